@@ -0,0 +1,170 @@
+"""
+ATLAS Higgs Machine Learning Challenge 2014
+
+Vectorized AMS computation and exact threshold scan
+
+The events are selected as signal if score>threshold. Instead of looping on the
+events for each threshold, the score is sorted once and the signal and background
+weights are summed from the right with cumulative sums, which gives the AMS for
+every distinct threshold in O(n log n).
+
+Typical use:
+    from higgsml_ams import optimise_threshold
+    best,curve=optimise_threshold(score,issig,kaggleweight)
+    print best["threshold"],best["ams"]
+
+The best threshold on the events used to train the classifier is biased, two options help:
+smoothing averages the AMS over neighbouring thresholds before taking the maximum, and
+crossvalidate_threshold picks the threshold on k-1 folds, measures the AMS on the held-out
+fold and returns the median threshold of the folds.
+
+"""
+
+import numpy as np
+from higgsml_instrument import instrumented, argument_length
+
+
+def ams(s, b, br=10.):
+    """ Approximate Median Significance (works on numbers and numpy arrays)
+        AMS = sqrt( 2 { (s + b + b_r) log[1 + (s/(b+b_r))] - s} )
+    where b_r = 10, b = background, s = signal, log is natural logarithm
+    As in higgsml_opendata_simplest.py, AMS is 0 if b is 0 """
+    s = np.asarray(s, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):  # b+br=0 is masked below
+        radicand = 2 * ((s + b + br) * np.log1p(s / (b + br)) - s)
+        result = np.where(b == 0, 0., np.sqrt(np.maximum(radicand, 0.)))
+    if result.ndim == 0:
+        return float(result)
+    return result
+
+
+def amssimple(s, b):
+    """ s/sqrt(b), 0 if b is 0 """
+    s = np.asarray(s, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    result = np.where(b > 0, s / np.sqrt(np.where(b > 0, b, 1.)), 0.)
+    return float(result) if result.ndim == 0 else result
+
+
+def amsasimov(s, b):
+    """ AMS without regularisation term (b_r=0), 0 if b is 0 """
+    return ams(s, b, 0.)
+
+
+def renormalisation(weight, issig, insub):
+    """ factors to apply to the signal and background weight of the subset insub (boolean mask)
+    so that the subset has the same total signal and background weight as the full dataset
+    (this is how KaggleWeight was derived from Weight) """
+    weight = np.asarray(weight)
+    issig = np.asarray(issig, dtype=bool)
+    insub = np.asarray(insub, dtype=bool)
+    sumallsig = weight[issig].sum()
+    sumallbkg = weight[~issig].sum()
+    sumsubsig = weight[insub & issig].sum()
+    sumsubbkg = weight[insub & ~issig].sum()
+    return sumallsig / sumsubsig, sumallbkg / sumsubbkg
+
+
+def selected_sums(score, issig, weight):
+    """ sort on the score and return, for each distinct score value (ascending),
+    the sum of signal and background weight of the events with a score strictly above """
+    score = np.asarray(score)
+    issig = np.asarray(issig, dtype=bool)
+    weight = np.asarray(weight, dtype=np.float64)
+    if len(score) == 0:
+        return score, np.zeros(0), np.zeros(0)
+    order = np.argsort(score, kind="mergesort")
+    sortedscore = score[order]
+    sortedsig = issig[order]
+    sortedweight = weight[order]
+    # sum from the right (more precise than total minus cumsum)
+    sigabove = np.append(np.cumsum(np.where(sortedsig, sortedweight, 0.)[::-1])[::-1], 0.)
+    bkgabove = np.append(np.cumsum(np.where(sortedsig, 0., sortedweight)[::-1])[::-1], 0.)
+    # last entry of each group of identical scores
+    last = np.flatnonzero(np.append(sortedscore[1:] != sortedscore[:-1], True))
+    return sortedscore[last], sigabove[last + 1], bkgabove[last + 1]
+
+
+def ams_curve(score, issig, weight, sigscale=1., bkgscale=1., br=10.):
+    """ AMS for every distinct threshold, selecting events with score>threshold
+    sigscale,bkgscale : factors applied to signal and background weights (see renormalisation)
+    Return a dictionary of arrays with keys threshold, ams, signal, background (ascending threshold),
+    and for information amssimple and amsasimov.
+    Selecting all events corresponds to a threshold below the lowest score and is not included """
+    thresholds, sig, bkg = selected_sums(score, issig, weight)
+    sig = sig * sigscale
+    bkg = bkg * bkgscale
+    return {"threshold": thresholds, "ams": ams(sig, bkg, br), "signal": sig, "background": bkg,
+            "amssimple": amssimple(sig, bkg), "amsasimov": amsasimov(sig, bkg)}
+
+
+def smooth(values, window):
+    """ moving average of values over window neighbouring entries (centred, shorter at the edges) """
+    values = np.asarray(values, dtype=np.float64)
+    if window <= 1 or len(values) == 0:
+        return values
+    cumulative = np.concatenate([[0.], np.cumsum(values)])
+    index = np.arange(len(values))
+    low = np.maximum(index - window // 2, 0)
+    high = np.minimum(index + (window - 1) // 2 + 1, len(values))
+    return (cumulative[high] - cumulative[low]) / (high - low)
+
+
+def best_point(curve):
+    """ the point of a curve (as returned by ams_curve) with the highest AMS, as a dictionary of numbers """
+    if len(curve["ams"]) == 0:
+        return {"threshold": None, "ams": 0., "signal": 0., "background": 0.}
+    ibest = int(np.argmax(curve["ams"]))
+    return dict((key, float(values[ibest])) for key, values in curve.items())
+
+
+@instrumented("threshold", rows=argument_length(0))
+def optimise_threshold(score, issig, weight, sigscale=1., bkgscale=1., br=10., smoothing=0):
+    """ find the threshold maximising the AMS
+    smoothing : if >1, maximise the AMS averaged over this number of neighbouring thresholds
+                (the curve then has an additional entry amssmooth)
+    Return the best point (dictionary threshold, ams, signal, background...) and the full curve """
+    curve = ams_curve(score, issig, weight, sigscale, bkgscale, br)
+    if smoothing > 1:
+        curve["amssmooth"] = smooth(curve["ams"], smoothing)
+        if len(curve["ams"]) == 0:
+            return best_point(curve), curve
+        ibest = int(np.argmax(curve["amssmooth"]))
+        return dict((key, float(values[ibest])) for key, values in curve.items()), curve
+    return best_point(curve), curve
+
+
+def ams_at(score, issig, weight, threshold, sigscale=1., bkgscale=1., br=10.):
+    """ AMS, signal and background selecting score>threshold """
+    selected = np.asarray(score) > threshold
+    issig = np.asarray(issig, dtype=bool)
+    weight = np.asarray(weight, dtype=np.float64)
+    sig = weight[selected & issig].sum() * sigscale
+    bkg = weight[selected & ~issig].sum() * bkgscale
+    return {"threshold": threshold, "ams": ams(sig, bkg, br), "signal": sig, "background": bkg}
+
+
+def crossvalidate_threshold(score, issig, weight, nfolds=5, seed=0, smoothing=0, br=10.):
+    """ Choose the threshold on k-1 folds, measure the AMS on the held-out fold.
+    The weights of each subset are renormalised per class to the total of all the events,
+    so the AMS of a fold is comparable to the AMS of the full set.
+    Return the median of the fold thresholds, and a dictionary of arrays (one entry per fold)
+    threshold, ams (AMS on the held-out fold, an unbiased estimate) and trainams (AMS where it was chosen) """
+    score = np.asarray(score)
+    issig = np.asarray(issig, dtype=bool)
+    weight = np.asarray(weight, dtype=np.float64)
+    fold = np.random.RandomState(seed).permutation(len(score)) % nfolds
+    folds = {"threshold": [], "ams": [], "trainams": []}
+    for ifold in range(nfolds):
+        heldout = fold == ifold
+        sigscale, bkgscale = renormalisation(weight, issig, ~heldout)
+        best, curve = optimise_threshold(score[~heldout], issig[~heldout], weight[~heldout],
+                                         sigscale, bkgscale, br, smoothing)
+        sigscale, bkgscale = renormalisation(weight, issig, heldout)
+        test = ams_at(score[heldout], issig[heldout], weight[heldout], best["threshold"], sigscale, bkgscale, br)
+        folds["threshold"] += [best["threshold"]]
+        folds["trainams"] += [best["ams"]]
+        folds["ams"] += [test["ams"]]
+    folds = dict((key, np.array(values)) for key, values in folds.items())
+    return float(np.median(folds["threshold"])), folds
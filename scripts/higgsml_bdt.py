@@ -0,0 +1,215 @@
+"""
+ATLAS Higgs Machine Learning Challenge 2014
+
+Pure numpy evaluation of a TMVA BDT, no ROOT needed
+
+The weight file written by TMVA (weights/TMVAClassification_BDT.weights.xml) is parsed
+into flat arrays (one entry per node of all the trees):
+  feature  index of the variable cut on (-1 for a leaf)
+  cut      cut value
+  cuttype  True if the event goes right when value>=cut, False when value<cut (TMVA cType)
+  left, right  index of the children
+  value    value of the leaf (node type +1/-1 with UseYesNoLeaf, purity otherwise, response for gradient boost)
+and the events are evaluated a batch at a time, all the trees together, one tree level per step.
+As in TMVA DecisionTreeNode::GoesRight, values and cuts are compared in float32.
+The result is the same as TMVA Reader EvaluateMVA, as computed by MethodBDT:
+  AdaBoost (and other non gradient boost)  sum(boostweight*leaf)/sum(boostweight)
+  Grad                                     2/(1+exp(-2*sum(leaf)))-1
+
+Typical use:
+    from higgsml_bdt import read_tmva_weights
+    forest=read_tmva_weights("weights/TMVAClassification_BDT.weights.xml")
+    bdt=forest.evaluate(columns) # columns : dictionary variable name -> array
+A Forest (also one trained by higgsml_gbt.py) can be saved and read back with save_forest and
+load_forest, several forests can be averaged into one with merge_forests.
+"""
+
+import xml.etree.ElementTree as ElementTree
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+from higgsml_instrument import instrumented, result_length
+
+
+# number of events evaluated at a time (all the trees together)
+BATCHSIZE = 10000
+
+
+class Forest(object):
+    """ a forest of binary decision trees stored as flat arrays """
+
+    def __init__(self, variables, feature, cut, cuttype, left, right, value, roots, boostweights, boosttype="AdaBoost"):
+        self.variables = list(variables)
+        self.feature = np.asarray(feature, dtype=np.int32)
+        self.cut = np.asarray(cut, dtype=np.float64)
+        self.cut32 = self.cut.astype(np.float32)  # the comparison is done in float, as TMVA
+        self.cuttype = np.asarray(cuttype, dtype=bool)
+        self.left = np.asarray(left, dtype=np.int32)
+        self.right = np.asarray(right, dtype=np.int32)
+        self.value = np.asarray(value, dtype=np.float64)
+        self.roots = np.asarray(roots, dtype=np.int32)
+        self.boostweights = np.asarray(boostweights, dtype=np.float64)
+        self.boosttype = boosttype
+        self.maxdepth = self._depth()
+
+    def _depth(self):
+        """ maximum depth of the trees (number of steps to reach all the leaves) """
+        depth = 0
+        nodes = self.roots
+        while len(nodes):
+            nodes = nodes[self.feature[nodes] >= 0]
+            if len(nodes):
+                depth += 1
+                nodes = np.concatenate([self.left[nodes], self.right[nodes]])
+        return depth
+
+    def matrix(self, columns):
+        """ 2D array (events, variables) from a dictionary of columns or a 2D array
+        Variables are converted to float like for the TMVA Reader (which only takes float) """
+        if isinstance(columns, dict):
+            missing = [var for var in self.variables if var not in columns]
+            if missing:
+                raise KeyError("variables needed by the BDT are missing: %s" % ",".join(missing))
+            x = np.empty((len(columns[self.variables[0]]), len(self.variables)), dtype=np.float32)
+            for ivar, var in enumerate(self.variables):
+                x[:, ivar] = columns[var]
+        else:
+            x = np.asarray(columns, dtype=np.float32)
+            if x.ndim != 2 or x.shape[1] != len(self.variables):
+                raise ValueError("expected an array of shape (events, %d)" % len(self.variables))
+        return x
+
+    def leaves(self, x):
+        """ index of the leaf reached in each tree by each event of the 2D array x, shape (trees, events) """
+        nevents = len(x)
+        node = np.repeat(self.roots[:, np.newaxis], nevents, axis=1)
+        events = np.arange(nevents)[np.newaxis, :]
+        for _ in range(self.maxdepth):
+            feature = self.feature[node]
+            inner = feature >= 0
+            values = x[events, np.where(inner, feature, 0)]
+            goesright = (values >= self.cut32[node]) == self.cuttype[node]
+            node = np.where(inner, np.where(goesright, self.right[node], self.left[node]), node)
+        return node
+
+    def evaluate_batch(self, x):
+        """ BDT output for the 2D array x """
+        leafvalues = self.value[self.leaves(x)]
+        if self.boosttype == "Grad":
+            return 2.0 / (1.0 + np.exp(-2.0 * leafvalues.sum(axis=0))) - 1
+        norm = self.boostweights.sum()
+        if norm <= np.finfo(np.float64).eps:
+            return np.zeros(len(x))
+        return np.dot(self.boostweights, leafvalues) / norm
+
+    @instrumented("evaluate", rows=result_length)
+    def evaluate(self, columns, batchsize=BATCHSIZE, nworkers=1):
+        """ BDT output for all events of columns (dictionary variable name -> array, or 2D array)
+        the events are evaluated by batches, in a pool of nworkers threads if nworkers>1 """
+        x = self.matrix(columns)
+        batches = [x[start:start + batchsize] for start in range(0, len(x), batchsize)]
+        if not batches:
+            return np.empty(0)
+        if nworkers > 1:
+            pool = ThreadPool(nworkers)
+            try:
+                results = pool.map(self.evaluate_batch, batches)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [self.evaluate_batch(batch) for batch in batches]
+        return np.concatenate(results)
+
+
+def merge_forests(forests):
+    """ one Forest averaging several forests of the same variables and boost type (e.g. the models of a k-fold
+    training): AdaBoost output is the mean of the outputs, Grad output is computed from the mean of the sums """
+    variables, boosttype = forests[0].variables, forests[0].boosttype
+    if any(forest.variables != variables or forest.boosttype != boosttype for forest in forests):
+        raise ValueError("only forests of the same variables and boost type can be merged")
+    nodes = {"feature": [], "cut": [], "cuttype": [], "left": [], "right": [], "value": [], "roots": [], "boostweights": []}
+    offset = 0
+    for forest in forests:
+        for key in ["feature", "cut", "cuttype"]:
+            nodes[key] += [getattr(forest, key)]
+        for key in ["left", "right"]:
+            children = getattr(forest, key)
+            nodes[key] += [np.where(children >= 0, children + offset, -1)]
+        nodes["roots"] += [forest.roots + offset]
+        if boosttype == "Grad":
+            nodes["value"] += [forest.value / len(forests)]
+            nodes["boostweights"] += [forest.boostweights]
+        else:
+            nodes["value"] += [forest.value]
+            nodes["boostweights"] += [forest.boostweights / forest.boostweights.sum()]
+        offset += len(forest.feature)
+    nodes = dict((key, np.concatenate(values)) for key, values in nodes.items())
+    return Forest(variables, nodes["feature"], nodes["cut"], nodes["cuttype"], nodes["left"], nodes["right"],
+                  nodes["value"], nodes["roots"], nodes["boostweights"], boosttype)
+
+
+def save_forest(forest, filename):
+    """ save a Forest (e.g. trained by higgsml_gbt.py) in a numpy .npz file """
+    np.savez(filename, variables=np.array(forest.variables), feature=forest.feature, cut=forest.cut,
+             cuttype=forest.cuttype, left=forest.left, right=forest.right, value=forest.value, roots=forest.roots,
+             boostweights=forest.boostweights, boosttype=np.array(forest.boosttype))
+
+
+def load_forest(filename):
+    """ read a Forest saved by save_forest """
+    data = np.load(filename)
+    return Forest([str(var) for var in data["variables"]], data["feature"], data["cut"], data["cuttype"],
+                  data["left"], data["right"], data["value"], data["roots"], data["boostweights"],
+                  str(data["boosttype"]))
+
+
+def read_tmva_weights(filename):
+    """ read a TMVA BDT weight file (xml), return a Forest """
+    root = ElementTree.parse(filename).getroot()
+
+    options = dict((option.get("name"), (option.text or "").strip()) for option in root.iter("Option"))
+    boosttype = options.get("BoostType", "AdaBoost")
+    useyesnoleaf = options.get("UseYesNoLeaf", "True").lower() in ["true", "1"]
+
+    transformations = root.find("Transformations")
+    if transformations is not None and int(transformations.get("NTransformations", "0")) != 0:
+        raise NotImplementedError("variable transformations are not supported")
+
+    variables = [None] * int(root.find("Variables").get("NVar"))
+    for variable in root.find("Variables").findall("Variable"):
+        variables[int(variable.get("VarIndex"))] = variable.get("Expression")
+
+    nodes = {"feature": [], "cut": [], "cuttype": [], "left": [], "right": [], "value": []}
+
+    def addnode(node):
+        """ add node and its children (depth first), return its index """
+        if int(node.get("NCoef", "0")) != 0:
+            raise NotImplementedError("fisher cuts are not supported")
+        inode = len(nodes["feature"])
+        for key in nodes:
+            nodes[key] += [-1 if key in ["feature", "left", "right"] else 0]
+        children = dict((child.get("pos"), child) for child in node.findall("Node"))
+        nodetype = int(node.get("nType"))
+        if nodetype == 0 and children:
+            nodes["feature"][inode] = int(node.get("IVar"))
+            nodes["cut"][inode] = float(node.get("Cut"))
+            nodes["cuttype"][inode] = int(node.get("cType")) == 1
+            nodes["left"][inode] = addnode(children["l"])
+            nodes["right"][inode] = addnode(children["r"])
+        elif boosttype == "Grad":
+            nodes["value"][inode] = float(node.get("res"))
+        elif useyesnoleaf:
+            nodes["value"][inode] = float(nodetype)
+        else:
+            nodes["value"][inode] = float(node.get("purity"))
+        return inode
+
+    roots = []
+    boostweights = []
+    for tree in root.find("Weights").findall("BinaryTree"):
+        boostweights += [float(tree.get("boostWeight", "1"))]
+        roots += [addnode(tree.find("Node"))]
+
+    return Forest(variables, nodes["feature"], nodes["cut"], nodes["cuttype"], nodes["left"], nodes["right"],
+                  nodes["value"], roots, boostweights, boosttype)
@@ -0,0 +1,243 @@
+"""
+ATLAS Higgs Machine Learning Challenge 2014
+
+Benchmarks of the scripts on synthetic data (no need of atlas-higgs-challenge-2014-v2.csv)
+
+A synthetic file with the schema of the real one is generated once (see higgsml_synthetic.py),
+at scale times the real size (1 to 100), then each benchmark runs in its own process:
+  load_csv     parse the csv file into columns (higgsml_data.load_csv)
+  build_cache  convert the csv file into the binary cache (higgsml_data.build_cache)
+  load_cached  memory-map the cache and read all the columns
+  score        evaluate a BDT of NTREES random trees on all the events (higgsml_bdt.Forest)
+  threshold    exact AMS scan on the training set (higgsml_ams.optimise_threshold)
+  submission   rank and write the submission file of the test events (higgsml_submission.write_submission)
+  kaggle       validate and score the submission file against the solution (higgsml_opendata_kaggle)
+For each benchmark the time of the operation (not of its setup), the throughput in events/s
+(and MB/s for those reading the csv file), and the peak resident memory of the process are
+printed and saved in benchmark_x<scale>.json. Given the json file of a previous run, the
+benchmarks which became slower or use more memory by more than TOLERANCE are flagged.
+
+Typical use:
+    python higgsml_benchmark.py                                   scale 1
+    python higgsml_benchmark.py 10                                scale 10
+    python higgsml_benchmark.py 1 benchmark_reference.json        compare with a previous run
+"""
+
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+from collections import OrderedDict
+
+import numpy as np
+from higgsml_data import load_csv, load_cached, build_cache, KAGGLESETS
+from higgsml_ams import optimise_threshold
+from higgsml_bdt import Forest
+from higgsml_submission import write_submission
+from higgsml_synthetic import write_csv, HEADER, NEVENTS
+from higgsml_instrument import peak_memory
+
+
+# directory for the synthetic file and the outputs of the benchmarks (kept between runs)
+WORKDIR = "benchmark_data"
+SEED = 0
+# random BDT for the score benchmark
+NTREES = 200
+DEPTH = 3
+# a benchmark is flagged if its throughput is lower, or its memory higher, by more than this factor
+TOLERANCE = 1.2
+
+# variables of the BDT, as in higgsml_opendata_tmva.py
+BDT_VARIABLES = [var for var in HEADER if var not in ["EventId", "Weight", "Label", "KaggleSet", "KaggleWeight"]]
+
+
+def random_forest(variables, columns, ntrees=NTREES, depth=DEPTH, seed=SEED):
+    """ a Forest of ntrees complete trees of the given depth, cutting on random variables
+    at the value of a random event, with AdaBoost leaves +1/-1 """
+    rng = np.random.RandomState(seed)
+    nnodes = 2 ** (depth + 1) - 1
+    ninternal = 2 ** depth - 1
+    node = np.arange(nnodes)
+    internal = node < ninternal
+    feature = np.where(internal, rng.randint(len(variables), size=(ntrees, nnodes)), -1)
+    events = rng.randint(len(columns[variables[0]]), size=(ntrees, nnodes))
+    cut = np.array([[columns[variables[f]][e] if f >= 0 else 0. for f, e in zip(tf, te)]
+                    for tf, te in zip(feature, events)])
+    offset = (np.arange(ntrees) * nnodes)[:, np.newaxis]
+    left = np.where(internal, 2 * node + 1, -1) + np.where(internal, offset, 0)
+    right = np.where(internal, 2 * node + 2, -1) + np.where(internal, offset, 0)
+    value = np.where(internal, 0., rng.choice([-1., 1.], size=(ntrees, nnodes)))
+    return Forest(variables, feature.ravel(), cut.ravel(), np.ones(ntrees * nnodes, dtype=bool),
+                  left.ravel(), right.ravel(), value.ravel(), offset.ravel(), rng.uniform(0.5, 1., ntrees))
+
+
+def proxy_score(columns):
+    """ a cheap score with some separation (and ties, as a float32 BDT output) for the benchmarks after scoring """
+    mmc = np.asarray(columns["DER_mass_MMC"])
+    rng = np.random.RandomState(SEED)
+    return (np.where(mmc > 0, -np.abs(mmc - 125.), -200.) + rng.normal(0., 20., len(mmc))).astype(np.float32)
+
+
+def bench_load_csv(csvfile):
+    start = time.time()
+    columns = load_csv(csvfile)
+    return len(columns["EventId"]), time.time() - start, os.path.getsize(csvfile)
+
+
+def bench_build_cache(csvfile):
+    cachedir = os.path.join(WORKDIR, "benchmark.cache")
+    if os.path.exists(cachedir):
+        shutil.rmtree(cachedir)
+    start = time.time()
+    meta = build_cache(csvfile, cachedir)
+    seconds = time.time() - start
+    shutil.rmtree(cachedir)
+    return meta["nrows"], seconds, os.path.getsize(csvfile)
+
+
+def bench_load_cached(csvfile):
+    load_cached(csvfile)  # make sure the cache exists
+    start = time.time()
+    columns, meta = load_cached(csvfile)
+    for col in columns.values():
+        np.asarray(col).sum()  # read every page
+    return meta["nrows"], time.time() - start, None
+
+
+def bench_score(csvfile):
+    columns, meta = load_cached(csvfile, BDT_VARIABLES)
+    forest = random_forest(BDT_VARIABLES, columns)
+    start = time.time()
+    forest.evaluate(columns)
+    return meta["nrows"], time.time() - start, None
+
+
+def bench_threshold(csvfile):
+    columns, meta = load_cached(csvfile, ["DER_mass_MMC", "Label", "KaggleSet", "KaggleWeight"])
+    intrain = columns["KaggleSet"] == KAGGLESETS.index("t")
+    score = proxy_score(columns)[intrain]
+    issig = columns["Label"][intrain] == 1
+    weight = columns["KaggleWeight"][intrain]
+    start = time.time()
+    optimise_threshold(score, issig, weight)
+    return len(score), time.time() - start, None
+
+
+def bench_submission(csvfile):
+    columns, meta = load_cached(csvfile, ["EventId", "DER_mass_MMC", "KaggleSet"])
+    intest = np.isin(columns["KaggleSet"], [KAGGLESETS.index("b"), KAGGLESETS.index("v")])
+    score = proxy_score(columns)[intest]
+    eventid = columns["EventId"][intest]
+    start = time.time()
+    nwritten = write_submission(os.path.join(WORKDIR, "submission_benchmark.csv"), eventid, score, np.median(score))
+    return nwritten, time.time() - start, None
+
+
+def bench_kaggle(csvfile):
+    from higgsml_opendata_kaggle import load_solution_store, score_submission, TESTSETS
+    submission = os.path.join(WORKDIR, "submission_benchmark.csv")
+    if not os.path.exists(submission):
+        bench_submission(csvfile)
+    store = load_solution_store(csvfile)  # built once, as in the batch scoring
+    start = time.time()
+    score_submission(submission, store)
+    return int(np.isin(store["KaggleSet"], TESTSETS).sum()), time.time() - start, os.path.getsize(submission)
+
+
+BENCHMARKS = OrderedDict([
+    ("load_csv", bench_load_csv),
+    ("build_cache", bench_build_cache),
+    ("load_cached", bench_load_cached),
+    ("score", bench_score),
+    ("threshold", bench_threshold),
+    ("submission", bench_submission),
+    ("kaggle", bench_kaggle),
+])
+
+
+def run_benchmark(args):
+    """ run one benchmark, return a dictionary with its measurements """
+    name, csvfile = args
+    peak_memory(reset=True)
+    nrows, seconds, nbytes = BENCHMARKS[name](csvfile)
+    result = OrderedDict([("benchmark", name), ("events", nrows), ("seconds", seconds),
+                          ("eventspersecond", nrows / max(seconds, 1e-9)), ("peakmemorymb", peak_memory())])
+    if nbytes is not None:
+        result["mbpersecond"] = nbytes / 1e6 / max(seconds, 1e-9)
+    return result
+
+
+def in_new_process(func, *args):
+    """ func(*args) in a new process, so that its memory is not counted in (nor inherited by) this one """
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(func, args)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def run_benchmarks(csvfile, names=None):
+    """ run the benchmarks, each in a new process so that the peak memory is its own """
+    results = []
+    for name in names or BENCHMARKS:
+        try:
+            results += [in_new_process(run_benchmark, (name, csvfile))]
+        except (ImportError, SyntaxError) as e:
+            # e.g. higgsml_opendata_kaggle.py is python 2 only
+            print("%-12s skipped: %s" % (name, e))
+            continue
+        print("%-12s %10d events %8.2f s %12.0f events/s %8.0f MB" % (
+            name, results[-1]["events"], results[-1]["seconds"], results[-1]["eventspersecond"], results[-1]["peakmemorymb"]))
+    return results
+
+
+def compare(results, reference, tolerance=TOLERANCE):
+    """ list of messages for the benchmarks slower or using more memory than in the reference results """
+    previous = dict((result["benchmark"], result) for result in reference)
+    messages = []
+    for result in results:
+        old = previous.get(result["benchmark"])
+        if old is None:
+            continue
+        if result["eventspersecond"] * tolerance < old["eventspersecond"]:
+            messages += ["%s is slower: %.0f events/s instead of %.0f" % (
+                result["benchmark"], result["eventspersecond"], old["eventspersecond"])]
+        if result["peakmemorymb"] > old["peakmemorymb"] * tolerance:
+            messages += ["%s uses more memory: %.0f MB instead of %.0f" % (
+                result["benchmark"], result["peakmemorymb"], old["peakmemorymb"])]
+    return messages
+
+
+if __name__ == "__main__":
+    scale = float(sys.argv[1]) if len(sys.argv) > 1 else 1.
+    referencefile = sys.argv[2] if len(sys.argv) > 2 else None
+    reference = None
+    if referencefile:
+        with open(referencefile) as f:  # read now, the output file may be the same
+            reference = json.load(f)["results"]
+
+    if not os.path.exists(WORKDIR):
+        os.makedirs(WORKDIR)
+    csvfile = os.path.join(WORKDIR, "synthetic_x%g_seed%d.csv" % (scale, SEED))
+    if not os.path.exists(csvfile):
+        start = time.time()
+        # in this process, write_csv has its own pool of processes (and writes the file under its final name at the end)
+        nrows = write_csv(csvfile, None, SEED, scale)
+        print("generated %d events (%.1f MB) in %s in %.1f s" % (nrows, os.path.getsize(csvfile) / 1e6, csvfile,
+                                                                  time.time() - start))
+
+    results = run_benchmarks(csvfile)
+    outputfile = "benchmark_x%g.json" % scale
+    with open(outputfile, "w") as f:
+        json.dump({"scale": scale, "events": int(round(NEVENTS * scale)), "results": results}, f, indent=1)
+    print("results written in %s" % outputfile)
+
+    if reference is not None:
+        messages = compare(results, reference)
+        for message in messages:
+            print("REGRESSION " + message)
+        if not messages:
+            print("no regression compared to %s" % referencefile)
@@ -0,0 +1,148 @@
+"""
+ATLAS Higgs Machine Learning Challenge 2014
+
+Bootstrap estimation of the AMS uncertainty
+
+Each replica gives every event a Poisson(1) multiplicity, which is equivalent to drawing the
+events again with replacement. The events are sorted on the score once; a batch of replicas
+is then a matrix (replicas, events) of multiplicities, and the signal and background weights
+above every threshold are cumulative sums along the events, as in higgsml_ams.py. For each
+replica this gives the AMS at a fixed threshold, and the best threshold with its AMS.
+
+The replicas are split in blocks of fixed size, each with its own seed (seed, block index),
+so the result only depends on seed and not on the number of worker processes.
+
+Typical use:
+    from higgsml_bootstrap import bootstrap_ams,summarise
+    replicas=bootstrap_ams(score,issig,kaggleweight,threshold,nreplicas=1000)
+    print summarise(replicas["ams"])
+"""
+
+import math
+import multiprocessing
+
+import numpy as np
+from higgsml_ams import ams
+
+
+# number of replicas generated with the same seed (one task of a worker)
+BLOCKSIZE = 50
+# maximum size of a matrix (replicas, events) in memory at a time
+MAXELEMENTS = 4000000
+
+# cumulative distribution of Poisson(1), the tail beyond 20 is below double precision
+POISSON1_CDF = np.cumsum([math.exp(-1.) / math.factorial(k) for k in range(20)])
+
+# data shared by the worker processes
+_data = None
+
+
+def _init_worker(data):
+    global _data
+    _data = data
+
+
+def poisson1(rng, size):
+    """ Poisson(1) multiplicities by inversion of the cumulative distribution (faster than rng.poisson) """
+    return np.searchsorted(POISSON1_CDF, rng.random_sample(size), side="right").astype(np.float64)
+
+
+def _run_block(task):
+    """ generate the replicas of one block, return the AMS at the threshold, the best threshold and AMS of each
+    (best threshold and AMS are None without scan) """
+    iblock, nreplicas, seed = task
+    d = _data
+    nevents = len(d["sigweight"])
+    rng = np.random.RandomState([seed, iblock])
+    batchsize = max(1, min(nreplicas, MAXELEMENTS // max(nevents, 1)))
+    amsat, bestthreshold, bestams = [], [], []
+    for start in range(0, nreplicas, batchsize):
+        multiplicity = poisson1(rng, (min(batchsize, nreplicas - start), nevents))
+        if not d["scan"]:
+            # only the selected events matter, a matrix-vector product per weight
+            position = d["position"]
+            amsat += [ams(np.dot(multiplicity[:, position:], d["sigweight"][position:]),
+                          np.dot(multiplicity[:, position:], d["bkgweight"][position:]), d["br"])]
+            continue
+        # weights above each position, sum from the right with an extra zero column at the end
+        sigabove = np.cumsum((multiplicity * d["sigweight"])[:, ::-1], axis=1)[:, ::-1]
+        bkgabove = np.cumsum((multiplicity * d["bkgweight"])[:, ::-1], axis=1)[:, ::-1]
+        del multiplicity
+        zero = np.zeros((len(sigabove), 1))
+        sigabove = np.hstack([sigabove, zero])
+        bkgabove = np.hstack([bkgabove, zero])
+        if d["position"] is not None:
+            amsat += [ams(sigabove[:, d["position"]], bkgabove[:, d["position"]], d["br"])]
+        curve = ams(sigabove[:, d["last"] + 1], bkgabove[:, d["last"] + 1], d["br"])
+        ibest = np.argmax(curve, axis=1)
+        bestthreshold += [d["thresholds"][ibest]]
+        bestams += [curve[np.arange(len(curve)), ibest]]
+    concatenate = lambda results: np.concatenate(results) if results else None
+    return concatenate(amsat), concatenate(bestthreshold), concatenate(bestams)
+
+
+def bootstrap_ams(score, issig, weight, threshold=None, nreplicas=1000, seed=0, nworkers=None,
+                  sigscale=1., bkgscale=1., br=10., scan=True):
+    """ Poisson bootstrap of the events (score>threshold is selected as signal)
+    sigscale,bkgscale : factors applied to signal and background weights (see higgsml_ams.renormalisation)
+    nworkers : number of processes (default number of cores), 1 to run in this process
+    scan : if False only compute the AMS at threshold (faster)
+    Return a dictionary of arrays, one entry per replica:
+        ams        AMS at threshold (only if threshold is given)
+        threshold  best threshold of the replica (only with scan)
+        bestams    AMS at the best threshold (only with scan)
+    without events, every replica has ams 0, threshold NaN and bestams 0 """
+    if threshold is None and not scan:
+        raise ValueError("a threshold is needed without scan")
+    score = np.asarray(score)
+    issig = np.asarray(issig, dtype=bool)
+    weight = np.asarray(weight, dtype=np.float64)
+    if len(score) == 0:
+        replicas = {}
+        if scan:
+            replicas["threshold"] = np.full(nreplicas, np.nan)
+            replicas["bestams"] = np.zeros(nreplicas)
+        if threshold is not None:
+            replicas["ams"] = np.zeros(nreplicas)
+        return replicas
+    order = np.argsort(score, kind="mergesort")
+    sortedscore = score[order]
+    last = np.flatnonzero(np.append(sortedscore[1:] != sortedscore[:-1], True))
+    data = {
+        "sigweight": np.where(issig[order], weight[order] * sigscale, 0.),
+        "bkgweight": np.where(issig[order], 0., weight[order] * bkgscale),
+        "last": last,
+        "thresholds": sortedscore[last],
+        # first sorted event with score>threshold
+        "position": None if threshold is None else int(np.searchsorted(sortedscore, threshold, side="right")),
+        "br": br,
+        "scan": scan,
+    }
+
+    tasks = [(iblock, min(BLOCKSIZE, nreplicas - start), seed)
+             for iblock, start in enumerate(range(0, nreplicas, BLOCKSIZE))]
+    if nworkers == 1 or len(tasks) <= 1:
+        _init_worker(data)
+        results = [_run_block(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(nworkers, _init_worker, (data,))
+        try:
+            results = pool.map(_run_block, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+    replicas = {}
+    if scan:
+        replicas["threshold"] = np.concatenate([r[1] for r in results])
+        replicas["bestams"] = np.concatenate([r[2] for r in results])
+    if threshold is not None:
+        replicas["ams"] = np.concatenate([r[0] for r in results])
+    return replicas
+
+
+def summarise(values, cl=0.68):
+    """ mean, standard deviation and central confidence interval (at confidence level cl) of the replica values """
+    values = np.asarray(values)
+    low, high = np.percentile(values, [50 * (1 - cl), 50 * (1 + cl)])
+    return {"mean": float(values.mean()), "std": float(values.std()), "low": float(low), "high": float(high), "cl": cl}
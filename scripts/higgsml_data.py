@@ -0,0 +1,356 @@
+"""
+ATLAS Higgs Machine Learning Challenge 2014
+
+Typed columnar loader for the challenge csv file atlas-higgs-challenge-2014-v2.csv
+Instead of a list (one entry per line) of list of strings, the file is read into
+one numpy array per variable :
+  EventId, PRI_jet_num, RankOrder  -> int32
+  all the other numeric variables  -> float64 (physics variables, Weight, KaggleWeight)
+  Label, KaggleSet, Class          -> int8 codes, the code is the index in LABELS / KAGGLESETS
+
+Typical use:
+    from higgsml_data import load_csv
+    columns=load_csv("atlas-higgs-challenge-2014-v2.csv")
+    mmc=columns["DER_mass_MMC"]
+    issig=columns["Label"]==LABELS.index("s")
+
+Parsing the csv takes a few seconds, load_cached converts it once into a directory
+(by default atlas-higgs-challenge-2014-v2.csv.cache) with one .npy file per variable
+and a meta.json sidecar (header, dtypes, number of rows, sha1 of the csv file and the
+sums of Weight and KaggleWeight per Label and KaggleSet). Later runs memory-map the
+.npy files and never read the csv. The cache is rebuilt if the csv file changes.
+    columns,meta=load_cached("atlas-higgs-challenge-2014-v2.csv")
+    sumallsig=sum(meta["sums"]["Weight"]["s"].values())
+
+The csv file can be compressed (gzip, bzip2 or xz, e.g. atlas-higgs-challenge-2014-v2.csv.gz),
+it is decompressed on the fly while being parsed (see higgsml_input.py).
+
+"""
+
+import hashlib
+import json
+import os
+import shutil
+from collections import OrderedDict
+
+import numpy as np
+from higgsml_input import open_input
+from higgsml_instrument import instrumented, columns_length
+
+
+# categorical variables are stored as small int codes, the code is the index in the tuple
+# Label follows the convention of the root file of higgsml_opendata_tmva.py : 1 for "s", 0 for "b"
+LABELS = ("b", "s")
+# kaggle sample "t" training "b" public leaderboard "v" private leaderboard "u" unused
+KAGGLESETS = ("t", "b", "v", "u")
+# Class is the predicted label of a submission file
+CATEGORIES = {"Label": LABELS, "KaggleSet": KAGGLESETS, "Class": LABELS}
+
+# variables which are integer, all the others (except categories) are float
+INTVARS = ["EventId", "PRI_jet_num", "RankOrder"]
+
+# code for a categorical value not found in CATEGORIES
+UNKNOWN = -1
+
+# the csv is parsed in blocks of roughly this size (bytes), so that only one block of text is in memory at a time
+BLOCKSIZE = 1 << 24
+
+
+def column_dtype(var, float_dtype=np.float64):
+    """ numpy dtype in which variable var is stored """
+    if var in CATEGORIES:
+        return np.dtype(np.int8)
+    if var in INTVARS:
+        return np.dtype(np.int32)
+    return np.dtype(float_dtype)
+
+
+def encode(var, values):
+    """ convert an array (or list) of strings of categorical variable var into int codes """
+    values = np.asarray(values)
+    codes = np.empty(values.shape, dtype=np.int8)
+    codes.fill(UNKNOWN)
+    for code, cat in enumerate(CATEGORIES[var]):
+        codes[(values == cat) | (values == cat.encode("ascii"))] = code
+    return codes
+
+
+def decode(var, codes):
+    """ convert int codes of categorical variable var back to an array of strings """
+    cats = np.array(CATEGORIES[var] + ("?",))
+    return cats[np.asarray(codes)]  # UNKNOWN=-1 picks the trailing "?"
+
+
+def iter_line_blocks(f, blocksize=BLOCKSIZE):
+    """ yield the content of binary file object f in blocks of complete lines """
+    rest = b""
+    while True:
+        block = f.read(blocksize)
+        if not block:
+            break
+        block = rest + block
+        iend = block.rfind(b"\n")
+        if iend < 0:
+            rest = block
+            continue
+        rest = block[iend + 1:]
+        yield block[:iend + 1]
+    if rest.strip():
+        yield rest + b"\n"
+
+
+def read_header(f):
+    """ read the first line of binary file object f, return the list of variable names """
+    line = f.readline()
+    return [str(var.strip().decode("ascii")) for var in line.split(b",")]
+
+
+class BlockParser(object):
+    """ convert blocks of csv lines into typed numpy columns
+
+    The numeric fields are parsed in C by numpy. To do so, each categorical letter is first
+    translated in the text into a placeholder digit, which is then converted into the code of
+    its own column (the same letter can mean different things, "b" is a Label and a KaggleSet).
+    """
+
+    def __init__(self, header, float_dtype=np.float64):
+        self.header = list(header)
+        self.float_dtype = float_dtype
+        self.nvar = len(self.header)
+        letters = set()
+        for var in self.header:
+            letters.update(CATEGORIES.get(var, ()))
+        self.letters = sorted(letters)
+        if len(self.letters) > 10 or [cat for cat in self.letters if len(cat) != 1 or cat in "eE"]:
+            raise ValueError("categories should be at most 10 single letters (not e/E)")
+        # one pass over the text : letter -> placeholder digit, end of line -> separator
+        table = list(range(256))
+        for i, cat in enumerate(self.letters):
+            table[ord(cat)] = ord(str(i))
+        table[ord("\n")] = ord(",")
+        self.table = bytes(bytearray(table))
+        # for each categorical column, placeholder digit -> code
+        self.lookup = {}
+        for var in self.header:
+            if var in CATEGORIES:
+                lookup = np.empty(len(self.letters), dtype=np.int8)
+                lookup.fill(UNKNOWN)
+                for code, cat in enumerate(CATEGORIES[var]):
+                    lookup[self.letters.index(cat)] = code
+                self.lookup[var] = lookup
+
+    def parse(self, block):
+        """ parse a block of complete lines, return an OrderedDict variable -> numpy array """
+        text = block.translate(self.table, b"\r").strip(b",")
+        values = np.fromstring(text, dtype=np.float64, sep=",") if text else np.empty(0)
+        if values.size != text.count(b",") + 1 or values.size % self.nvar != 0:
+            raise ValueError("csv block could not be parsed into %d numerical fields per line" % self.nvar)
+        values = values.reshape(-1, self.nvar)
+        columns = OrderedDict()
+        for ivar, var in enumerate(self.header):
+            col = values[:, ivar]
+            if var in self.lookup:
+                placeholder = col.astype(np.intp)
+                codes = np.empty(len(col), dtype=np.int8)
+                codes.fill(UNKNOWN)
+                valid = (placeholder >= 0) & (placeholder < len(self.letters)) & (placeholder == col)
+                codes[valid] = self.lookup[var][placeholder[valid]]
+                col = codes
+            else:
+                col = col.astype(column_dtype(var, self.float_dtype))
+            columns[var] = col
+        return columns
+
+
+def concatenate(blocks, header):
+    """ concatenate a list of column dictionaries into one """
+    columns = OrderedDict()
+    for var in header:
+        columns[var] = np.concatenate([b[var] for b in blocks])
+        for b in blocks:
+            del b[var]  # release memory as we go
+    return columns
+
+
+@instrumented("load", rows=columns_length)
+def load_csv(filename, variables=None, float_dtype=np.float64, blocksize=BLOCKSIZE):
+    """ Read the csv file, return an OrderedDict variable name -> numpy array
+    (in the same order as the header of the file).
+    variables : if not None, the list of variables to keep """
+    with open_input(filename) as f:
+        header = read_header(f)
+        parser = BlockParser(header, float_dtype)
+        keep = header if variables is None else [var for var in header if var in variables]
+        blocks = []
+        for block in iter_line_blocks(f, blocksize):
+            columns = parser.parse(block)
+            blocks += [OrderedDict((var, columns[var]) for var in keep)]
+    if not blocks:
+        return OrderedDict((var, np.empty(0, dtype=column_dtype(var, float_dtype))) for var in keep)
+    return concatenate(blocks, keep)
+
+
+# version of the cache layout, bump it to invalidate existing caches
+CACHE_VERSION = 1
+CACHE_META = "meta.json"
+
+
+def file_hash(filename, blocksize=BLOCKSIZE):
+    """ sha1 hex digest of the content of a file """
+    h = hashlib.sha1()
+    with open(filename, "rb") as f:
+        while True:
+            block = f.read(blocksize)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+def default_cachedir(filename):
+    return filename + ".cache"
+
+
+def weight_sums(columns):
+    """ sums of Weight and KaggleWeight per Label and KaggleSet
+    returned as {weight: {label: {kaggleset: sum}}} """
+    sums = {}
+    if "Label" not in columns or "KaggleSet" not in columns:
+        return sums
+    # one bincount per weight on the combined (Label,KaggleSet) index
+    ncat = len(KAGGLESETS)
+    index = columns["Label"].astype(np.intp) * ncat + columns["KaggleSet"]
+    valid = (columns["Label"] >= 0) & (columns["KaggleSet"] >= 0)
+    for wvar in ["Weight", "KaggleWeight"]:
+        if wvar not in columns:
+            continue
+        total = np.bincount(index[valid], weights=columns[wvar][valid], minlength=len(LABELS) * ncat)
+        sums[wvar] = dict((label, dict((kset, float(total[il * ncat + ik])) for ik, kset in enumerate(KAGGLESETS)))
+                          for il, label in enumerate(LABELS))
+    return sums
+
+
+def add_sums(total, sums):
+    """ add weight sums (as returned by weight_sums) into total, return total """
+    for wvar, bylabel in sums.items():
+        for label, bykset in bylabel.items():
+            for kset, value in bykset.items():
+                total.setdefault(wvar, {}).setdefault(label, {})
+                total[wvar][label][kset] = total[wvar][label].get(kset, 0.) + value
+    return total
+
+
+def count_rows(filename, blocksize=BLOCKSIZE):
+    """ number of lines of the csv file after the header """
+    nrows = 0
+    with open_input(filename) as f:
+        read_header(f)
+        for block in iter_line_blocks(f, blocksize):
+            nrows += block.count(b"\n")
+    return nrows
+
+
+def read_cache_meta(cachedir):
+    """ return the metadata of a cache directory, None if there is none """
+    try:
+        with open(os.path.join(cachedir, CACHE_META)) as f:
+            meta = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    # native strings for the variable names (json gives unicode in python 2)
+    meta["header"] = [str(var) for var in meta.get("header", [])]
+    return meta
+
+
+def write_cache_meta(cachedir, meta):
+    tmpname = os.path.join(cachedir, CACHE_META + ".tmp")
+    with open(tmpname, "w") as f:
+        json.dump(meta, f, indent=1, sort_keys=True)
+    os.rename(tmpname, os.path.join(cachedir, CACHE_META))
+
+
+@instrumented("convert", rows=lambda meta, *args, **kwargs: meta["nrows"])
+def build_cache(filename, cachedir=None, float_dtype=np.float64, blocksize=BLOCKSIZE):
+    """ convert the csv file into a cache directory, return the metadata
+    The file is converted block by block, so the memory used does not depend on its size """
+    cachedir = cachedir or default_cachedir(filename)
+    stat = os.stat(filename)
+    nrows = count_rows(filename, blocksize)  # the .npy headers need the number of rows
+    # write in a temporary directory, then move in place so that an interrupted build leaves no half cache
+    tmpdir = cachedir + ".tmp%d" % os.getpid()
+    if os.path.exists(tmpdir):
+        shutil.rmtree(tmpdir)
+    os.makedirs(tmpdir)
+    sums = {}
+    with open_input(filename) as f:
+        header = read_header(f)
+        parser = BlockParser(header, float_dtype)
+        dtypes = OrderedDict((var, column_dtype(var, float_dtype)) for var in header)
+        outputs = OrderedDict((var, open(os.path.join(tmpdir, var + ".npy"), "wb")) for var in header)
+        try:
+            for var, output in outputs.items():
+                np.lib.format.write_array_header_1_0(output, {"descr": np.lib.format.dtype_to_descr(dtypes[var]),
+                                                              "fortran_order": False, "shape": (nrows,)})
+            nwritten = 0
+            for block in iter_line_blocks(f, blocksize):
+                columns = parser.parse(block)
+                for var, output in outputs.items():
+                    output.write(columns[var].tobytes())
+                add_sums(sums, weight_sums(columns))
+                nwritten += len(columns[header[0]])
+        finally:
+            for output in outputs.values():
+                output.close()
+    if nwritten != nrows:
+        raise ValueError("%s changed while building the cache" % filename)
+    meta = {
+        "version": CACHE_VERSION,
+        "source": os.path.abspath(filename),
+        "sha1": file_hash(filename),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "header": header,
+        "dtypes": dict((var, dtype.str) for var, dtype in dtypes.items()),
+        "nrows": nrows,
+        "sums": sums,
+    }
+    write_cache_meta(tmpdir, meta)
+    if os.path.exists(cachedir):
+        shutil.rmtree(cachedir)
+    os.rename(tmpdir, cachedir)
+    return meta
+
+
+def check_cache(filename, cachedir=None):
+    """ return the metadata if the cache is up to date with the csv file, None otherwise
+    The sha1 is only recomputed if the size or modification time of the csv changed """
+    cachedir = cachedir or default_cachedir(filename)
+    meta = read_cache_meta(cachedir)
+    if meta is None or meta.get("version") != CACHE_VERSION:
+        return None
+    stat = os.stat(filename)
+    if stat.st_size == meta["size"] and stat.st_mtime == meta["mtime"]:
+        return meta
+    if stat.st_size != meta["size"] or file_hash(filename) != meta["sha1"]:
+        return None
+    # same content, only touched : remember the new time to avoid hashing next time
+    meta["mtime"] = stat.st_mtime
+    write_cache_meta(cachedir, meta)
+    return meta
+
+
+@instrumented("load", rows=lambda result, *args, **kwargs: result[1]["nrows"])
+def load_cached(filename, variables=None, cachedir=None, mmap=True, float_dtype=np.float64):
+    """ Same as load_csv, but go through the binary cache (built or rebuilt if needed).
+    Return the OrderedDict variable -> numpy array (read-only memory-map if mmap) and the cache metadata """
+    cachedir = cachedir or default_cachedir(filename)
+    meta = check_cache(filename, cachedir)
+    if meta is None or np.dtype(meta["dtypes"].get("Weight", np.dtype(float_dtype).str)) != float_dtype:
+        print("Building binary cache %s of %s" % (cachedir, filename))
+        meta = build_cache(filename, cachedir, float_dtype)
+    columns = OrderedDict()
+    for var in meta["header"]:
+        if variables is not None and var not in variables:
+            continue
+        columns[var] = np.load(os.path.join(cachedir, var + ".npy"), mmap_mode="r" if mmap else None)
+    return columns, meta
@@ -0,0 +1,210 @@
+"""
+ATLAS Higgs Machine Learning Challenge 2014
+
+Derived variables defined by expressions over the columns, computed on whole columns with numpy
+
+A derived variable is a (name, expression) pair, the expression is written as in python with
+the variable names of the file, numbers, + - * / ** and the functions of FUNCTIONS:
+    ("MyGreatNewVar", "PRI_lep_phi+1.213141")
+    ("DeltaPhiTauLep", "abs(deltaphi(PRI_tau_phi,PRI_lep_phi))")
+    ("MassTauLep", "invmass(PRI_tau_pt,PRI_tau_eta,PRI_tau_phi,PRI_lep_pt,PRI_lep_eta,PRI_lep_phi)")
+    ("LogMassJetJet", "log1p(DER_mass_jet_jet)")
+An expression can use the derived variables defined before it in the list.
+Missing values are handled: if any variable of the expression is -999 for an event (e.g. the
+jet variables without jet), or the result is not a number, the derived value is -999.
+
+The expression is parsed once (only the allowed operations, no python code is run) into a tree
+of numpy operations on whole columns. load_features computes the derived variables of a file
+once and stores them in the binary cache of the file (see higgsml_data.py), in a "derived"
+directory, next time they are memory-mapped as the base columns. A derived variable is
+recomputed if its expression (or the file) changed.
+
+Typical use:
+    from higgsml_features import derive,load_features
+    newcolumns=derive(columns,[("MyGreatNewVar","PRI_lep_phi+1.213141")])
+    newcolumns=load_features("atlas-higgs-challenge-2014-v2.csv",features)
+"""
+
+import ast
+import json
+import os
+import sys
+from collections import OrderedDict
+
+import numpy as np
+from higgsml_data import load_cached, default_cachedir
+from higgsml_instrument import instrumented, columns_length
+
+
+MISSING = -999.
+DERIVED_DIR = "derived"
+DERIVED_META = "features.json"
+
+
+def deltaphi(phi1, phi2):
+    """ phi1-phi2 in [-pi,pi) """
+    return np.mod(phi1 - phi2 + np.pi, 2 * np.pi) - np.pi
+
+
+def deltar(eta1, phi1, eta2, phi2):
+    return np.sqrt((eta1 - eta2) ** 2 + deltaphi(phi1, phi2) ** 2)
+
+
+def invmass(pt1, eta1, phi1, pt2, eta2, phi2):
+    """ invariant mass of two massless particles """
+    return np.sqrt(np.maximum(2 * pt1 * pt2 * (np.cosh(eta1 - eta2) - np.cos(phi1 - phi2)), 0.))
+
+
+def transmass(pt1, phi1, pt2, phi2):
+    """ transverse mass of two massless particles (e.g. lepton and missing transverse energy) """
+    return np.sqrt(np.maximum(2 * pt1 * pt2 * (1 - np.cos(phi1 - phi2)), 0.))
+
+
+# functions allowed in the expressions
+FUNCTIONS = {
+    "abs": np.abs, "sqrt": np.sqrt, "exp": np.exp, "log": np.log, "log1p": np.log1p,
+    "sin": np.sin, "cos": np.cos, "tan": np.tan, "arctan2": np.arctan2,
+    "sinh": np.sinh, "cosh": np.cosh, "tanh": np.tanh,
+    "minimum": np.minimum, "maximum": np.maximum,
+    "deltaphi": deltaphi, "deltar": deltar, "invmass": invmass, "transmass": transmass,
+}
+
+# node of a number in the syntax tree
+NUMBER_NODE = ast.Constant if sys.version_info >= (3, 8) else ast.Num
+
+OPERATORS = {
+    ast.Add: np.add, ast.Sub: np.subtract, ast.Mult: np.multiply, ast.Div: np.true_divide, ast.Pow: np.power,
+}
+
+
+class Expression(object):
+    """ an expression compiled into a tree of numpy operations
+    .names is the list of the variables it uses """
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.names = []
+        try:
+            tree = ast.parse(expression.strip(), mode="eval")
+        except SyntaxError as e:
+            raise ValueError("invalid expression %r: %s" % (expression, e))
+        self.evaluate = self.compile(tree.body)
+
+    def compile(self, node):
+        """ function columns -> (values, missing mask or None) for the node """
+        if isinstance(node, ast.BinOp) and type(node.op) in OPERATORS:
+            left, right, op = self.compile(node.left), self.compile(node.right), OPERATORS[type(node.op)]
+            return lambda columns: combine(op, [left(columns), right(columns)])
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+            operand = self.compile(node.operand)
+            sign = -1. if isinstance(node.op, ast.USub) else 1.
+            return lambda columns: combine(lambda x: sign * x, [operand(columns)])
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS \
+                and not node.keywords and not getattr(node, "starargs", None) and not getattr(node, "kwargs", None):
+            func = FUNCTIONS[node.func.id]
+            args = [self.compile(arg) for arg in node.args]
+            return lambda columns: combine(func, [arg(columns) for arg in args])
+        if isinstance(node, ast.Name):
+            name = node.id
+            if name not in self.names:
+                self.names += [name]
+            return lambda columns: column_value(columns, name)
+        if isinstance(node, NUMBER_NODE):
+            number = node.value if sys.version_info >= (3, 8) else node.n
+            if isinstance(number, (int, float)) and not isinstance(number, bool):
+                value = float(number)
+                return lambda columns: (value, None)
+        raise ValueError("not allowed in expression %r: %s" % (self.expression, ast.dump(node)))
+
+    def __call__(self, columns):
+        """ the values of the expression (float64, MISSING where undefined) """
+        missingnames = [name for name in self.names if name not in columns]
+        if missingnames:
+            raise KeyError("variables missing for expression %r: %s" % (self.expression, ",".join(missingnames)))
+        with np.errstate(all="ignore"):
+            values, missing = self.evaluate(columns)
+        nrows = len(columns[self.names[0]]) if self.names else 1
+        values = np.array(np.broadcast_to(values, (nrows,)), dtype=np.float64)
+        undefined = ~np.isfinite(values)
+        if missing is not None:
+            undefined |= missing
+        values[undefined] = MISSING
+        return values
+
+
+def column_value(columns, name):
+    col = np.asarray(columns[name])
+    if col.dtype.kind == "f":
+        return col, col == MISSING
+    return col, None
+
+
+def combine(func, operands):
+    """ apply func to the values of the operands, the result is missing where any operand is missing """
+    missing = None
+    for values, mask in operands:
+        if mask is not None:
+            missing = mask if missing is None else missing | mask
+    return func(*[values for values, mask in operands]), missing
+
+
+def compile_features(features):
+    """ list of (name, Expression) from a list of (name, expression string) """
+    return [(name, Expression(expression)) for name, expression in features]
+
+
+@instrumented("derive", rows=columns_length)
+def derive(columns, features):
+    """ compute the derived variables on the columns, return an OrderedDict name -> array
+    (features : list of (name, expression), in order, each can use the previous ones) """
+    available = dict(columns)
+    result = OrderedDict()
+    for name, expression in compile_features(features):
+        result[name] = available[name] = expression(available)
+    return result
+
+
+def signatures(features):
+    """ for each derived variable, a text identifying its definition (its expression and those of the derived
+    variables it uses), so that it is recomputed if any of them changes """
+    result = OrderedDict()
+    for name, expression in compile_features(features):
+        result[name] = expression.expression + "".join(
+            "|%s=%s" % (used, result[used]) for used in expression.names if used in result)
+    return result
+
+
+@instrumented("derive", rows=columns_length)
+def load_features(filename, features, cachedir=None):
+    """ the derived variables of the file, computed once and stored in the binary cache of the file
+    Return an OrderedDict name -> read-only memory-mapped array """
+    cachedir = cachedir or default_cachedir(filename)
+    base, meta = load_cached(filename, cachedir=cachedir)  # builds the cache if needed
+    derivedir = os.path.join(cachedir, DERIVED_DIR)
+    metafile = os.path.join(derivedir, DERIVED_META)
+    try:
+        with open(metafile) as f:
+            known = json.load(f)
+    except (IOError, OSError, ValueError):
+        known = {}
+    if known.get("sha1") != meta["sha1"]:
+        known = {"sha1": meta["sha1"], "features": {}}
+    wanted = signatures(features)
+    todo = [(name, expression) for name, expression in features
+            if known["features"].get(name) != wanted[name]
+            or not os.path.exists(os.path.join(derivedir, name + ".npy"))]
+    if todo:
+        if not os.path.exists(derivedir):
+            os.makedirs(derivedir)
+        available = dict(base)
+        for name, expression in compile_features(features):
+            if (name, expression.expression) in todo:
+                values = expression(available)
+                np.save(os.path.join(derivedir, name + ".npy"), values)
+                known["features"][name] = wanted[name]
+            available[name] = np.load(os.path.join(derivedir, name + ".npy"), mmap_mode="r")
+        tmpname = metafile + ".tmp%d" % os.getpid()
+        with open(tmpname, "w") as f:
+            json.dump(known, f, indent=1, sort_keys=True)
+        os.rename(tmpname, metafile)
+    return OrderedDict((name, np.load(os.path.join(derivedir, name + ".npy"), mmap_mode="r")) for name, expression in features)
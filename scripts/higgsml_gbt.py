@@ -0,0 +1,407 @@
+"""
+ATLAS Higgs Machine Learning Challenge 2014
+
+Histogram gradient boosted trees in numpy, an alternative to the TMVA training of step 2 of
+higgsml_opendata_tmva.py which does not need ROOT
+
+Each input variable is first cut into at most NBINS quantile bins (once, the training only sees
+the bin numbers, -999 naturally gets its own bin). The trees are grown one level at a time: for
+all the nodes of a level, the sums of the gradient and hessian of the logistic loss per
+(node, variable, bin) are computed with bincount, and the best cut of each node is found with
+cumulative sums over the bins. Only the smaller child of a split is histogrammed, the other one
+is the parent minus the child. The histograms are computed in a pool of processes, each doing
+a group of variables on the data in shared memory.
+The events are weighted by the given weight (KaggleWeight), by default renormalised so that the
+signal and the background have the same total (as TMVA does).
+
+The result is a higgsml_bdt.Forest with gradient boost output 2/(1+exp(-2*sum))-1, so it is
+evaluated and used (score "bdt" of steps 3, 4, 5) exactly as the TMVA BDT. save_forest and
+load_forest of higgsml_bdt.py store it.
+train_kfold trains one model per fold on the other folds, the folds in parallel (processes
+sharing the binned data), and gives the out-of-fold score of each event (for an unbiased choice
+of the threshold) and the average of the models (to score the other events).
+With validation events, train_binned stops adding trees when their AMS does not improve any
+more (used by the option search of higgsml_search.py).
+
+Typical use:
+    from higgsml_gbt import train_gbt
+    forest=train_gbt(columns,variables,issig,kaggleweight,ntrees=200,maxdepth=5)
+    bdt=forest.evaluate(columns)
+    forests,outoffold,ensemble=train_kfold(binned,issig,kaggleweight,edges,variables,nfolds=5)
+"""
+
+import ctypes
+import multiprocessing
+
+import numpy as np
+from higgsml_bdt import Forest, merge_forests
+from higgsml_ams import ams_curve, best_point
+from higgsml_instrument import instrumented, argument_length
+
+
+NBINS = 256
+NTREES = 200
+MAXDEPTH = 5
+LEARNINGRATE = 0.1
+# minimum sum of hessian in a node (about 4 events for a node of mixed signal and background of weight 1)
+MINNODEWEIGHT = 1.
+L2 = 1.
+
+# data shared by the worker processes
+_shared = None
+# data shared by the k-fold worker processes
+_folddata = None
+
+
+def quantile_edges(values, nbins=NBINS):
+    """ bin edges (float32, at most nbins-1) at the quantiles of the values """
+    values = np.asarray(values, dtype=np.float32)
+    if len(values) == 0:
+        return np.empty(0, dtype=np.float32)
+    quantiles = np.percentile(values, np.linspace(0., 100., nbins + 1)[1:-1])
+    return np.unique(quantiles.astype(np.float32))
+
+
+def apply_bins(columns, variables, edges):
+    """ 2D array (variables, events) of bin numbers (uint8): bin k is edges[k-1] <= value < edges[k] """
+    nevents = len(columns[variables[0]])
+    binned = np.empty((len(variables), nevents), dtype=np.uint8)
+    for ivar, var in enumerate(variables):
+        binned[ivar] = np.searchsorted(edges[ivar], np.asarray(columns[var], dtype=np.float32), side="right")
+    return binned
+
+
+def bin_values(edges):
+    """ for each variable, a value (float32) in each bin, the lower edge (just below the first edge for bin 0)
+    A forest trained on the bins gives exactly the same result on these values as on the original ones """
+    values = []
+    for e in edges:
+        low = np.nextafter(e[:1], np.float32(-np.inf)) if len(e) else np.zeros(1, dtype=np.float32)
+        values += [np.concatenate([low, e]).astype(np.float32)]
+    return values
+
+
+def binned_matrix(binned, edges, rows=None):
+    """ 2D array (events, variables) of bin values (see bin_values) of the rows of the binned data, to evaluate a Forest """
+    values = bin_values(edges)
+    rows = np.arange(binned.shape[1]) if rows is None else rows
+    x = np.empty((len(rows), len(values)), dtype=np.float32)
+    for ivar in range(len(values)):
+        x[:, ivar] = values[ivar][binned[ivar, rows]]
+    return x
+
+
+def bin_columns(columns, variables, nbins=NBINS):
+    """ quantile edges of each variable and the binned 2D array (see apply_bins) """
+    if nbins > 256:
+        raise ValueError("at most 256 bins (stored as uint8)")
+    edges = [quantile_edges(columns[var], nbins) for var in variables]
+    return edges, apply_bins(columns, variables, edges)
+
+
+def shared_array(values, typecode):
+    """ copy of values in shared memory (to be inherited by the worker processes) """
+    raw = multiprocessing.RawArray(typecode, int(np.prod(values.shape)))
+    np.ctypeslib.as_array(raw)[:] = values.ravel()
+    return raw
+
+
+def _init_worker(shared, nvars):
+    global _shared
+    _shared = {"binned": shared["binned"] if isinstance(shared["binned"], np.ndarray) else
+               np.ctypeslib.as_array(shared["binned"]).reshape(nvars, -1)}
+    for key in ["grad", "hess", "node"]:
+        _shared[key] = np.ctypeslib.as_array(shared[key])
+    _shared["rows"] = np.ctypeslib.as_array(shared["rows"]) if shared.get("rows") is not None else None
+
+
+def _histograms(task):
+    """ sums of gradient and hessian per (node, variable, bin) for some variables
+    lookup[node] is the index of the node in the result, -1 for nodes not to histogram
+    Return an array (2, nodes, variables, bins) """
+    variables, lookup, nbuild, nbins = task
+    d = _shared
+    local = lookup[d["node"]]
+    rows = np.flatnonzero(local >= 0)
+    base = local[rows].astype(np.intp) * nbins
+    grad = d["grad"][rows]
+    hess = d["hess"][rows]
+    # columns of the binned data of these events
+    columns = rows if d["rows"] is None else d["rows"][rows]
+    result = np.empty((2, nbuild, len(variables), nbins))
+    for i, ivar in enumerate(variables):
+        index = base + d["binned"][ivar, columns]
+        result[0, :, i, :] = np.bincount(index, weights=grad, minlength=nbuild * nbins).reshape(nbuild, nbins)
+        result[1, :, i, :] = np.bincount(index, weights=hess, minlength=nbuild * nbins).reshape(nbuild, nbins)
+    return result
+
+
+class _Trainer(object):
+    """ state of a training: binned data in shared memory, pool of workers, current score of the events
+    rows : the columns of binned of the training events (None for all), the binned data is never sliced """
+
+    def __init__(self, binned, edges, label, weight, nworkers, nbins, l2, minnodeweight, rows=None):
+        self.nvars = binned.shape[0]
+        self.nevents = binned.shape[1] if rows is None else len(rows)
+        self.edges = edges
+        self.label = label
+        self.weight = weight
+        self.nbins = nbins
+        self.l2 = l2
+        self.minnodeweight = minnodeweight
+        # a split after bin b is only possible if edge b exists
+        self.validbin = np.array([np.arange(nbins - 1) < len(e) for e in edges])
+        nworkers = nworkers or multiprocessing.cpu_count()
+        # the binned data is only copied in shared memory for a pool of workers, in this process it is used as is
+        shared = {"binned": shared_array(binned, ctypes.c_uint8) if nworkers > 1 else binned,
+                  "grad": shared_array(np.zeros(self.nevents), "d"), "hess": shared_array(np.zeros(self.nevents), "d"),
+                  "node": shared_array(np.zeros(self.nevents, dtype=np.int32), "i"),
+                  "rows": shared_array(np.asarray(rows, dtype=np.int32), "i") if rows is not None else None}
+        self.groups = [list(group) for group in np.array_split(np.arange(self.nvars), min(nworkers, self.nvars))
+                       if len(group)]
+        _init_worker(shared, self.nvars)
+        self.arrays = _shared
+        self.pool = multiprocessing.Pool(nworkers, _init_worker, (shared, self.nvars)) if nworkers > 1 else None
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+    def histograms(self, nodes, nnodes):
+        """ histograms (2, variables, bins) of the given nodes (node ids of the tree, nnodes nodes so far) """
+        lookup = np.empty(nnodes, dtype=np.int32)
+        lookup.fill(-1)
+        lookup[nodes] = np.arange(len(nodes))
+        tasks = [(group, lookup, len(nodes), self.nbins) for group in self.groups]
+        if self.pool is not None:
+            results = self.pool.map(_histograms, tasks)
+        else:
+            results = [_histograms(task) for task in tasks]
+        result = np.concatenate(results, axis=2)
+        return [result[:, inode] for inode in range(len(nodes))]
+
+    def best_splits(self, hists):
+        """ best (gain, variable, bin) of each node from its histograms """
+        hist = np.array(hists)  # (nodes, 2, variables, bins)
+        gradleft = np.cumsum(hist[:, 0], axis=2)[:, :, :-1]
+        hessleft = np.cumsum(hist[:, 1], axis=2)[:, :, :-1]
+        gradtotal = hist[:, 0, 0].sum(axis=1)[:, np.newaxis, np.newaxis]
+        hesstotal = hist[:, 1, 0].sum(axis=1)[:, np.newaxis, np.newaxis]
+        gradright = gradtotal - gradleft
+        hessright = hesstotal - hessleft
+        with np.errstate(divide="ignore", invalid="ignore"):
+            gain = (gradleft ** 2 / (hessleft + self.l2) + gradright ** 2 / (hessright + self.l2)
+                    - gradtotal ** 2 / (hesstotal + self.l2))
+        valid = (hessleft >= self.minnodeweight) & (hessright >= self.minnodeweight) & self.validbin[np.newaxis]
+        gain = np.where(valid, gain, -np.inf).reshape(len(hists), -1)
+        best = np.argmax(gain, axis=1)
+        return [(gain[inode, ibest],) + divmod(int(ibest), self.nbins - 1) for inode, ibest in enumerate(best)]
+
+    def leaf_value(self, hist):
+        return -hist[0, 0].sum() / (hist[1, 0].sum() + self.l2)
+
+    def grow_tree(self, score, maxdepth, learningrate):
+        """ grow one tree on the gradients of the current score, update the score
+        Return the tree as lists (feature, cut, bin, left, right, value) with value in units of the score,
+        the right child is always left+1 """
+        prob = 1. / (1. + np.exp(-score))
+        self.arrays["grad"][:] = self.weight * (prob - self.label)
+        self.arrays["hess"][:] = np.maximum(self.weight * prob * (1. - prob), 1e-16)
+        node = self.arrays["node"]
+        node[:] = 0
+        tree = {"feature": [-1], "cut": [0.], "bin": [0], "left": [-1], "right": [-1], "value": [0.]}
+        hists = {0: self.histograms([0], 1)[0]}
+        frontier = [0]
+        for depth in range(maxdepth):
+            if not frontier:
+                break
+            splits = self.best_splits([hists[inode] for inode in frontier])
+            nnodes = len(tree["feature"])
+            splitvar = np.empty(nnodes, dtype=np.intp)
+            splitvar.fill(-1)
+            splitbin = np.zeros(nnodes, dtype=np.intp)
+            newfrontier = []
+            for inode, (gain, ivar, ibin) in zip(frontier, splits):
+                if not gain > 0:
+                    tree["value"][inode] = learningrate * self.leaf_value(hists[inode])
+                    continue
+                left, right = len(tree["feature"]), len(tree["feature"]) + 1
+                for key in tree:
+                    tree[key] += [-1 if key in ["feature", "left", "right"] else 0] * 2
+                tree["feature"][inode] = ivar
+                # events with bin<=ibin (value<edge) go left, the forest sends value>=cut right
+                tree["cut"][inode] = float(np.float32(self.edges[ivar][ibin]))
+                tree["bin"][inode] = ibin
+                tree["left"][inode], tree["right"][inode] = left, right
+                splitvar[inode], splitbin[inode] = ivar, ibin
+                newfrontier += [(inode, left, right)]
+            if not newfrontier:
+                frontier = []
+                break
+            # move the events of the split nodes to the children
+            nnodes = len(tree["feature"])
+            rows = np.flatnonzero(splitvar[node] >= 0)
+            parent = node[rows]
+            columns = rows if self.arrays["rows"] is None else self.arrays["rows"][rows]
+            goleft = self.arrays["binned"][splitvar[parent], columns] <= splitbin[parent]
+            children = np.array(tree["left"])[parent]
+            node[rows] = np.where(goleft, children, children + 1)
+            # histogram the smaller child, the other one is the parent minus it
+            counts = np.bincount(node, minlength=nnodes)
+            build = [left if counts[left] <= counts[right] else right for inode, left, right in newfrontier]
+            for inode, hist in zip(build, self.histograms(build, nnodes)):
+                hists[inode] = hist
+            for inode, left, right in newfrontier:
+                other = right if left in build else left
+                hists[other] = hists[inode] - hists[left if other == right else right]
+                del hists[inode]
+            frontier = [child for inode, left, right in newfrontier for child in (left, right)]
+        for inode in frontier:
+            tree["value"][inode] = learningrate * self.leaf_value(hists[inode])
+        score += np.array(tree["value"])[node]
+        return tree
+
+
+def tree_values(tree, binned, columns=None):
+    """ value of a tree (as returned by grow_tree) for each event of the binned data (the columns of binned) """
+    feature, splitbin = np.array(tree["feature"]), np.array(tree["bin"], dtype=np.intp)
+    left, value = np.array(tree["left"]), np.array(tree["value"])
+    columns = np.arange(binned.shape[1]) if columns is None else np.asarray(columns)
+    node = np.zeros(len(columns), dtype=np.intp)
+    rows = np.arange(len(columns))
+    while len(rows):
+        rows = rows[feature[node[rows]] >= 0]
+        parent = node[rows]
+        goleft = binned[feature[parent], columns[rows]] <= splitbin[parent]
+        node[rows] = np.where(goleft, left[parent], left[parent] + 1)
+    return value[node]
+
+
+@instrumented("train", rows=argument_length(1))
+def train_binned(binned, label, weight, edges, variables, ntrees=NTREES, maxdepth=MAXDEPTH, learningrate=LEARNINGRATE,
+                 minnodeweight=MINNODEWEIGHT, l2=L2, balance=True, nworkers=None, verbose=False,
+                 validation=None, checkevery=10, patience=5, monitor=None, rows=None):
+    """ train on already binned data (see bin_columns), label : 1 for signal 0 for background
+    rows : the columns of binned of the training events (label and weight are those of these events), default all,
+    so that a subset is trained on without copying the binned data
+    validation : (binned, label, weight) of validation events, or (binned, label, weight, rows) for some columns
+    of binned, their best AMS is computed every checkevery trees,
+    the training stops when it did not improve for patience checks, or when monitor(ntrees, ams) returns True,
+    and the forest is cut at the best number of trees
+    Return the Forest """
+    label = np.asarray(label, dtype=np.float64)
+    weight = np.asarray(weight, dtype=np.float64)
+    if balance:
+        # same total for signal and background, average weight 1
+        sumsig = weight[label == 1].sum()
+        sumbkg = weight[label == 0].sum()
+        weight = np.where(label == 1, weight * 0.5 * len(weight) / sumsig, weight * 0.5 * len(weight) / sumbkg)
+        initial = 0.
+    else:
+        weight = weight * len(weight) / weight.sum()
+        initial = np.log(weight[label == 1].sum() / weight[label == 0].sum())
+    nbins = max([len(e) for e in edges] + [0]) + 1
+    trainer = _Trainer(binned, edges, label, weight, nworkers, nbins, l2, minnodeweight, rows)
+    nodes = {"feature": [], "cut": [], "left": [], "right": [], "value": []}
+    roots = []
+    score = np.zeros(len(label)) + initial
+    if validation is not None:
+        validbinned, validsig, validweight = validation[0], np.asarray(validation[1]) == 1, validation[2]
+        validrows = validation[3] if len(validation) > 3 else None
+        validscore = np.zeros(len(validsig))
+        history = []
+    try:
+        for itree in range(ntrees):
+            tree = trainer.grow_tree(score, maxdepth, learningrate)
+            if itree == 0:
+                # the initial score is put in the leaves of the first tree
+                tree["value"] = [value + initial if feature < 0 else 0. for feature, value in zip(tree["feature"], tree["value"])]
+            offset = len(nodes["feature"])
+            roots += [offset]
+            for key in nodes:
+                if key in ["left", "right"]:
+                    nodes[key] += [child + offset if child >= 0 else -1 for child in tree[key]]
+                else:
+                    nodes[key] += tree[key]
+            if verbose and (itree + 1) % 10 == 0:
+                print("tree %d, %d nodes" % (itree + 1, len(tree["feature"])))
+            if validation is not None:
+                validscore += tree_values(tree, validbinned, validrows)
+                if (itree + 1) % checkevery == 0 or itree + 1 == ntrees:
+                    history += [(itree + 1, best_point(ams_curve(validscore, validsig, validweight))["ams"])]
+                    if monitor is not None and monitor(*history[-1]):
+                        break
+                    if len(history) - 1 - max(range(len(history)), key=lambda i: history[i][1]) >= patience:
+                        break
+    finally:
+        trainer.close()
+    if validation is not None and history:
+        keep = max(history, key=lambda point: point[1])[0]
+        if keep < len(roots):
+            nodes = dict((key, values[:roots[keep]]) for key, values in nodes.items())
+            roots = roots[:keep]
+    # the forest output is 2/(1+exp(-2*sum))-1 = tanh(sum), the logistic score is 2*sum
+    return Forest(variables, nodes["feature"], nodes["cut"], np.ones(len(nodes["feature"]), dtype=bool),
+                  nodes["left"], nodes["right"], 0.5 * np.array(nodes["value"]), roots, np.ones(len(roots)), "Grad")
+
+
+def train_gbt(columns, variables, issig, weight, nbins=NBINS, **options):
+    """ bin the columns and train, options as train_binned, return the Forest """
+    edges, binned = bin_columns(columns, variables, nbins)
+    return train_binned(binned, np.asarray(issig, dtype=bool), weight, edges, variables, **options)
+
+
+def fold_numbers(nevents, nfolds, seed=0):
+    """ random fold number (0 to nfolds-1) of each event, folds of equal size """
+    return np.random.RandomState(seed).permutation(nevents) % nfolds
+
+
+def _init_fold_worker(shared, nvars, edges, variables):
+    global _folddata
+    _folddata = {"binned": np.ctypeslib.as_array(shared["binned"]).reshape(nvars, -1),
+                 "edges": edges, "variables": variables}
+    for key in ["label", "weight", "fold"]:
+        _folddata[key] = np.ctypeslib.as_array(shared[key])
+
+
+def _train_fold(task):
+    """ train on all the folds but one, return the forest and its score of the held-out fold """
+    ifold, options = task
+    d = _folddata
+    train = np.flatnonzero(d["fold"] != ifold)
+    # the shared binned data is not copied, the trainer only sees the rows of the other folds
+    forest = train_binned(d["binned"], d["label"][train], d["weight"][train], d["edges"], d["variables"],
+                          nworkers=1, rows=train, **options)
+    heldout = np.flatnonzero(d["fold"] == ifold)
+    return forest, forest.evaluate(binned_matrix(d["binned"], d["edges"], heldout))
+
+
+def train_kfold(binned, label, weight, edges, variables, nfolds=5, seed=0, nworkers=None, **options):
+    """ k-fold training on binned data: one model per fold trained on the other folds, the folds in parallel in
+    a pool of processes sharing the binned data, options as train_binned
+    Return the list of forests, the out-of-fold score of each event (from the model which did not see it)
+    and the ensemble (merge_forests of the models) to score other events """
+    label = np.asarray(label, dtype=np.float64)
+    fold = fold_numbers(len(label), nfolds, seed)
+    shared = {"binned": shared_array(binned, ctypes.c_uint8), "label": shared_array(label, "d"),
+              "weight": shared_array(np.asarray(weight, dtype=np.float64), "d"),
+              "fold": shared_array(fold.astype(np.int32), "i")}
+    initargs = (shared, binned.shape[0], edges, variables)
+    tasks = [(ifold, options) for ifold in range(nfolds)]
+    nworkers = min(nworkers or multiprocessing.cpu_count(), nfolds)
+    if nworkers > 1:
+        pool = multiprocessing.Pool(nworkers, _init_fold_worker, initargs)
+        try:
+            results = pool.map(_train_fold, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_fold_worker(*initargs)
+        results = [_train_fold(task) for task in tasks]
+    outoffold = np.empty(len(label))
+    for ifold, (forest, score) in enumerate(results):
+        outoffold[fold == ifold] = score
+    forests = [forest for forest, score in results]
+    return forests, outoffold, merge_forests(forests)
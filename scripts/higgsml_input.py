@@ -0,0 +1,379 @@
+"""
+ATLAS Higgs Machine Learning Challenge 2014
+
+Transparent reading of compressed csv files (.gz, .bz2, .xz)
+
+open_input opens a file for binary reading like open(filename,"rb"), and if the file is
+compressed (recognised from its first bytes, whatever its name) returns a file-like object
+giving the decompressed content. The decompression runs in a background thread, a few blocks
+ahead of the reader, so that decompressing the next block and parsing the current one overlap
+(zlib, bz2 and lzma release the GIL).
+Block-compressed files are in addition decompressed in parallel by a pool of threads:
+  gzip in BGZF blocks (bgzip), whose size is written in each block header
+  bzip2 made of several streams (pbzip2), each stream starts with "BZh" and a block magic number
+other files (plain gzip, single stream bzip2, xz) are decompressed sequentially. Concatenated
+streams (e.g. cat a.gz b.gz) are read to the end. A bzip2 file is only recognised as made of several
+streams if a second one starts in its first TASKSIZE bytes (pbzip2 streams are smaller), otherwise it
+is read sequentially, which is slower but gives the same content.
+xz is decompressed by the lzma module (python 3, or backports.lzma on python 2), without it by
+the xz command (xz -dc) in a subprocess.
+All the loaders of higgsml_data.py (so load_csv, load_cached, the scripts and the kaggle scorer)
+and higgsml_stream.iter_csv_blocks read through open_input.
+
+Typical use:
+    from higgsml_input import open_input
+    with open_input("atlas-higgs-challenge-2014-v2.csv.gz") as f:
+        header=f.readline()
+or to check that a compressed file gives line by line the same content as the plain one:
+    python higgsml_input.py atlas-higgs-challenge-2014-v2.csv.gz atlas-higgs-challenge-2014-v2.csv
+"""
+
+import bz2
+import multiprocessing
+import re
+import struct
+import subprocess
+import sys
+import threading
+import time
+import zlib
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+try:
+    from itertools import izip_longest as zip_longest
+except ImportError:
+    from itertools import zip_longest
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+
+# bytes of compressed data read at a time
+CHUNKSIZE = 1 << 20
+# compressed bytes per task of the parallel decompression
+TASKSIZE = 4 << 20
+# decompressed blocks kept ahead of the reader
+PREFETCH = 8
+
+GZIP_MAGIC = b"\x1f\x8b"
+BZIP2_MAGIC = b"BZh"
+XZ_MAGIC = b"\xfd7zXZ\x00"
+# start of a bzip2 stream: header and magic number of its first block
+BZIP2_STREAM = re.compile(b"BZh[1-9]1AY&SY")
+STREAMSTART = 10  # length of a match of BZIP2_STREAM
+
+
+def compression(filename):
+    """ "gz", "bz2", "xz" or None from the first bytes of the file """
+    with open(filename, "rb") as f:
+        magic = f.read(len(XZ_MAGIC))
+    if magic.startswith(GZIP_MAGIC):
+        return "gz"
+    if magic.startswith(BZIP2_MAGIC):
+        return "bz2"
+    if magic == XZ_MAGIC:
+        return "xz"
+    return None
+
+
+def _decompressor(kind):
+    if kind == "gz":
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if kind == "bz2":
+        return bz2.BZ2Decompressor()
+    if lzma is None:
+        raise IOError("xz files need the lzma module (python 3 or backports.lzma)")
+    return lzma.LZMADecompressor()
+
+
+def _decompress_all(kind, data):
+    """ decompress data made of one or several complete streams """
+    output = []
+    while data:
+        decompressor = _decompressor(kind)
+        output += [decompressor.decompress(data)]
+        data = decompressor.unused_data
+    return b"".join(output)
+
+
+def _sequential_chunks(f, kind):
+    """ yield the decompressed content of file object f, one compressed chunk at a time """
+    decompressor = _decompressor(kind)
+    while True:
+        data = f.read(CHUNKSIZE)
+        if not data:
+            break
+        while data:
+            if getattr(decompressor, "eof", False):
+                decompressor = _decompressor(kind)  # next of concatenated streams
+            try:
+                chunk = decompressor.decompress(data)
+            except EOFError:
+                # bz2 of python 2 has no eof: the previous stream ended exactly at the end of the previous chunk
+                decompressor = _decompressor(kind)
+                chunk = decompressor.decompress(data)
+            if chunk:
+                yield chunk
+            data = decompressor.unused_data
+            if data:
+                decompressor = _decompressor(kind)
+
+
+def _command_chunks(command):
+    """ yield the output of a command (e.g. xz -dc file), raise IOError if it fails """
+    try:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    except OSError:
+        raise IOError("%s failed, xz files need the lzma module (python 3 or backports.lzma) or the xz command"
+                      % " ".join(command))
+    try:
+        for chunk in iter(lambda: process.stdout.read(CHUNKSIZE), b""):
+            yield chunk
+        if process.wait() != 0:
+            raise IOError("%s failed" % " ".join(command))
+    finally:
+        if process.poll() is None:
+            process.kill()  # the reader was closed before the end
+        process.stdout.close()
+        process.wait()
+
+
+def _bgzf_tasks(f):
+    """ yield groups of complete BGZF blocks (about TASKSIZE bytes), the size of each block is in its header """
+    group = []
+    size = 0
+    while True:
+        header = f.read(12)
+        if not header:
+            break
+        if len(header) < 12 or not header.startswith(GZIP_MAGIC) or not ord(header[3:4]) & 4:
+            raise IOError("not a BGZF block")
+        xlen = struct.unpack("<H", header[10:12])[0]
+        extra = f.read(xlen)
+        bsize = None
+        position = 0
+        while position + 4 <= len(extra):
+            subfield, length = extra[position:position + 2], struct.unpack("<H", extra[position + 2:position + 4])[0]
+            if subfield == b"BC" and length == 2:
+                bsize = struct.unpack("<H", extra[position + 4:position + 6])[0]
+            position += 4 + length
+        if bsize is None:
+            raise IOError("not a BGZF block")
+        rest = f.read(bsize + 1 - 12 - xlen)
+        group += [header, extra, rest]
+        size += bsize + 1
+        if size >= TASKSIZE:
+            yield b"".join(group)
+            group, size = [], 0
+    if group:
+        yield b"".join(group)
+
+
+def _bzip2_tasks(f):
+    """ yield groups of complete bzip2 streams (cut at the stream starts, about TASKSIZE bytes) """
+    pending = []
+    size = 0
+    overlap = b""
+    while True:
+        data = f.read(TASKSIZE)
+        if not data:
+            break
+        # only the new data (and the end of the previous read) has to be searched
+        searched = overlap + data
+        offset = size - len(overlap)
+        starts = [offset + match.start() for match in BZIP2_STREAM.finditer(searched) if offset + match.start() > 0]
+        pending += [data]
+        size += len(data)
+        overlap = data[-(STREAMSTART - 1):]
+        if starts:
+            joined = b"".join(pending)
+            yield joined[:starts[-1]]
+            pending = [joined[starts[-1]:]]
+            size = len(pending[0])
+            overlap = pending[0][-(STREAMSTART - 1):]
+    if size:
+        yield b"".join(pending)
+
+
+def is_bgzf(filename):
+    """ True if the file is gzip in BGZF blocks """
+    with open(filename, "rb") as f:
+        header = f.read(18)
+    return len(header) == 18 and header.startswith(GZIP_MAGIC) and bool(ord(header[3:4]) & 4) \
+        and header[12:14] == b"BC"
+
+
+def is_multistream_bzip2(filename):
+    """ True if the file is bzip2 made of several streams (only a second stream starting in the first TASKSIZE
+    bytes is seen, a file with a larger first stream is taken as a single stream) """
+    with open(filename, "rb") as f:
+        data = f.read(TASKSIZE)
+    return data.startswith(BZIP2_MAGIC) and BZIP2_STREAM.search(data, 1) is not None
+
+
+def _parallel_chunks(f, kind, nworkers):
+    """ decompress the tasks in a pool of threads, yield the results in order, at most 2*nworkers tasks ahead """
+    tasks = _bgzf_tasks(f) if kind == "gz" else _bzip2_tasks(f)
+    pool = ThreadPool(nworkers)
+    pending = deque()
+    try:
+        for task in tasks:
+            pending.append(pool.apply_async(_decompress_all, (kind, task)))
+            if len(pending) >= 2 * nworkers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+class PipelinedReader(object):
+    """ read-only binary file-like object (read, readline, iteration on lines) on the chunks of data yielded by
+    a generator, which runs in a background thread at most PREFETCH chunks ahead """
+
+    def __init__(self, chunks, fileobj=None, prefetch=PREFETCH):
+        self.chunks = chunks
+        self.fileobj = fileobj
+        self.queue = Queue(prefetch)
+        # data not read yet : self.data[self.offset:]
+        self.data = b""
+        self.offset = 0
+        self.finished = False
+        self.closed = False
+        self.error = None
+        self.thread = threading.Thread(target=self._produce)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _produce(self):
+        try:
+            for chunk in self.chunks:
+                if self.closed:
+                    break
+                self.queue.put(chunk)
+        except Exception:
+            self.error = sys.exc_info()[1]
+        finally:
+            self.chunks.close()
+            self.queue.put(None)
+
+    def _next_chunk(self):
+        """ the next chunk of data, None at the end """
+        if self.finished:
+            return None
+        chunk = self.queue.get()
+        if chunk is None:
+            self.finished = True
+            if self.error is not None:
+                raise IOError("decompression failed: %s" % self.error)
+        return chunk
+
+    def read(self, size=-1):
+        parts = [self.data[self.offset:]]
+        available = len(parts[0])
+        while size is None or size < 0 or available < size:
+            chunk = self._next_chunk()
+            if chunk is None:
+                break
+            parts += [chunk]
+            available += len(chunk)
+        self.data = b"".join(parts)
+        self.offset = available if size is None or size < 0 else min(size, available)
+        return self.data[:self.offset]
+
+    def readline(self):
+        # a line is cut from the current chunk, the chunks are only joined around the line crossing them
+        searched = self.offset
+        while True:
+            end = self.data.find(b"\n", searched)
+            if end >= 0:
+                line = self.data[self.offset:end + 1]
+                self.offset = end + 1
+                return line
+            chunk = self._next_chunk()
+            if chunk is None:
+                line = self.data[self.offset:]
+                self.data, self.offset = b"", 0
+                return line
+            self.data = self.data[self.offset:] + chunk
+            searched = len(self.data) - len(chunk)
+            self.offset = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    next = __next__
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        # unblock the producer, then wait for it
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except Empty:
+                pass
+        if self.fileobj is not None:
+            self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+def open_input(filename, nworkers=None):
+    """ open a file for binary reading, decompressed on the fly if it is gzip, bzip2 or xz
+    nworkers : number of threads decompressing block-compressed files (default number of cores) """
+    kind = compression(filename)
+    f = open(filename, "rb")
+    if kind is None:
+        return f
+    if kind == "xz" and lzma is None:
+        f.close()
+        return PipelinedReader(_command_chunks(["xz", "-dc", filename]))
+    nworkers = nworkers or multiprocessing.cpu_count()
+    if nworkers > 1 and ((kind == "bz2" and is_multistream_bzip2(filename)) or (kind == "gz" and is_bgzf(filename))):
+        chunks = _parallel_chunks(f, kind, nworkers)
+    else:
+        chunks = _sequential_chunks(f, kind)
+    return PipelinedReader(chunks, f)
+
+
+def compare_lines(filename, reference):
+    """ iterate on the lines of filename (through open_input) and of the plain file reference
+    Return the number of lines, raise ValueError at the first line that differs """
+    nlines = 0
+    with open_input(filename) as f, open(reference, "rb") as ref:
+        for line, refline in zip_longest(f, ref):
+            if line != refline:
+                raise ValueError("line %d of %s differs from %s" % (nlines + 1, filename, reference))
+            nlines += 1
+    return nlines
+
+
+if __name__ == "__main__":
+    start = time.time()
+    print("%s : %d lines identical to %s (%.2f s)" % (sys.argv[1], compare_lines(sys.argv[1], sys.argv[2]),
+                                                    sys.argv[2], time.time() - start))
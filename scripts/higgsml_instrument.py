@@ -0,0 +1,214 @@
+"""
+ATLAS Higgs Machine Learning Challenge 2014
+
+Instrumentation of the stages of the scripts: wall and cpu time, rows, throughput, memory
+
+The main stages are instrumented in the modules themselves, so nothing has to be changed in
+the scripts:
+  load      higgsml_data.load_csv, load_cached
+  convert   higgsml_data.build_cache, higgsml_root.csv_to_root
+  derive    higgsml_features.derive, load_features
+  train     higgsml_gbt.train_binned
+  evaluate  higgsml_bdt.Forest.evaluate
+  threshold higgsml_ams.optimise_threshold
+  submit    higgsml_submission.write_submission, write_submission_stream
+  score     scoring of a submission in higgsml_opendata_kaggle.py
+and every step run by higgsml_pipeline.Pipeline (e.g. the training of higgsml_opendata_tmva.py).
+Nothing is measured unless it is switched on, with environment variables or configure():
+  HIGGSML_INSTRUMENT=stages.jsonl  append one json line per stage to this file ("-" for stderr)
+  HIGGSML_PROFILE=profiles         also run each (outermost) stage under cProfile and dump the
+                                   statistics in this directory (<stage>_<pid>_<n>.prof)
+A line has the stage name, the start time, wall and cpu time (s), the number of rows, rows per
+second, the resident memory at the end of the stage and the peak resident memory during the stage
+(MB), and whether the stage raised an exception. The peak is reset when a stage starts (linux
+clear_refs), the peaks of the enclosing stages are kept aside, so that each stage gets its own
+peak. Where the peak can not be reset, peakscope is "process" and the peak is the one of the
+process since it started.
+
+Typical use:
+    HIGGSML_INSTRUMENT=stages.jsonl python higgsml_opendata_simplest.py
+or in the code:
+    with stage("mystage") as s:
+        ...
+        s.rows=len(columns["EventId"])
+    @instrumented("mystage",rows=result_length)
+    def myfunction(...):
+"""
+
+import cProfile
+import functools
+import itertools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+
+_config = {"logfile": os.environ.get("HIGGSML_INSTRUMENT"), "profiledir": os.environ.get("HIGGSML_PROFILE")}
+_lock = threading.Lock()
+_local = threading.local()
+_counter = itertools.count()
+# peak memory seen so far by each running stage (the peak of the process is reset when a stage starts)
+_running = []
+
+
+def configure(logfile=None, profiledir=None):
+    """ switch the instrumentation on (json lines to logfile, "-" for stderr; cProfile dumps in profiledir)
+    or off (both None) """
+    _config["logfile"] = logfile
+    _config["profiledir"] = profiledir
+
+
+def enabled():
+    return bool(_config["logfile"] or _config["profiledir"])
+
+
+def _status_mb(key):
+    """ value of a memory line of /proc/self/status in MB, None if not available """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(key + ":"):
+                    return int(line.split()[1]) / 1024.
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def reset_peak_memory():
+    """ start a new measurement of the peak resident memory, False if the system does not allow it """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")  # reset the peak resident memory (linux)
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def peak_memory(reset=False):
+    """ peak resident memory of this process in MB (reset : start a new measurement if the system allows it) """
+    if reset:
+        reset_peak_memory()
+    peak = _status_mb("VmHWM")
+    if peak is None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    return peak
+
+
+def current_memory():
+    """ resident memory of this process in MB (None if not available) """
+    return _status_mb("VmRSS")
+
+
+def cpu_time():
+    """ user+system time of the process (all threads) """
+    times = os.times()
+    return times[0] + times[1]
+
+
+def emit(record):
+    """ write a record as a json line """
+    line = json.dumps(record, sort_keys=True) + "\n"
+    with _lock:
+        if _config["logfile"] == "-":
+            sys.stderr.write(line)
+            sys.stderr.flush()
+        elif _config["logfile"]:
+            with open(_config["logfile"], "a") as f:
+                f.write(line)
+
+
+class stage(object):
+    """ context manager measuring a stage, set .rows inside the block if the number of rows is known
+    Extra keyword arguments are added to the record """
+
+    def __init__(self, name, rows=None, **info):
+        self.name = name
+        self.rows = rows
+        self.info = info
+        self.profile = None
+
+    def __enter__(self):
+        self.active = enabled()
+        if not self.active:
+            return self
+        depth = getattr(_local, "depth", 0)
+        _local.depth = depth + 1
+        if _config["profiledir"] and depth == 0:
+            # cProfile can not be nested, only the outermost stage is profiled
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        with _lock:
+            # keep the peak so far for the enclosing stages, then measure this one from here
+            peak = peak_memory()
+            for running in _running:
+                running.peak = max(running.peak, peak)
+            self.resetpeak = reset_peak_memory()
+            self.peak = peak_memory() if self.resetpeak else peak
+            _running.append(self)
+        self.start = time.time()
+        self.startcpu = cpu_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.active:
+            return False
+        wall = time.time() - self.start
+        cpu = cpu_time() - self.startcpu
+        _local.depth -= 1
+        with _lock:
+            peak = peak_memory()
+            for running in _running:
+                running.peak = max(running.peak, peak)
+            _running.remove(self)
+        record = {"stage": self.name, "time": self.start, "wall": wall, "cpu": cpu, "rows": self.rows,
+                  "rowspersecond": self.rows / wall if self.rows is not None and wall > 0 else None,
+                  "rssmb": current_memory(), "peakrssmb": self.peak, "peakscope": "stage" if self.resetpeak else "process",
+                  "pid": os.getpid(), "ok": exc_type is None}
+        record.update(self.info)
+        if self.profile is not None:
+            self.profile.disable()
+            if not os.path.exists(_config["profiledir"]):
+                os.makedirs(_config["profiledir"])
+            record["profile"] = os.path.join(_config["profiledir"],
+                                             "%s_%d_%d.prof" % (self.name, os.getpid(), next(_counter)))
+            self.profile.dump_stats(record["profile"])
+        emit(record)
+        return False
+
+
+def result_value(result, *args, **kwargs):
+    return result
+
+
+def result_length(result, *args, **kwargs):
+    return len(result)
+
+
+def columns_length(result, *args, **kwargs):
+    """ number of rows of a dictionary of columns """
+    return len(next(iter(result.values()))) if result else 0
+
+
+def argument_length(index):
+    """ rows function giving the length of an argument of the function """
+    return lambda result, *args, **kwargs: len(args[index])
+
+
+def instrumented(name, rows=None):
+    """ decorator running the function as a stage
+    rows : function (result, *args, **kwargs) giving the number of rows from the result and the arguments """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled():
+                return func(*args, **kwargs)
+            with stage(name) as s:
+                result = func(*args, **kwargs)
+                if rows is not None:
+                    s.rows = rows(result, *args, **kwargs)
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,138 @@
+"""
+ATLAS Higgs Machine Learning Challenge 2014
+
+Compact in-memory representation of the events partitioned by jet multiplicity
+
+Whole groups of variables are -999 by construction depending on PRI_jet_num: without jet all
+the PRI_jet_leading_* and PRI_jet_subleading_* and the DER_*_jet_jet variables (and
+DER_lep_eta_centrality), with one jet the subleading jet and DER_*_jet_jet variables.
+JetPartitions splits the events in the categories 0, 1 and 2 or more jets and keeps in each
+only the variables which are not always -999 there, float variables in float32 (or float_dtype).
+The other -999 (e.g. DER_mass_MMC when it could not be computed) are kept in place, with an
+explicit mask (True where missing) per variable and category.
+The unified view rebuilds the full columns in the original order (with -999 where a variable is
+not defined), e.g. to score all the events, and combine puts per-category results back in the
+original order. map runs a function on each category, in parallel in a pool of processes
+(e.g. training, evaluation or threshold scan per category).
+
+Typical use:
+    from higgsml_jets import JetPartitions
+    jets=JetPartitions(columns)
+    print jets.variables_of(0),jets.nbytes()
+    scores=jets.combine(jets.map(evaluate_category)) # evaluate_category(category,columns,masks)
+    bdt=forest.evaluate(jets.unified(forest.variables))
+"""
+
+import multiprocessing
+from collections import OrderedDict
+
+import numpy as np
+
+
+# PRI_jet_num 0, 1, 2 or more
+JET_CATEGORIES = (0, 1, 2)
+MISSING = -999.
+
+# data shared by the worker processes
+_jets = None
+
+
+def jet_category(jetnum):
+    """ jet category (0, 1 or 2 for 2 or more) of each event """
+    return np.minimum(np.asarray(jetnum), JET_CATEGORIES[-1]).astype(np.int8)
+
+
+def _init_worker(jets):
+    global _jets
+    _jets = jets
+
+
+def _run_category(task):
+    func, category = task
+    return func(category, _jets.partition(category), _jets.masks[JET_CATEGORIES.index(category)])
+
+
+class JetPartitions(object):
+    """ the columns of events partitioned by jet category, without the variables always missing in a category """
+
+    def __init__(self, columns, float_dtype=np.float32):
+        self.variables = list(columns)
+        self.dtypes = OrderedDict()
+        for var in self.variables:
+            dtype = np.asarray(columns[var]).dtype
+            self.dtypes[var] = np.dtype(float_dtype) if dtype.kind == "f" else dtype
+        category = jet_category(columns["PRI_jet_num"])
+        self.nrows = len(category)
+        # rows of each category in the original order
+        self.index = [np.flatnonzero(category == cat) for cat in JET_CATEGORIES]
+        self.columns = []
+        self.masks = []
+        for rows in self.index:
+            part = OrderedDict()
+            masks = {}
+            for var in self.variables:
+                values = np.asarray(columns[var])[rows]
+                if self.dtypes[var].kind == "f":
+                    missing = values == MISSING
+                    if len(values) and missing.all():
+                        continue  # not defined in this category
+                    if missing.any():
+                        masks[var] = missing
+                part[var] = values.astype(self.dtypes[var])
+            self.columns += [part]
+            self.masks += [masks]
+
+    def partition(self, category):
+        """ OrderedDict variable -> array of the variables defined in the category """
+        return self.columns[JET_CATEGORIES.index(category)]
+
+    def variables_of(self, category):
+        return list(self.partition(category))
+
+    def mask(self, category, var):
+        """ True for the events of the category where var is missing """
+        icat = JET_CATEGORIES.index(category)
+        if var not in self.columns[icat]:
+            return np.ones(len(self.index[icat]), dtype=bool)
+        return self.masks[icat].get(var, np.zeros(len(self.index[icat]), dtype=bool))
+
+    def column(self, var):
+        """ full column of var for all the events in the original order, MISSING where not defined """
+        result = np.empty(self.nrows, dtype=self.dtypes[var])
+        for rows, part in zip(self.index, self.columns):
+            result[rows] = part[var] if var in part else MISSING
+        return result
+
+    def unified(self, variables=None):
+        """ OrderedDict of full columns (see column) """
+        return OrderedDict((var, self.column(var)) for var in (variables or self.variables))
+
+    def combine(self, results):
+        """ full array in the original order from one array per category (e.g. the results of map) """
+        results = [np.asarray(values) for values in results]
+        combined = np.empty(self.nrows, dtype=np.result_type(*results))
+        for rows, values in zip(self.index, results):
+            combined[rows] = values
+        return combined
+
+    def nbytes(self):
+        """ memory used by the partitioned columns, masks and row indices """
+        return sum(col.nbytes for part in self.columns for col in part.values()) + \
+            sum(mask.nbytes for masks in self.masks for mask in masks.values()) + \
+            sum(rows.nbytes for rows in self.index)
+
+    def map(self, func, nworkers=None):
+        """ func(category, columns, masks) for each category, in a pool of nworkers processes
+        (default number of cores, 1 to run in this process, func has to be a module level function)
+        Return the list of results, in the order of JET_CATEGORIES """
+        tasks = [(func, cat) for cat in JET_CATEGORIES]
+        nworkers = min(nworkers or multiprocessing.cpu_count(), len(tasks))
+        if nworkers == 1:
+            _init_worker(self)
+            return [_run_category(task) for task in tasks]
+        pool = multiprocessing.Pool(nworkers, _init_worker, (self,))
+        try:
+            return pool.map(_run_category, tasks)
+        finally:
+            pool.close()
+            pool.join()
@@ -8,67 +8,233 @@ Author D. Rousseau LAL evolved from original by J. Noah-Vanhoucke, Kaggle.
 """
 
 import os
-import csv
+import sys
+import glob
 import math
+import multiprocessing
 
+import numpy as np
+from higgsml_data import load_csv,load_cached,LABELS,KAGGLESETS,UNKNOWN
+from higgsml_bootstrap import bootstrap_ams,summarise
+from higgsml_instrument import instrumented,argument_length
 
-def create_solution_dictionary(solution):
-    """ Read solution file, return a dictionary with key EventId and value the row, as well as the header
-    Solution file headers: EventId, Label, Weight """
-    
-    solnDict = {}
+# one record per EventId, the record of EventId is at index EventId-(first EventId)
+# Label and KaggleSet are codes (index in LABELS and KAGGLESETS, -1 for an EventId not in the solution)
+SOLUTION_DTYPE = np.dtype([("EventId", np.int32), ("Label", np.int8), ("KaggleSet", np.int8), ("KaggleWeight", np.float64)])
+
+# a submission contains the events of the public "b" and private "v" leaderboard
+TESTSETS = [KAGGLESETS.index("b"),KAGGLESETS.index("v")]
+
+
+class SubmissionError(Exception):
+    """ A submission file is not valid, errors is the list of all the problems found """
+
+    def __init__(self, errors):
+        Exception.__init__(self, "\n".join(errors))
+        self.errors = errors
+
+
+def create_solution_store(solution, storefile=None):
+    """ Read solution file, keep only what is needed for scoring (Label, KaggleSet, KaggleWeight)
+    in an array of records indexed by EventId, save it in storefile (default solution+".solution.npy")
+    Solution file headers: EventId, Label, KaggleSet, KaggleWeight (any other column is ignored) """
+
+    storefile = storefile or solution+".solution.npy"
     print "Reading solution file ",solution
-    with open(solution, 'rb') as f:
-        soln = csv.reader(f)
-        header=soln.next() # header
-        iid=header.index("EventId")
-        for row in soln:
-                solnDict[row[iid]] = row
-    return solnDict,header
+    columns,meta = load_cached(solution,["EventId","Label","KaggleSet","KaggleWeight"])
+    eventid = columns["EventId"]
+    firstid = int(eventid.min())
+    store = np.zeros(int(eventid.max())-firstid+1, dtype=SOLUTION_DTYPE)
+    store["EventId"] = np.arange(firstid,firstid+len(store))
+    store["Label"] = UNKNOWN # EventId not in the solution
+    store["KaggleSet"] = UNKNOWN
+    index = eventid-firstid
+    for var in ["Label","KaggleSet","KaggleWeight"]:
+        store[var][index] = columns[var]
+    np.save(storefile,store)
+    return store
+
+
+def load_solution_store(solution, storefile=None):
+    """ Return the solution store of the solution file, memory-mapped from storefile.
+    The store is (re)created if storefile does not exist or is older than the solution file """
+    storefile = storefile or solution+".solution.npy"
+    if not os.path.exists(storefile) or os.path.getmtime(storefile) < os.path.getmtime(solution):
+        create_solution_store(solution, storefile)
+    return np.load(storefile, mmap_mode="r")
+
+
+def gather_solution(store, eventid):
+    """ Return the records of the store for an array of EventId (a copy, in the same order) """
+    index = np.asarray(eventid, dtype=np.int64)-int(store["EventId"][0])
+    if len(index) and (index.min() < 0 or index.max() >= len(store)):
+        raise ValueError("EventId outside of the solution range")
+    records = store[index]
+    if (records["Label"] == UNKNOWN).any():
+        raise ValueError("EventId not in the solution: %d" % records["EventId"][records["Label"] == UNKNOWN][0])
+    return records
 
         
-def check_submission(submission):
-    """ Check that submission RankOrder column is correct:
-        1. All numbers are in [1,NTestSet]
-        2. All numbers are unqiue
-    """
-    Nelements=550000 # hard coded number of event of a valid submission file
-    rankOrderSet = set()    
-    with open(submission, 'rb') as f:
-        sub = csv.reader(f)
-        iline=0 
-        lowest_signal_rank=Nelements+1
-        largest_background_rank=0         
-        sub.next() # header
-        iline+=1
-        for row in sub:
-            rankOrderSet.add(row[1])
-            if row[2]=="s":
-              lowest_signal_rank=min(lowest_signal_rank,int(row[1]))
-              # print "s=",row[1]
-            elif row[2]=="b":                    
-              largest_background_rank=max(largest_background_rank,int(row[1])) 
-              # print "b=",row[1]
-            else:
-              print "ERROR unrecognised label=",row[2]," at line ",iline
-              exit()
-            iline+=1
-    if len(rankOrderSet) != Nelements:
-        print 'ERROR RankOrder column must contain unique values'
-        exit()
-    elif rankOrderSet.isdisjoint(set(xrange(1,Nelements+1))) == False:
-        print 'ERROR RankOrder column must contain all numbers from [1..NTestSset]'
-        exit()
-        
-    if lowest_signal_rank!=largest_background_rank+1:     
-        print "ERROR the lowest signal rank is:",lowest_signal_rank
-        print "ERROR the largest background rank is:",largest_background_rank
-        print "ERROR while all signal rank should be above all background rank!"
-        exit()                                          
+def read_submission(submission):
+    """ Read the submission file once, return EventId and RankOrder (int arrays)
+    and whether each event is predicted as signal (bool array).
+    Submission file headers: EventId, RankOrder, Class """
+    try:
+        columns = load_csv(submission)
+    except ValueError as e:
+        raise SubmissionError(["could not parse %s : %s (Class should be s or b)" % (submission, e)])
+    missing = [var for var in ["EventId","RankOrder","Class"] if var not in columns]
+    if missing:
+        raise SubmissionError(["column %s missing in %s" % (var, submission) for var in missing])
+    unknown = np.flatnonzero(columns["Class"] == UNKNOWN)
+    if len(unknown):
+        raise SubmissionError(["unrecognised Class at line %d (%d lines)" % (unknown[0]+2, len(unknown))])
+    return columns["EventId"].astype(np.int64), columns["RankOrder"].astype(np.int64), columns["Class"] == LABELS.index("s")
+
+
+def validate_submission(eventid, rank, predicted, store, nelements=None):
+    """ Check the content of a submission against the solution store:
+        1. there is one line per event of the public and private leaderboard (nelements, 550000 for the full solution)
+        2. RankOrder is a permutation of [1,nelements]
+        3. all signal ranks are above all background ranks
+    Return the solution records of the events (in the submission order) and the list of errors (empty if valid) """
+    errors = []
+    if nelements is None:
+        nelements = int(np.isin(store["KaggleSet"], TESTSETS).sum())
+    n = len(rank)
+    if n != nelements:
+        errors += ["submission has %d events, expected %d" % (n, nelements)]
+
+    # line number of the first entry of a mask, for the error messages (header is line 1)
+    firstline = lambda mask: np.flatnonzero(mask)[0]+2
+
+    outside = (rank < 1) | (rank > nelements)
+    if outside.any():
+        errors += ["RankOrder must be in [1..%d], found %d at line %d" % (nelements, rank[outside][0], firstline(outside))]
+    counts = np.bincount(rank[~outside], minlength=nelements+1)
+    if (counts > 1).any():
+        errors += ["RankOrder column must contain unique values, %d repeated (first %d)" % ((counts > 1).sum(), np.flatnonzero(counts > 1)[0])]
+    elif (counts[1:] == 0).any():
+        errors += ["RankOrder column must contain all numbers from [1..%d], %d missing" % (nelements, (counts[1:] == 0).sum())]
+
+    lowest_signal_rank = rank[predicted].min() if predicted.any() else nelements+1
+    largest_background_rank = rank[~predicted].max() if (~predicted).any() else 0
+    if lowest_signal_rank != largest_background_rank+1:
+        errors += ["the lowest signal rank is %d and the largest background rank is %d, while all signal rank should be above all background rank" % (lowest_signal_rank, largest_background_rank)]
+
+    # gather the solution of each event, EventId outside the store are left UNKNOWN
+    records = np.zeros(n, dtype=SOLUTION_DTYPE)
+    records["EventId"] = eventid
+    records["Label"] = UNKNOWN
+    records["KaggleSet"] = UNKNOWN
+    index = eventid-int(store["EventId"][0])
+    inrange = (index >= 0) & (index < len(store))
+    records[inrange] = store[index[inrange]]
+    notest = ~np.isin(records["KaggleSet"], TESTSETS)
+    if notest.any():
+        errors += ["EventId %d at line %d is not in the public or private leaderboard (%d events)" % (eventid[notest][0], firstline(notest), notest.sum())]
+    repeated = np.bincount(index[inrange]) > 1
+    if repeated.any():
+        errors += ["EventId column must contain unique values, %d repeated (first %d)" % (repeated.sum(), np.flatnonzero(repeated)[0]+store["EventId"][0])]
+
+    return records, errors
+
 
+def check_submission(submission, store, nelements=None):
+    """ Check that the submission file is valid, raise SubmissionError otherwise """
+    eventid, rank, predicted = read_submission(submission)
+    records, errors = validate_submission(eventid, rank, predicted, store, nelements)
+    if errors:
+        raise SubmissionError(errors)
     return True
 
+
+@instrumented("score", rows=argument_length(0))
+def score_records(records, predicted):
+    """ AMS of the events predicted as signal, for the public and private leaderboard
+    Return a dictionary {"public": {"ams":,"signal":,"background":}, "private": {...}} """
+    # sum of KaggleWeight per KaggleSet and Label in one go
+    issel = predicted & (records["Label"] >= 0) & (records["KaggleSet"] >= 0)
+    index = records["KaggleSet"][issel].astype(np.intp)*len(LABELS)+records["Label"][issel]
+    sums = np.bincount(index, weights=records["KaggleWeight"][issel], minlength=len(KAGGLESETS)*len(LABELS))
+    result = {}
+    for board, kset in [("public","b"), ("private","v")]:
+        signal = float(sums[KAGGLESETS.index(kset)*len(LABELS)+LABELS.index("s")])
+        background = float(sums[KAGGLESETS.index(kset)*len(LABELS)+LABELS.index("b")])
+        result[board] = {"ams": AMS(signal, background), "signal": signal, "background": background}
+    return result
+
+
+def score_submission(submission, store, nelements=None):
+    """ Read, validate and score a submission file in a single pass, raise SubmissionError if not valid
+    Return the public and private scores (see score_records) """
+    eventid, rank, predicted = read_submission(submission)
+    records, errors = validate_submission(eventid, rank, predicted, store, nelements)
+    if errors:
+        raise SubmissionError(errors)
+    return score_records(records, predicted)
+
     
+# solution store of the scoring worker processes, memory-mapped so that all processes share the same pages
+_workerStore = None
+
+
+def _init_worker(storefile):
+    global _workerStore
+    _workerStore = np.load(storefile, mmap_mode="r")
+
+
+def _score_worker(args):
+    submission, nelements = args
+    try:
+        return submission, score_submission(submission, _workerStore, nelements), []
+    except SubmissionError as e:
+        return submission, None, e.errors
+    except (IOError, OSError) as e:
+        return submission, None, [str(e)]
+
+
+def expand_submissions(patterns):
+    """ list of submission files from file names or glob patterns (duplicates removed, order kept) """
+    submissions = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) or [pattern] # a missing file is reported when scoring
+        submissions += [match for match in matches if match not in submissions]
+    return submissions
+
+
+def score_submissions(submissions, solution, nworkers=None, nelements=None, storefile=None):
+    """ Score several submission files against one solution, in a pool of nworkers processes
+    (default number of cores, 1 to score in this process). The solution store is loaded once
+    and memory-mapped by the workers, not copied.
+    Return a list of (submission, score, errors): score as returned by score_submission
+    (None if not valid), errors the list of problems found """
+    storefile = storefile or solution+".solution.npy"
+    load_solution_store(solution, storefile) # create it if needed, before starting the workers
+    tasks = [(submission, nelements) for submission in submissions]
+    if nworkers == 1 or len(tasks) <= 1:
+        _init_worker(storefile)
+        return [_score_worker(task) for task in tasks]
+    pool = multiprocessing.Pool(nworkers, _init_worker, (storefile,))
+    try:
+        return pool.map(_score_worker, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def write_score_table(results, filename):
+    """ write the results of score_submissions as a csv table, one line per submission """
+    with open(filename, "w") as f:
+        f.write("Submission,Valid,PublicAMS,PublicSignal,PublicBackground,PrivateAMS,PrivateSignal,PrivateBackground,Error\n")
+        for submission, score, errors in results:
+            if score is None:
+                f.write("%s,0,,,,,,,%s\n" % (submission, errors[0].replace(",", ";") if errors else ""))
+                continue
+            f.write("%s,1,%s,\n" % (submission, ",".join(repr(score[board][key]) for board in ["public","private"]
+                                                        for key in ["ams","signal","background"])))
+
+
 def AMS(s, b):
     """ Approximate Median Significance defined as:
         AMS = sqrt(
@@ -79,8 +245,7 @@ def AMS(s, b):
     br = 10.0
     radicand = 2 *( (s+b+br) * math.log (1.0 + s/(b+br)) -s)
     if radicand < 0:
-        print 'radicand is negative. Exiting'
-        exit()
+        raise ValueError('radicand is negative')
     else:
         return math.sqrt(radicand)
 
@@ -94,62 +259,64 @@ if __name__ == "__main__":
     submissionFile = "submission_tmva.csv"
     #submissionFile = "submission_simplest.csv"        
     
+    # several submission files (or glob patterns) can also be given on the command line,
+    # they are then scored in parallel against the solution loaded once, and the table written in scoreFile
+    # e.g. python higgsml_opendata_kaggle.py "submissions/*.csv"
+    submissionFiles = expand_submissions(sys.argv[1:]) or [submissionFile]
+    scoreFile = "scores.csv"
+    # number of Poisson bootstrap replicas to estimate the uncertainty of the AMS (single submission), 0 for none
+    # (e.g. 1000, it takes a few seconds)
+    bootstrapReplicas = 0
 
 
     # solution file is the full file from opendata
-    solutionFile = "atlas-higgs-challenge-2014-v2.csv"  
-    solutionDict,header = create_solution_dictionary(solutionFile)
-    ilabel=header.index("Label")
-    iid=header.index("EventId")
-    ikaggleweight=header.index("KaggleWeight") # weight normalised wrt kaggle samples
-    ikaggleset=header.index("KaggleSet") # which kaggle sample "t" training "b" public leaderboard "v" private ld "u" unused                       
-
-    signalPublic=0.
-    backgroundPublic=0.
-    signalPrivate=0.
-    backgroundPrivate=0.
-                
-    if check_submission(submissionFile):
-        print submissionFile," is valid"
+    solutionFile = "atlas-higgs-challenge-2014-v2.csv"  # the solution and the submissions can be compressed (.gz, .bz2, .xz)
 
-        
-    with open(submissionFile, 'rb') as f:
-        sub = csv.reader(f)
-        iline=0 
-        sub.next() # header
-        iline+=1
-        for row in sub:
-            eventId=row[0]
-            sol=solutionDict[eventId]
-            kaggleweight=float(sol[ikaggleweight])
-            label=sol[ilabel]
-            kaggleset=sol[ikaggleset]
-            #just to be sure
-            if sol[iid] != eventId:
-                print sol[iid],eventId
-                exit()
-
-
-            if row[2] == 's': # only events predicted to be signal are scored
-                if label == 's':
-                        if kaggleset=="b":
-                                signalPublic += kaggleweight
-                        elif kaggleset=="v":
-                                signalPrivate += kaggleweight                            
-                        else:
-                            print "kaggleset=",usage
-                elif label == 'b':
-                        if kaggleset=="b":
-                                backgroundPublic += kaggleweight
-                        elif kaggleset=="v":
-                                backgroundPrivate += kaggleweight                            
-                else:
-                    print "something wrong",label
-                    exit()
+    if len(submissionFiles) > 1:
+        print "Scoring ",len(submissionFiles)," submissions against ",solutionFile
+        results = score_submissions(submissionFiles, solutionFile)
+        for submission, score, errors in results:
+            if score is None:
+                print submission," is not valid: ",errors[0]
+            else:
+                print submission," public AMS = ",score["public"]["ams"]," private AMS = ",score["private"]["ams"]
+        write_score_table(results, scoreFile)
+        print "scores written in ",scoreFile
+        exit()
+
+    submissionFile = submissionFiles[0]
+    # compact store Label/KaggleSet/KaggleWeight indexed by EventId, memory-mapped (created the first time)
+    solutionStore = load_solution_store(solutionFile)
+
+    try:
+        eventId, rank, predicted = read_submission(submissionFile)
+        records, errors = validate_submission(eventId, rank, predicted, solutionStore)
+        if errors:
+            raise SubmissionError(errors)
+    except SubmissionError as e:
+        for error in e.errors:
+            print "ERROR",error
+        exit(1)
+    print submissionFile," is valid"
+    score = score_records(records, predicted)
+
+    signalPublic,backgroundPublic = score["public"]["signal"],score["public"]["background"]
+    signalPrivate,backgroundPrivate = score["private"]["signal"],score["private"]["background"]
 
     print "Public leaderboard: AMS = ",AMS(signalPublic, backgroundPublic),'signal = {0}, background = {1}'.format(signalPublic, backgroundPublic)
     print "Private leaderboard: AMS = ",AMS(signalPrivate, backgroundPrivate),'signal = {0}, background = {1}'.format(signalPrivate, backgroundPrivate)
 
+    if bootstrapReplicas > 0:
+        print "Uncertainty from ",bootstrapReplicas," bootstrap replicas of the events"
+        issig = records["Label"] == LABELS.index("s")
+        for board, kset in [("Public","b"), ("Private","v")]:
+            inboard = records["KaggleSet"] == KAGGLESETS.index(kset)
+            # the submission selects the events predicted as signal, i.e. score>0.5 with score 1 for s 0 for b
+            replicas = bootstrap_ams(predicted[inboard].astype(np.float64), issig[inboard], records["KaggleWeight"][inboard],
+                                     0.5, bootstrapReplicas, scan=False)
+            interval = summarise(replicas["ams"])
+            print board+" leaderboard: AMS std = ",interval["std"]," 68% interval = [",interval["low"],",",interval["high"],"]"
+
     
 #with simplest      
 #Public leaderboard: AMS =  1.54450974337 signal = 461.228096209, background = 89012.844986
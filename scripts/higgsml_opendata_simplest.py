@@ -8,102 +8,74 @@ Author D. Rousseau LAL
 """
 
 
-import csv
+import numpy as np
+from higgsml_data import load_cached,LABELS,KAGGLESETS
+from higgsml_ams import ams,optimise_threshold,renormalisation
+from higgsml_submission import write_submission
 
-datafile="atlas-higgs-challenge-2014-v2.csv"
+datafile="atlas-higgs-challenge-2014-v2.csv" # can also be compressed, e.g. atlas-higgs-challenge-2014-v2.csv.gz (or .bz2, .xz)
  
 
 print "Reading the data file :",datafile
-# store everything in memory
-alldata = list(csv.reader(open(datafile,"rb"), delimiter=','))
-
-# first line is the list of variables, put it aside
-header        = alldata.pop(0)
-
-
-# get the index of a few variables
-iid=header.index("EventId")
-ilabel=header.index("Label")
-ikaggleset=header.index("KaggleSet")
-ikaggleweight=header.index("KaggleWeight")
-iweight=header.index("Weight") # original weight     
-immc=header.index("DER_mass_MMC")
-injet=header.index("PRI_jet_num")
-
-# turn all entries from string to float, except EventId and PRI_jet_num to int, except Label and KaggleSet remains string
-for entry in alldata:
-        for i in range(len(entry)):
-                if i in [iid,injet]:
-                    entry[i]=int(entry[i])
-                elif i not in [ilabel,ikaggleset]:
-                    entry[i]=float(entry[i])
-
-print "Loop on  dataset and compute the score"
-header+=["myscore"] # myscore is a new variable
-
-# loop and all entries and compute my score
-for entry in alldata:
-    myscore=-abs(entry[immc]-125.) # this is a simple discriminating variable. Signal should be closer to zero.
+# store everything in memory, one numpy array per variable
+# EventId and PRI_jet_num are int, Label and KaggleSet are small int codes (index in LABELS and KAGGLESETS), all others are float
+# the first time the csv is converted into a binary cache, which is simply memory-mapped afterwards
+alldata,meta = load_cached(datafile)
+
+# the codes of the few categories we need
+issig=alldata["Label"]==LABELS.index("s")
+kaggleset=alldata["KaggleSet"]
+weight=alldata["Weight"] # original weight
+kaggleweight=alldata["KaggleWeight"]
+
+print "Compute the score on the whole dataset"
+# myscore is a new variable
+alldata["myscore"]=-np.abs(alldata["DER_mass_MMC"]-125.) # this is a simple discriminating variable. Signal should be closer to zero.
                                    # minus sign so that signal has the highest values
                                    # so we will be making a simple window cut on the Higgs mass estimator
                                    # 125 GeV is the middle of the window
-    entry+=[myscore]
     
-# at this stage alldata is a list (one entry per line) of list of variables
-# which can be conveniently accessed by getting the index from the header 
+# at this stage alldata is a dictionary of numpy arrays (one entry per event)
+# which can be conveniently accessed by the name of the variable
 
 threshold=-22 # somewhat arbitrary value, should be optimised
+optimise=False # if True the threshold is optimised on the kaggle training set ('t'), otherwise keep the value above
 
+myscore=alldata["myscore"]
 
+if optimise:
+    print "Optimise the threshold on the kaggle training set ('t') with an exact scan of all thresholds"
+    intrain=kaggleset==KAGGLESETS.index("t")
+    # with KaggleWeight, already normalised
+    best,curve=optimise_threshold(myscore[intrain],issig[intrain],kaggleweight[intrain])
+    print " best threshold with kaggle weight: ",best["threshold"]," AMS=",best["ams"]," (",len(curve["threshold"])," thresholds scanned)"
+    # with Weight, renormalised to the full dataset, should give the same result
+    sigscale,bkgscale=renormalisation(weight,issig,intrain)
+    bestw,curvew=optimise_threshold(myscore[intrain],issig[intrain],weight[intrain],sigscale,bkgscale)
+    print " best threshold with recomputed weight: ",bestw["threshold"]," AMS=",bestw["ams"]
+    threshold=best["threshold"]
 
 
-print "Loop again to determine the AMS, using threshold:",threshold
-sumselsig=0.
-sumselbkg=0.
-sumallsig=0.
-sumallbkg=0.
-sumsubsig=0.
-sumsubbkg=0.
-
-sumselkagglesig=0.
-sumselkagglebkg=0.
-
-iscore=header.index("myscore")
+print "Determine the AMS, using threshold:",threshold
 print "only look at kaggle public data set ('b') (other choice training 't', private 'v', unused 'u')"
 print "One could make one own dataset (then the weight should be renoramalised)"
+# (higgsml_subset.SubsetBuilder builds selected, random or stratified subsets with renormalised weights)
 
-for entry in alldata:
-    myscore=entry[iscore]
-    weight=entry[iweight]
-    kaggleweight=entry[ikaggleweight]    
+# sum of signal and background weight needed to renormalise (precomputed in the cache)
+sumallsig=sum(meta["sums"]["Weight"]["s"].values())
+sumallbkg=sum(meta["sums"]["Weight"]["b"].values())
 
-    # compute sum of signal and background weight needed to renormalise
-    if entry[ilabel]=="s":
-        sumallsig+=weight
-    else:
-        sumallbkg+=weight    
+# from now on, only work on subset
+insub=kaggleset==KAGGLESETS.index("b")
+sumsubsig=weight[insub & issig].sum()
+sumsubbkg=weight[insub & ~issig].sum()
 
-        
-
-    if entry[ikaggleset]!="b":
-        continue
-    
-    # from now on, only work on subset
-    # compute sum of signal and background weight needed to renormalise
-    if entry[ilabel]=="s":
-        sumsubsig+=weight
-    else:
-        sumsubbkg+=weight    
-    
-    
-    # sum event weight passing the selection. Of course in real life the threshold should be optimised
-    if myscore >threshold:
-        if entry[ilabel]=="s":
-            sumselsig+=weight
-            sumselkagglesig+=kaggleweight
-        else:
-            sumselbkg+=weight                
-            sumselkagglebkg+=kaggleweight    
+# sum event weight passing the selection. Of course in real life the threshold should be optimised
+selected=insub & (myscore>threshold)
+sumselsig=weight[selected & issig].sum()
+sumselbkg=weight[selected & ~issig].sum()
+sumselkagglesig=kaggleweight[selected & issig].sum()
+sumselkagglebkg=kaggleweight[selected & ~issig].sum()
 
             
 # ok now we have our signal (sumselkagglesig) and background (sumselkagglebkg) estimation
@@ -112,14 +84,7 @@ for entry in alldata:
 sumsig=sumselsig*sumallsig/sumsubsig
 sumbkg=sumselbkg*sumallbkg/sumsubbkg
 
-# compute AMS
-def ams(s,b):
-    from math import sqrt,log
-    if b==0:
-        return 0
-
-    return sqrt(2*((s+b+10)*log(1+float(s)/(b+10))-s))
-
+# compute AMS (see higgsml_ams.py)
 print " AMS with recomputed weight: ",ams(sumsig,sumbkg),"( signal=",sumsig," bkg=",sumbkg,")"
 print " AMS with kaggle weight : ",ams(sumselkagglesig,sumselkagglebkg),"( signal=",sumselkagglesig," bkg=",sumselkagglebkg,")"
 print " recomputed weight and Kaggle weight should be identical if using a predefined kaggle subset"
@@ -129,45 +94,15 @@ submissionfilename="submission_simplest.csv"
 print " Now build submission file a la Kaggle:",submissionfilename
 
 # build subset with only the needed variables
-alltest=[]
-for entry in alldata:
-    if entry[ikaggleset] not in ["b","v"]:
-        continue
-    # build the new record with only the needed info    
-    outputentry=[]
-    outputentry+=[entry[iid]]
-    outputentry+=[entry[iscore]]
-    alltest+=[outputentry]
+intest=np.isin(kaggleset,[KAGGLESETS.index("b"),KAGGLESETS.index("v")])
+testid=alldata["EventId"][intest]
+testscore=myscore[intest]
 
-#index of variables in the subset     
-ioid=0
-ioscore=1    
-# Sort on the score 
-alltestsorted=sorted(alltest,key=lambda entrytest: entrytest[ioscore])
-# the RankOrder we want is now simply the entry number in alltestsorted
-
-
-outputfile=open(submissionfilename,"w")
-outputfile.write("EventId,RankOrder,Class\n")
-
-rank=1 # kaggle wants to start at 1
-for oentry in alltestsorted:
-    # compute label 
-    slabel="b"
-    if oentry[ioscore]>threshold: # arbitrary threshold
-        slabel="s"
-
-    outputfile.write(str(oentry[ioid])+",")
-    outputfile.write(str(rank)+",")
-    outputfile.write(slabel)            
-    outputfile.write("\n")
-    rank+=1
-
-
-outputfile.close()
+# Sort on the score (ties broken by EventId), the RankOrder is the position in the sorted events,
+# label "s" above the threshold, and write the file in blocks (see higgsml_submission.py)
+write_submission(submissionfilename,testid,testscore,threshold)
 
 
 
 # delete big objects
-del alldata,alltest,alltestsorted
-
+del alldata,testid,testscore
@@ -12,12 +12,24 @@ Author D. Rousseau LAL
 # the output of each step is saved in one or more file,
 # so that each step can be run separately for easier debugging
 # use the doXYZ flag to switch steps on/off
+# a step is only rerun if its input files, its options or its code changed since its last run
+# (see higgsml_pipeline.py), e.g. changing the threshold only reruns the submission step
 
-from ROOT import TFile,TTree,gStyle,TMVA,TCut,TH1F
+from ROOT import TFile,gStyle,TMVA,TCut,TGraph
 import array
 gStyle.SetOptStat(1111111)
 
-import random,string,math,csv
+import random,string,math,os
+import numpy as np
+from higgsml_root import csv_to_root,read_tree_columns,clone_tree_with_branches,write_tree,root_columns
+from higgsml_store import csv_to_store,load_store,read_store_meta,write_like
+from higgsml_bdt import read_tmva_weights,save_forest,load_forest
+from higgsml_gbt import train_gbt,bin_columns,train_kfold
+from higgsml_ams import optimise_threshold,crossvalidate_threshold
+from higgsml_bootstrap import bootstrap_ams,summarise
+from higgsml_submission import write_submission
+from higgsml_report import ams_breakdown,format_breakdown
+from higgsml_pipeline import Pipeline
 
 debug=False
 debug=True # if print some debugging printout
@@ -35,166 +47,100 @@ doevaluate=True # apply training on training and test files, output new root fil
 dothreshold=True # compute optimal threshold from score training file
 dosubmission=True # generate csv file for kaggle submission, from optimal threshold and test score file
 
-filenamecsv="atlas-higgs-challenge-2014-v2.csv"
+forcerun=False # if True, run the switched on steps even if they are up to date
+
+filenamecsv="atlas-higgs-challenge-2014-v2.csv" # can also be compressed (.gz, .bz2, .xz)
 treename="htautau"
+storage="root" # "root" : steps 2-5 read the tree htautau, "columnar" : a store partitioned by KaggleSet and jet category
+               # (higgsml_store.py), each step only reads the variables and KaggleSets it uses
+storename=filenamecsv+".parts"
+scorestorename=filenamecsv+"_score.parts"
 picklename="threshold.p"
 
+trainer="tmva" # "tmva" : TMVA BDT, "native" : gradient boosted trees in numpy (higgsml_gbt.py, no TMVA, several cores)
+ntrees=200 # options of the native training
+maxdepth=5
+learningrate=0.1
+nworkers=None # number of processes of the native training (None : all the cores)
+kfolds=1 # if >1, native training of one model per fold (in parallel), the training events are scored by the model
+         # which did not see them (out of fold, used for the threshold), the others by the average of the models
+oofname="weights/higgsml_gbt_oof.npz" # out of fold scores of the k-fold training
+if trainer=="native":
+    weightfilename="weights/higgsml_gbt.npz"
+else:
+    weightfilename="weights/TMVAClassification_BDT.weights.xml"
+
 
 # convert the cvs file into a root file
 # bit by bit conversion, except the "Label" which is converted into an int 1 for "s" 0 for "b"
 
-if docsvtoroot:
+def csvtoroot():
     print " Step #1 : read csv file, convert into root file "
     pathtofile=""
 
     fullfilename=pathtofile+filenamecsv
     print "reading ",fullfilename
-    allentries = list(csv.reader(open(fullfilename,"rb"), delimiter=','))
-
-    # first line is the list of variables, put it aside
-    header        = allentries.pop(0)
-    if debug:
-        print header
 
     output_name  = filenamecsv+'.root'
-    output_file  = TFile(output_name, 'recreate')
-
-    # create ttree
-    tree = TTree(treename, treename)
-
-    # mapping between name and field
-    maps={}
-
-    # mapping of variable name with type
-    typemap={}
-
-    # by default all variables are float
-    for var in header:
-        typemap [ var ] = "float"
 
-    # create the new branches if any
+    # create the new branches if any (all new vars are float)
+    # each is a (name, expression) pair, the expression uses the variables of the file, + - * / **,
+    # and functions like abs, sqrt, log, cos, deltaphi, invmass (see higgsml_features.py)
+    # it is -999 for events where one of its variables is -999
     newvars= []
-    # newvars= ["MyGreatNewVar"] 
-    for var in newvars:
-        maps [ var ] = array.array('f',[0.0])
-        tree.Branch(var , maps[var],  '% s/F' % (var))  # assume all new vars are float
-
-        
-    # deal with some exception
-    typemap["EventId"]="int" 
-    typemap["PRI_jet_num"]="int"
-    typemap["Label"]="int" # s/b will be converted to 1/0
-    typemap["KaggleSet"]="int" # t b v u will be converted in 0 10 11 100
-
-
-    if len(typemap)!=len(header): # we should not have added any variable
-        print "typemap :", len(typemap), "header : ", len(header) # we should not have added any variable
-        exit() # should not happen
-
-
-    # create the tree branches
-    for var in header:
-        type=typemap[var]
-        if type=="float":
-            maps [ var ] = array.array('f',[0.0])
-            tree.Branch(var , maps[var],  '% s/F' % (var))
-        elif type=="int":
-            maps [ var ] = array.array('i',[0])
-            tree.Branch(var , maps[var],  '% s/I' % (var))
+    # newvars= [("MyGreatNewVar","PRI_lep_phi+1.213141"),
+    #           ("DeltaPhiTauLep","abs(deltaphi(PRI_tau_phi,PRI_lep_phi))"),
+    #           ("MassTauLep","invmass(PRI_tau_pt,PRI_tau_eta,PRI_tau_phi,PRI_lep_pt,PRI_lep_eta,PRI_lep_phi)")]
+
+    # the csv is converted once into a binary cache (see higgsml_data.py), then chunks of rows
+    # are converted in parallel into small root files which are merged into the final tree
+    # (see higgsml_root.py). EventId and PRI_jet_num are int, Label s/b is converted to 1/0,
+    # KaggleSet t b v u to 0 10 11 100, all others are float
+    chunksize=100000 # number of events converted at a time by one process
+    nworkers=None # number of processes, None for the number of cores, 1 to convert in this process
+    if storage=="columnar":
+        # or one .npy file per variable, KaggleSet and jet category
+        nentries=csv_to_store(fullfilename,storename,newvars)
+        print nentries, " entries successfully written in ",storename
+        if debug:
+            for part in read_store_meta(storename)["partitions"]:
+                print " KaggleSet ",part["kaggleset"]," PRI_jet_num ",part["jets"],": ",part["nrows"]," entries"
+        return
+    nentries=csv_to_root(fullfilename,output_name,treename,newvars,chunksize,nworkers)
 
+    print nentries, " entries successfully written "
     if debug:
-        tree.GetListOfBranches().Print()    
-
-    # now fill the tree    
-    ientry=0
-    nvar=len(header)
-    for entry in allentries:
-        for ivar in range(nvar):
-            varval=entry[ivar]
-            varname=header[ivar]
-            type=typemap[varname]
-
-            # convert the character variables into int
-            if varname=="Label":
-                if varval=="s":
-                    varval=1
-                elif varval=="b":
-                    varval=0
-                else:
-                    varval=-999
-            if varname=="KaggleSet":
-                if varval=="t":
-                    varval=0
-                elif varval=="b":
-                    varval=10
-                elif varval=="v":
-                    varval=11
-                elif varval=="u":
-                    varval=100
-                else:
-                    varval=-999
-
-            if type=="float":        
-                maps [ varname ] [0]= float(varval)
-            elif type=="int":
-                maps [ varname ] [0]= int(varval)
-
-            # now fill the new variables if any
-            if len(newvars)!=0:
-                maps["MyGreatNewVar"][0]=maps["PRI_lep_phi"][0]+1.213141 # some calculation
-
-
-                
-        tree.Fill()
-        # if ientry>10:
-        #    break
-        ientry+=1
-        if ientry % 10000 == 1:
-            print "processing event ",ientry
-
-    print ientry, " entries successfully written "
-    # Save and close the output file (required for data to be written)    
-    output_file.Write()
-    output_file.Close()
-    # cleanup this big object
-    del allentries
+        output_file  = TFile(output_name, 'read')
+        output_file.Get(treename).GetListOfBranches().Print()    
+        output_file.Close()
 
 # train from training.csv.root
 # output training in xml
 # training is the most simple BDT in TMVA
 # this is deliberate to leave room for improvements within TMVA
 
-if dotraining:
+def training():
     print " Step #2 : train on training file, save training in xml file"
     output_directory = 'higgsml_output'
     traintree_name = treename
     trainfilename=filenamecsv+".root" 
 
 
-    trainfile = TFile.Open(trainfilename,"read")
-    traintree = trainfile.Get(traintree_name)
-    
-    TMVA.Tools.Instance()
-    
-    
-    # create the tmva output file, which will be full of details about the training
-    fout = TFile("tmvatest.root","RECREATE")
-
+    if storage=="columnar":
+        varlist=read_store_meta(storename)["header"]
+    else:
+        trainfile = TFile.Open(trainfilename,"read")
+        traintree = trainfile.Get(traintree_name)
 
-    # use the default factory
-    factory = TMVA.Factory("TMVAClassification", fout)                                
-
-
-
-    # build the list of variables
-    al=traintree.GetListOfBranches()
-    varlist=[]
-    for i in range(al.GetEntries()):
-        varlist+=[al[i].GetName()]
+        # build the list of variables
+        al=traintree.GetListOfBranches()
+        varlist=[]
+        for i in range(al.GetEntries()):
+            varlist+=[al[i].GetName()]
 
         
     if debug:
-        print "all variables of ",trainfile, " ", varlist
+        print "all variables of ",storename if storage=="columnar" else trainfile, " ", varlist
         print "now stripping EventId Weight and Label "
 
     # these variables should not be used for training
@@ -204,6 +150,57 @@ if dotraining:
     if len(mva_input_list)!=len(varlist)-5:
         raise Exception #  Something not understood in building mva_input_list
 
+    if trainer=="native":
+        # same events, variables and weights as TMVA below, trained with higgsml_gbt.py
+        if storage=="columnar":
+            # only the training set (KaggleSet t) is read
+            columns=load_store(storename,mva_input_list+["Label","KaggleWeight"]+(["EventId"] if kfolds>1 else []),
+                               kagglesets=["t"])
+            intrain=np.ones(len(columns["Label"]),dtype=bool)
+        else:
+            columns=read_tree_columns(traintree,mva_input_list+["Label","KaggleSet","KaggleWeight"])
+            intrain=columns["KaggleSet"]==0
+        print "train the native gradient boosted trees on ",intrain.sum()," events"
+        traincolumns=dict((var,columns[var][intrain]) for var in mva_input_list)
+        if not os.path.exists(os.path.dirname(weightfilename)):
+            os.makedirs(os.path.dirname(weightfilename))
+        if kfolds>1:
+            edges,binned=bin_columns(traincolumns,mva_input_list)
+            forests,outoffold,forest=train_kfold(binned,columns["Label"][intrain]==1,columns["KaggleWeight"][intrain],
+                                                 edges,mva_input_list,nfolds=kfolds,nworkers=nworkers,
+                                                 ntrees=ntrees,maxdepth=maxdepth,learningrate=learningrate)
+            if storage=="columnar":
+                eventid=columns["EventId"]
+            else:
+                eventid=read_tree_columns(traintree,["EventId"])["EventId"][intrain]
+            np.savez(oofname,EventId=eventid,bdt=outoffold)
+            print "out of fold scores saved in ",oofname
+        else:
+            forest=train_gbt(traincolumns,mva_input_list,columns["Label"][intrain]==1,columns["KaggleWeight"][intrain],
+                             ntrees=ntrees,maxdepth=maxdepth,learningrate=learningrate,nworkers=nworkers,verbose=debug)
+        save_forest(forest,weightfilename)
+        print "training saved in ",weightfilename
+        return
+
+    if storage=="columnar":
+        # TMVA needs a tree: the training set only, with the variables used
+        trainfilename="higgsml_train.root"
+        write_tree(trainfilename,treename,root_columns(load_store(storename,mva_input_list+["Label","KaggleSet","KaggleWeight"],
+                                                                  kagglesets=["t"])))
+        trainfile = TFile.Open(trainfilename,"read")
+        traintree = trainfile.Get(traintree_name)
+
+    TMVA.Tools.Instance()
+    
+    
+    # create the tmva output file, which will be full of details about the training
+    fout = TFile("tmvatest.root","RECREATE")
+
+
+    # use the default factory
+    factory = TMVA.Factory("TMVAClassification", fout)                                
+
+
     # only use kaggle training set (arbitrary) KaggleSet==0    
     # signal selection    
     signalCut = TCut( "Label==1 && KaggleSet==0" ) 
@@ -231,6 +228,7 @@ if dotraining:
     # for signal event (Label==1)     : Weight*(Sum_(i all signal) Weight_i)) /(Sum_(i subset signal) Weight_i))
     # for background event (Label==0) : Weight*(Sum_(i all background) Weight_i)) /(Sum_(i subset background) Weight_i))
     # (KaggleWeight was computed like that for Kaggle subsets)     
+    # (higgsml_subset.SubsetBuilder builds such subsets and their weights)
     factory.SetWeightExpression("KaggleWeight");
     
 
@@ -257,7 +255,7 @@ if dotraining:
 # read in train and test file, apply scoring as described in weights directory
 # write out new root tree with additional score file
 
-if doevaluate:
+def evaluate():
     print " Step #3 : apply training on training and test files, output new root files with score variable in addition"
 
 
@@ -272,209 +270,246 @@ if doevaluate:
 
     maps = {}
 
-    inputfile = TFile.Open(inputfilename,"read")
-    inputtree    = inputfile.Get(treename)
-
-    # get the list of input variables
-    al=inputtree.GetListOfBranches()
-    varlist=[]
-    for i in range(al.GetEntries()):
-        varlist+=[al[i].GetName()]
+    if storage=="columnar":
+        varlist=read_store_meta(storename)["header"]
+    else:
+        inputfile = TFile.Open(inputfilename,"read")
+        inputtree    = inputfile.Get(treename)
+
+        # get the list of input variables
+        al=inputtree.GetListOfBranches()
+        varlist=[]
+        for i in range(al.GetEntries()):
+            varlist+=[al[i].GetName()]
     mva_input_list=[e for e in varlist if not e in ['EventId','Weight','Label','KaggleSet','KaggleWeight']]
 
 
 
 
-    # create array to map variables to values
-    for var in varlist:                
-        maps [var ] = array.array('f',[0.0]) # all float, including possible integer (otherwise the reader chokes)          
+    usetmvareader=False # if True, evaluate with the TMVA Reader event by event (slow) instead of numpy
+    nworkers=1 # number of threads for the numpy evaluation
 
-    for var in new_variables_list: 
-        if debug:
-            print "adding ",var
-        maps [var ] = array.array('f',[0.0])
 
+    if trainer=="native" or not usetmvareader or storage=="columnar":
+        # the BDT is read from the weight file into flat arrays and evaluated on whole columns
+        # (see higgsml_bdt.py) no need of the TMVA Reader
+        if trainer=="native":
+            forest=load_forest(weightfilename)
+        else:
+            forest=read_tmva_weights(weightfilename)
+        if forest.variables!=mva_input_list:
+            print "WARNING variables of the weight file ",forest.variables," differ from the tree ",mva_input_list
+
+        if storage=="columnar":
+            # only the sets used afterwards: t for the threshold, b and v for the submission (not u)
+            # with the k-fold training the t events get their out of fold score below, only their EventId is read
+            bdtsets=["b","v"] if trainer=="native" and kfolds>1 else ["t","b","v"]
+            columns=load_store(storename,forest.variables+["EventId"],kagglesets=bdtsets)
+            print "evaluate the BDT on ",len(columns["EventId"])," events"
+            scores=forest.evaluate(columns,nworkers=nworkers)
+            eventid=columns["EventId"]
+            if "t" not in bdtsets:
+                # the t events come first in the store
+                traineventid=load_store(storename,["EventId"],kagglesets=["t"])["EventId"]
+                eventid=np.concatenate([traineventid,eventid])
+                scores=np.concatenate([np.zeros(len(traineventid)),scores])
+        else:
+            # read only the BDT variables from the tree, in the same order as for training
+            columns=read_tree_columns(inputtree,forest.variables)
+            print "evaluate the BDT on ",len(columns[forest.variables[0]])," events"
+            scores=forest.evaluate(columns,nworkers=nworkers)
+        if trainer=="native" and kfolds>1:
+            # the training events get their out of fold score
+            oof=np.load(oofname)
+            if storage!="columnar":
+                eventid=read_tree_columns(inputtree,["EventId"])["EventId"]
+            order=np.argsort(oof["EventId"])
+            position=np.searchsorted(oof["EventId"],eventid,sorter=order)
+            position=order[np.minimum(position,len(order)-1)]
+            found=oof["EventId"][position]==eventid
+            scores[found]=oof["bdt"][position[found]]
+            print "out of fold scores for ",found.sum()," training events"
+
+        if debug and trainer=="tmva":
+            # cross check with the TMVA Reader on the first events
+            maps={}
+            reader=TMVA.Reader()
+            for var in forest.variables:
+                maps [var ] = array.array('f',[0.0])
+                reader.AddVariable( var , maps[var]);
+            reader.BookMVA("BDT",weightfilename)
+            maxdiff=0.
+            for i in xrange(min(1000,len(scores))):
+                for var in forest.variables:
+                    maps[var][0]=columns[var][i]
+                maxdiff=max(maxdiff,abs(reader.EvaluateMVA("BDT")-scores[i]))
+            print "largest difference with TMVA Reader on the first 1000 events: ",maxdiff
+
+        if storage=="columnar":
+            # the score alone, in a store with the same partitions
+            print "creating store ",scorestorename
+            write_like(scorestorename,storename,{"bdt":scores},kagglesets=["t","b","v"])
+        else:
+            # Create the output file, copy of the input tree with the score in addition
+            print "creating file ",outputfilename
+            clone_tree_with_branches(inputtree,outputfilename,{"bdt":scores})
+
+    else:
+        # create array to map variables to values
+        for var in varlist:                
+            maps [var ] = array.array('f',[0.0]) # all float, including possible integer (otherwise the reader chokes)          
 
-    reader=TMVA.Reader()
-    # Add to the reader the variables to be used for bdt evaluation (only that one)
-    # Make sure variables are in the same order as for training
+        for var in new_variables_list: 
+            if debug:
+                print "adding ",var
+            maps [var ] = array.array('f',[0.0])
 
-    for var in mva_input_list:                
-        reader.AddVariable( var , maps[var]);            
 
-    reader.BookMVA("BDT","weights/TMVAClassification_BDT.weights.xml")
+        reader=TMVA.Reader()
+        # Add to the reader the variables to be used for bdt evaluation (only that one)
+        # Make sure variables are in the same order as for training
 
+        for var in mva_input_list:                
+            reader.AddVariable( var , maps[var]);            
 
-    # Create the output file
-    print "creating file ",outputfilename
-    outputfile = TFile.Open(
-        outputfilename, 
-        'RECREATE'
-        )
+        reader.BookMVA("BDT",weightfilename)
 
-    # Clone the original chain (but don't copy any entries yet).
-    outputtree = inputtree.CloneTree(0)
 
-    # Create other derived branches in the new tree
-    for var in new_variables_list:
-            outputtree.Branch(var , maps[var],  '% s/F' % (var))
+        # Create the output file
+        print "creating file ",outputfilename
+        outputfile = TFile.Open(
+            outputfilename, 
+            'RECREATE'
+            )
 
-    if debug:
-        print "List of branches for output tree"
-        outputtree.GetListOfBranches().Print()
+        # Clone the original chain (but don't copy any entries yet).
+        outputtree = inputtree.CloneTree(0)
+
+        # Create other derived branches in the new tree
+        for var in new_variables_list:
+                outputtree.Branch(var , maps[var],  '% s/F' % (var))
+
+        if debug:
+            print "List of branches for output tree"
+            outputtree.GetListOfBranches().Print()
 
 
-    # Loop over the original tree.
-    max_index = inputtree.GetEntries()
-    # max_index=min(max_index,10) ; # print "DR hack max event",max_index
-    for i in xrange(0, max_index):
-        if i % 10000==1:
-            print " processing event ",i 
+        # Loop over the original tree.
+        max_index = inputtree.GetEntries()
+        # max_index=min(max_index,10) ; # print "DR hack max event",max_index
+        for i in xrange(0, max_index):
+            if i % 10000==1:
+                print " processing event ",i 
 
-        # Now actually load the tree data.  This needs to be done before
-        # doing any manual selections or calculations.
-        inputtree.GetEntry(i)
+            # Now actually load the tree data.  This needs to be done before
+            # doing any manual selections or calculations.
+            inputtree.GetEntry(i)
 
-        # copy the input tree variables into the arrays (might be a better way)
-        # actually this is not be necessary for variables that are not used by BDT
-        for var in varlist:
-            exec ('maps["'+var+'"][0]=inputtree.'+var)
+            # copy the input tree variables into the arrays
+            # actually this is not be necessary for variables that are not used by BDT
+            for var in varlist:
+                maps[var][0]=getattr(inputtree,var)
 
-        # compute bdt scoree    
-        maps['bdt'][0]=reader.EvaluateMVA("BDT")
+            # compute bdt scoree    
+            maps['bdt'][0]=reader.EvaluateMVA("BDT")
 
-        # Add this entry in the new tree
-        outputtree.Fill()
+            # Add this entry in the new tree
+            outputtree.Fill()
 
 
-    # Save the output file (required for data to be written)
-    outputfile.Write()
+        # Save the output file (required for data to be written)
+        outputfile.Write()
 
-    # Close the output file
-    outputfile.Close()
+        # Close the output file
+        outputfile.Close()
 
 
 # compute a threshold for the best AMS
 # plot the different AMS
-if dothreshold:
+def computethreshold():
     print " Step #4 : compute optimal threshold from score training file"
 
-    def amssimple(s,b):
-        from math import sqrt
-        if b==0:
-            return 0
-        return s/sqrt(float(b))
-
-    def amsasimov(s,b):
-        from math import sqrt,log
-        if b==0:
-            return 0
-
-        return sqrt(2*((s+b)*log(1+float(s)/b)-s))
-
-    def amsfinal(s,b):
-        return amsasimov(s,b+10.)
-
-    def printsig(s,b):
-        return "ams simple=%.3f asimov=%.3f final=%.3f" % (amssimple(s,b),amsasimov(s,b),amsfinal(s,b))
-
-    # function to return a vector of bin content of an histogram
-    def getbins ( h):
-        vals=[]
-        vales=[]
-        nbins=h.GetNbinsX()
-        # copy the bins. Note that bin 0 is the underflow, bin nbins+1 is overflow    
-        for i in range (0,nbins+2): 
-            vals+=[h.GetBinContent(i)]
-            vales+=[h.GetBinError(i)]            
-        underflow=h.GetBinContent(0)
-        overflow=h.GetBinContent(nbins+1)        
-        if underflow>0:
-            print " WARNING histo ", h.GetName(), " underflow non zero :",underflow," deliberate ?"
-        if overflow>0:    
-            print " WARNING histo ", h.GetName(), " overflow non zero :",overflow," deliberate ?"            
-        return vals,vales    
+    # the AMS is computed exactly at every distinct value of the score, from the sorted
+    # scores and cumulative sums of the weights (see higgsml_ams.py), no histogram binning
 
-    
-    inputfilename= filenamecsv+"_score.root"
-    inputfile = TFile.Open(inputfilename,"read")
-    inputtree    = inputfile.Get(treename)
-
-    nbins=1000
-    scoremin=-1
-    scoremax=1
-    hsig=TH1F("hsig","signal bdt score",nbins,scoremin,scoremax)
-    hbkg=TH1F("hbkg","background bdt score",nbins,scoremin,scoremax)    
-    # accumulate sum of square weigths
-    hsig.Sumw2()
-    hbkg.Sumw2()    
+    smoothing=0 # if >1, maximise the AMS averaged over this number of neighbouring thresholds
+    nfolds=0 # if >1, choose the threshold by cross validation on nfolds folds of the training sample
+    bootstrapReplicas=0 # if >0, number of bootstrap replicas to estimate the spread of the best threshold
 
     
-    # fill histograms, using weight, only for training sample
-    inputtree.Project("hsig","bdt","KaggleWeight*(Label==1 && KaggleSet==0)")
-    inputtree.Project("hbkg","bdt","KaggleWeight*(Label==0 && KaggleSet==0)")    
-
-    # copy into vectors
-    vsig,ve=getbins(hsig)
-    vbkg,ve=getbins(hbkg)    
-
-    # prepare other vectors
-    vsigint=[0]*(nbins+2)
-    vbkgint=[0]*(nbins+2)
-    vamsasimov=[0]*(nbins+2)
-    vamsfinal=[0]*(nbins+2)
-    vamssimple=[0]*(nbins+2)    
-
-    # signal has higher values than background. So integrate histograms from the right
-    sumsig=0
-    sumbkg=0
-    for i in range (nbins+1,-1,-1):
-        sumsig+=vsig[i]
-        vsigint[i]=sumsig
-        sumbkg+=vbkg[i]
-        vbkgint[i]=sumbkg
-        vamsasimov[i]=amsasimov(sumsig,sumbkg)
-        vamssimple[i]=amssimple(sumsig,sumbkg)
-        vamsfinal[i]=amsfinal(sumsig,sumbkg)        
-
-    hsigint=TH1F("hsigint","integrated signal vs bdt score",nbins,scoremin,scoremax)
-    hbkgint=TH1F("hbkgint","integrated bkg vs bdt score",nbins,scoremin,scoremax)        
-    hamsfinal=TH1F("hamsfinal","final ams vs bdt score",nbins,scoremin,scoremax)
-    hamsasimov=TH1F("hamsasimov","asimov ams vs bdt score",nbins,scoremin,scoremax)
-    hamssimple=TH1F("hamssimple","simple ams vs bdt score",nbins,scoremin,scoremax)
-
-    # copy vectors into histogram
-    for i in range(nbins+2):
-        hsigint.SetBinContent(i,vsigint[i])
-        hbkgint.SetBinContent(i,vbkgint[i])        
-        hamsfinal.SetBinContent(i,vamsfinal[i])
-        hamssimple.SetBinContent(i,vamssimple[i])
-        hamsasimov.SetBinContent(i,vamsasimov[i])        
+    if storage=="columnar":
+        # only the training sample, the two stores have the same partitions
+        columns=load_store(storename,["Label","KaggleWeight"],kagglesets=["t"])
+        columns.update(load_store(scorestorename,["bdt"],kagglesets=["t"]))
+        intrain=np.ones(len(columns["bdt"]),dtype=bool)
+    else:
+        inputfilename= filenamecsv+"_score.root"
+        inputfile = TFile.Open(inputfilename,"read")
+        inputtree    = inputfile.Get(treename)
+
+        # read the score and what is needed from the tree, only for training sample
+        columns=read_tree_columns(inputtree,["bdt","Label","KaggleSet","KaggleWeight"])
+        intrain=columns["KaggleSet"]==0
+    bdt=columns["bdt"][intrain]
+    issig=columns["Label"][intrain]==1
+    kaggleweight=columns["KaggleWeight"][intrain]
+
+    # signal has higher values than background, select bdt>threshold
+    best,curve=optimise_threshold(bdt,issig,kaggleweight,smoothing=smoothing)
 
     # one nice plot    
-    hamsfinal.SetLineColor(2)
-    hamssimple.SetLineColor(3)   
-    hamsfinal.Draw()
-    hamssimple.Draw("same")
-    hamsasimov.Draw("same")
+    gamsfinal=TGraph(len(curve["threshold"]),curve["threshold"].astype('d'),curve["ams"])
+    gamssimple=TGraph(len(curve["threshold"]),curve["threshold"].astype('d'),curve["amssimple"])
+    gamsasimov=TGraph(len(curve["threshold"]),curve["threshold"].astype('d'),curve["amsasimov"])
+    gamsfinal.SetTitle("final ams vs bdt score")
+    gamsfinal.SetLineColor(2)
+    gamssimple.SetLineColor(3)   
+    gamsfinal.Draw("AL")
+    gamssimple.Draw("L")
+    gamsasimov.Draw("L")
    
     # determine the optimal value
     # Note that we determine the optimal value on the same data as used for the training.
-    # There are many ways to do better
-    bestamsfinal=max(vamsfinal)
-    ibest=vamsfinal.index(bestamsfinal)
-    threshold=hamsfinal.GetBinLowEdge(ibest+1)
-    print "Best amsfinal ",bestamsfinal," for threshold :",threshold," ( ams simple =",vamssimple[ibest],", ams asimov=",vamsasimov[ibest],")"
+    # There are many ways to do better (smoothing, nfolds above, or out of fold scores: kfolds of the native trainer)
+    threshold=best["threshold"]
+    print "Best amsfinal ",best["ams"]," for threshold :",threshold," ( ams simple =",best["amssimple"],", ams asimov=",best["amsasimov"],")"
+    print " ",len(curve["threshold"])," thresholds scanned"
+
+    if nfolds>1:
+        threshold,folds=crossvalidate_threshold(bdt,issig,kaggleweight,nfolds,smoothing=smoothing)
+        print "Cross validation on ",nfolds," folds: thresholds ",folds["threshold"]
+        print " ams on held out folds ",folds["ams"]," mean ",folds["ams"].mean()," (ams where chosen ",folds["trainams"].mean(),")"
+        print " median threshold :",threshold
+
+    if bootstrapReplicas>0:
+        replicas=bootstrap_ams(bdt,issig,kaggleweight,threshold,bootstrapReplicas)
+        print "Bootstrap with ",bootstrapReplicas," replicas: best threshold ",summarise(replicas["threshold"])
+        print " ams at threshold ",summarise(replicas["ams"])
+
+    if debug:
+        # AMS per KaggleSet x jet category x weight at the threshold, and best threshold of each (see higgsml_report.py)
+        classtotals=None
+        if storage=="columnar":
+            # the u set has no score
+            allcolumns=load_store(storename,["Label","KaggleSet","PRI_jet_num","Weight","KaggleWeight"],kagglesets=["t","b","v"])
+            allcolumns["bdt"]=load_store(scorestorename,["bdt"])["bdt"]
+            # but its events count in the Weight totals of each class, as with the root file
+            labelweight=load_store(storename,["Label","Weight"])
+            classtotals={"Weight":np.bincount(labelweight["Label"],weights=labelweight["Weight"],minlength=2)}
+        else:
+            allcolumns=read_tree_columns(inputtree,["bdt","Label","KaggleSet","PRI_jet_num","Weight","KaggleWeight"])
+            allcolumns["KaggleSet"]=np.searchsorted([0,10,11,100],allcolumns["KaggleSet"]) # root codes to t b v u = 0 1 2 3
+        print format_breakdown(ams_breakdown(allcolumns,allcolumns["bdt"],threshold,classtotals=classtotals))
 
     print " Writing out threshold value ",threshold, " in pickle file:",picklename
     import pickle
-    pickle.dump(threshold,open (picklename,"wb"))
+    pickle.dump(float(threshold),open (picklename,"wb"))
 
 
 # create kaggle submission file (just for reference)
 # ranks all entries according to score
 # given a threshold, label entries "s" or "b"
-if dosubmission:
+def submission():
     print " Step #5 : generate csv file for kaggle submission, from optimal threshold and test score file"
     import pickle
     threshold=pickle.load( open( picklename, "rb" ) )
@@ -483,73 +518,57 @@ if dosubmission:
     inputfilename=filenamecsv+"_score.root"
     submissionfilename="submission_tmva.csv"
 
-    inputfile = TFile.Open(inputfilename,"read")
-    inputtree    = inputfile.Get(treename)
-
-
-    print  "Loop once to load the EventId, bdt score pairs"
-    max_index = inputtree.GetEntries()
-    testentries=[]
-    for i in xrange(0, max_index):
-        if i % 100000==1:
-            print " processing event ",i 
-        inputtree.GetEntry(i)
+    print  "Load the EventId, bdt score pairs"
+    if storage=="columnar":
+        # only the public and private datasets are read
+        columns=load_store(storename,["EventId"],kagglesets=["b","v"])
+        testid=columns["EventId"]
+        testbdt=load_store(scorestorename,["bdt"],kagglesets=["b","v"])["bdt"]
+    else:
+        inputfile = TFile.Open(inputfilename,"read")
+        inputtree    = inputfile.Get(treename)
+
+        columns=read_tree_columns(inputtree,["EventId","bdt","KaggleSet"])
         # only consider event from the public and private dataset
-        if inputtree.KaggleSet not in [10,11]:
-            continue
-        testentries+=[(inputtree.EventId,inputtree.bdt)]
-
-    # sort on the bdt,
-    print "sort on the bdt score"
-    testsorted=sorted(testentries,key=lambda entry: entry[1])
+        intest=np.isin(columns["KaggleSet"],[10,11])
+        testid=columns["EventId"][intest]
+        testbdt=columns["bdt"][intest]
 
-    # then build a map key Id, value rank
-    testdict={}
-    r=1 # kaggle ask to start at 1
-    for e in testsorted:
-        if r % 100000==1:
-            print " sorting event ",r 
+    # rank on the bdt (identical values ranked by EventId), label "s" above threshold
+    print "write the submission file",submissionfilename
+    nwritten=write_submission(submissionfilename,testid,testbdt,threshold)
+    print nwritten," events written"
 
-        testdict[e[0]]=r
-        r+=1
-
-        
-    print "size of dict",len(testdict)
-    if len(testdict)!=len(testsorted):
-        print " ERROR ! Size of input file : ",len(testsorted), " size of map : ",len(testdict), " Should be equal. Maybe identical values ? " 
-        raise Exception # should not happen
-
-
-    outputfile=open(submissionfilename,"w")
-    outputfile.write("EventId,RankOrder,Class\n")
-
-    print  "Loop again to write the submission file",submissionfilename
-    for i in xrange(0, max_index):
-        if i % 100000==1:
-            print " processing event ",i 
-                
-        inputtree.GetEntry(i)
-        if inputtree.KaggleSet not in [10,11]:
-            continue
-
-        rank=testdict[inputtree.EventId]
-        if rank>550000:
-            print "large rank: ",rank, " for event ",i, " ",inputtree.EventId
-            exit() # should not happen
-        
-        # compute label 
-        slabel="b"
-        if inputtree.bdt>threshold:
-            slabel="s"
-            
-        outputfile.write(str(inputtree.EventId)+",")
-        outputfile.write(str(rank)+",")
-        outputfile.write(slabel)            
-        outputfile.write("\n")
-
-    outputfile.close()
     print "All done!"
     # delete big objects
-    del testentries
-    del testdict
-    del testsorted
+    del columns,testid,testbdt
+
+
+# run the switched on steps which are not up to date
+# the hashes of the inputs and outputs of each step are kept in .higgsml_pipeline.json
+pipeline=Pipeline()
+if storage=="columnar":
+    # a store stands for its meta.json, which has the sha1 of all its columns
+    datafiles=[os.path.join(storename,"meta.json")]
+    scorefiles=datafiles+[os.path.join(scorestorename,"meta.json")]
+    scoreoutputs=scorefiles[1:]
+else:
+    datafiles=[filenamecsv+".root"]
+    scorefiles=scoreoutputs=[filenamecsv+"_score.root"]
+pipeline.step("csvtoroot",csvtoroot,[filenamecsv],datafiles,
+              {"treename":treename,"storage":storage},enabled=docsvtoroot,force=forcerun)
+if trainer=="native":
+    trainingoutputs=[weightfilename]+([oofname] if kfolds>1 else [])
+else:
+    trainingoutputs=[weightfilename,"tmvatest.root"]
+pipeline.step("training",training,datafiles,trainingoutputs,
+              {"treename":treename,"trainer":trainer,"ntrees":ntrees,"maxdepth":maxdepth,"learningrate":learningrate,
+               "kfolds":kfolds,"storage":storage},enabled=dotraining,force=forcerun)
+pipeline.step("evaluate",evaluate,datafiles+[f for f in trainingoutputs if f!="tmvatest.root"],scoreoutputs,
+              {"treename":treename,"debug":debug,"trainer":trainer,"kfolds":kfolds,"storage":storage},enabled=doevaluate,force=forcerun)
+pipeline.step("threshold",computethreshold,scorefiles,[picklename],
+              {"treename":treename,"storage":storage},enabled=dothreshold,force=forcerun)
+pipeline.step("submission",submission,scorefiles+[picklename],["submission_tmva.csv"],
+              {"treename":treename,"storage":storage},enabled=dosubmission,force=forcerun)
+ran=pipeline.run()
+print "steps run: ",ran
@@ -0,0 +1,180 @@
+"""
+ATLAS Higgs Machine Learning Challenge 2014
+
+Small incremental pipeline runner (used by higgsml_opendata_tmva.py)
+
+Each step is a function with a list of input files, a list of output files and parameters.
+When a step has run, the sha1 of its inputs, of its parameters (including the source code of
+the function) and of its outputs are recorded in a state file. Next time the step is skipped
+if all of them are unchanged, so e.g. changing the threshold only reruns the submission step.
+The sha1 of a file is only recomputed when its size or modification time changed.
+
+A step depends on the steps producing its inputs. Steps whose dependencies are done run
+concurrently in a pool of threads (nworkers>1), which should only be used for steps that
+are thread safe (ROOT is not).
+
+Typical use:
+    pipeline=Pipeline()
+    pipeline.step("convert",convert,inputs=["data.csv"],outputs=["data.root"],params={"chunksize":100000})
+    pipeline.step("train",train,inputs=["data.root"],outputs=["weights.xml"])
+    pipeline.run()
+"""
+
+import hashlib
+import inspect
+import json
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+
+from higgsml_data import file_hash
+from higgsml_instrument import stage
+
+
+STATEFILE = ".higgsml_pipeline.json"
+
+
+class Step(object):
+    """ a step of the pipeline """
+
+    def __init__(self, name, func, inputs, outputs, params, enabled, force):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = params or {}
+        self.enabled = enabled
+        self.force = force
+        self.dependencies = []
+
+
+class Pipeline(object):
+    """ a list of steps, run in order of their dependencies, skipped when up to date """
+
+    def __init__(self, statefile=STATEFILE, nworkers=1, verbose=True):
+        self.statefile = statefile
+        self.nworkers = nworkers
+        self.verbose = verbose
+        self.steps = []
+        self.lock = threading.Lock()
+        try:
+            with open(statefile) as f:
+                self.state = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.state = {}
+        self.state.setdefault("steps", {})
+        self.state.setdefault("files", {})
+
+    def log(self, *words):
+        if self.verbose:
+            print(" ".join(str(word) for word in words))
+
+    def step(self, name, func, inputs=(), outputs=(), params=None, enabled=True, force=False):
+        """ add a step, it depends on the previous steps which have one of its inputs as output
+        enabled : if False the step is never run (its outputs can still be used by later steps)
+        force : if True the step is run even if up to date """
+        step = Step(name, func, inputs, outputs, params, enabled, force)
+        for previous in self.steps:
+            if set(previous.outputs) & set(step.inputs):
+                step.dependencies += [previous]
+        self.steps += [step]
+        return step
+
+    def hash_file(self, filename):
+        """ sha1 of a file (None if it does not exist), recomputed only if size or time changed """
+        if not os.path.exists(filename):
+            return None
+        stat = os.stat(filename)
+        with self.lock:
+            known = self.state["files"].get(filename)
+        if known and known[0] == stat.st_size and known[1] == stat.st_mtime:
+            return known[2]
+        sha1 = file_hash(filename)
+        with self.lock:
+            self.state["files"][filename] = [stat.st_size, stat.st_mtime, sha1]
+        return sha1
+
+    def hash_params(self, step):
+        """ sha1 of the parameters and of the source code of the step function """
+        try:
+            source = inspect.getsource(step.func)
+        except (IOError, OSError, TypeError):
+            source = ""
+        text = json.dumps({"params": step.params, "source": source}, sort_keys=True, default=repr)
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def reason(self, step):
+        """ why the step has to run, None if it is up to date """
+        if step.force:
+            return "forced"
+        with self.lock:
+            recorded = self.state["steps"].get(step.name)
+        if recorded is None:
+            return "never run"
+        if recorded["params"] != self.hash_params(step):
+            return "parameters or code changed"
+        for filename in step.inputs:
+            if recorded["inputs"].get(filename) != self.hash_file(filename):
+                return "input %s changed" % filename
+        for filename in step.outputs:
+            sha1 = self.hash_file(filename)
+            if sha1 is None:
+                return "output %s missing" % filename
+            if recorded["outputs"].get(filename) != sha1:
+                return "output %s modified" % filename
+        return None
+
+    def record(self, step, inputs, params):
+        """ remember the hashes of a step which has just run """
+        outputs = dict((filename, self.hash_file(filename)) for filename in step.outputs)
+        with self.lock:
+            self.state["steps"][step.name] = {"inputs": inputs, "params": params, "outputs": outputs}
+            self.save()
+
+    def save(self):
+        tmpname = self.statefile + ".tmp"
+        with open(tmpname, "w") as f:
+            json.dump(self.state, f, indent=1, sort_keys=True)
+        os.rename(tmpname, self.statefile)
+
+    def run_step(self, step):
+        """ run the step if needed, return True if it ran """
+        if not step.enabled:
+            self.log("step", step.name, ": disabled")
+            return False
+        why = self.reason(step)
+        if why is None:
+            self.log("step", step.name, ": up to date, skipped")
+            return False
+        self.log("step", step.name, ": running (" + why + ")")
+        # hashes of the inputs and parameters as they are when the step starts
+        inputs = dict((filename, self.hash_file(filename)) for filename in step.inputs)
+        params = self.hash_params(step)
+        with stage(step.name):
+            step.func()
+        self.record(step, inputs, params)
+        return True
+
+    def run(self):
+        """ run all the steps, by waves of steps whose dependencies are done
+        Return the list of names of the steps which ran """
+        done = set()
+        ran = []
+        pool = ThreadPool(self.nworkers) if self.nworkers > 1 else None
+        try:
+            while len(done) < len(self.steps):
+                wave = [step for step in self.steps
+                        if step.name not in done and all(dep.name in done for dep in step.dependencies)]
+                if pool is not None and len(wave) > 1:
+                    results = pool.map(self.run_step, wave)
+                else:
+                    results = [self.run_step(step) for step in wave]
+                for step, result in zip(wave, results):
+                    done.add(step.name)
+                    if result:
+                        ran += [step.name]
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return ran
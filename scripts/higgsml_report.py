@@ -0,0 +1,123 @@
+"""
+ATLAS Higgs Machine Learning Challenge 2014
+
+AMS breakdown per KaggleSet, jet category (PRI_jet_num 0, 1, 2 or more) and weight variable
+
+ams_breakdown computes for every cell (KaggleSet, jet category, weight variable) the signal,
+background and AMS at a given threshold, and the best threshold of the cell with its AMS, all
+in one pass: the events are sorted on the score once, then regrouped by cell (a stable sort of
+small ints, the score order is kept inside each cell), and the weights above every threshold of
+every cell are cumulative sums from the right minus the sum at the end of the cell. The best
+point of each cell is a segment maximum. The whole table costs about one ams_curve.
+Weight is renormalised per KaggleSet and class to the totals of all the events (as KaggleWeight
+is, see higgsml_ams.renormalisation), so that the Weight and KaggleWeight cells can be compared.
+When the columns only have some of the KaggleSets, the totals of all the events are given as classtotals.
+
+Typical use:
+    from higgsml_report import ams_breakdown,format_breakdown
+    rows=ams_breakdown(columns,score,threshold)
+    print format_breakdown(rows)
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+from higgsml_ams import ams
+from higgsml_data import KAGGLESETS, LABELS
+from higgsml_jets import JET_CATEGORIES, jet_category
+
+
+WEIGHTS = ("Weight", "KaggleWeight")
+
+
+def _sums_above(values, positions, ends):
+    """ sum of values[position+1:end] for each position (values grouped in segments, end : end of its segment) """
+    # sum from the right, with a zero at the end
+    above = np.append(np.cumsum(values[::-1])[::-1], 0.)
+    return np.maximum(above[positions + 1] - above[ends], 0.)
+
+
+def ams_breakdown(columns, score, threshold=None, weights=WEIGHTS, renormalise=True, br=10., classtotals=None):
+    """ AMS table per KaggleSet x jet category x weight variable
+    columns : Label, KaggleSet, PRI_jet_num and the weight variables of the events of score
+    classtotals : dictionary weight variable -> totals per Label code (b, s) of all the events, for the
+    renormalisation (default the totals of the events of columns)
+    Return a list of rows (OrderedDict) kaggleset, jets, weight, nevents, signal, background, ams (at threshold,
+    if given) and bestthreshold, bestams, bestsignal, bestbackground (best threshold of the cell, score>threshold)
+    or an empty list if there are no events """
+    score = np.asarray(score)
+    if len(score) == 0:
+        return []
+    issig = np.asarray(columns["Label"]) == LABELS.index("s")
+    kaggleset = np.asarray(columns["KaggleSet"]).astype(np.intp)
+    ncats = len(JET_CATEGORIES)
+    cell = kaggleset * ncats + jet_category(columns["PRI_jet_num"])
+    ncells = len(KAGGLESETS) * ncats
+    counts = np.bincount(cell, minlength=ncells)
+
+    # sort on the score, then on the cell keeping the score order inside each cell
+    order = np.argsort(score, kind="mergesort")
+    order = order[np.argsort(cell[order], kind="mergesort")]
+    sortedscore = score[order]
+    sortedcell = cell[order]
+    sortedsig = issig[order]
+    # last event of each group of identical (cell, score): the thresholds
+    last = np.flatnonzero(np.append((sortedscore[1:] != sortedscore[:-1]) | (sortedcell[1:] != sortedcell[:-1]), True))
+    lastcell = sortedcell[last]
+    lastend = np.cumsum(counts)[lastcell]
+    # first threshold of each cell which has events
+    present, first = np.unique(lastcell, return_index=True)
+    selected = score > threshold if threshold is not None else None
+
+    rows = []
+    for var in weights:
+        weight = np.asarray(columns[var], dtype=np.float64)
+        if renormalise and var != "KaggleWeight":
+            # per (KaggleSet, class) factor: total of the class over all events / total in the KaggleSet
+            group = kaggleset * 2 + issig
+            totals = np.bincount(group, weights=weight, minlength=2 * len(KAGGLESETS))
+            if classtotals is not None and var in classtotals:
+                alltotals = np.asarray(classtotals[var], dtype=np.float64)
+            else:
+                alltotals = totals.reshape(-1, 2).sum(axis=0)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                scales = np.where(totals > 0, np.tile(alltotals, len(KAGGLESETS)) / totals, 0.)
+            weight = weight * scales[group]
+        sortedweight = weight[order]
+        # weight strictly above each threshold in its cell
+        sig = _sums_above(np.where(sortedsig, sortedweight, 0.), last, lastend)
+        bkg = _sums_above(np.where(sortedsig, 0., sortedweight), last, lastend)
+        curve = ams(sig, bkg, br)
+        best = np.full(ncells, -1, dtype=np.intp)
+        if len(last):
+            cellmax = np.maximum.reduceat(curve, first)
+            ismax = np.flatnonzero(curve == cellmax[np.searchsorted(present, lastcell)])
+            bestcells, bestfirst = np.unique(lastcell[ismax], return_index=True)
+            best[bestcells] = ismax[bestfirst]
+        if selected is not None:
+            selsig = np.bincount(cell[selected & issig], weights=weight[selected & issig], minlength=ncells)
+            selbkg = np.bincount(cell[selected & ~issig], weights=weight[selected & ~issig], minlength=ncells)
+        for icell in range(ncells):
+            row = OrderedDict([("kaggleset", KAGGLESETS[icell // ncats]),
+                               ("jets", "%d%s" % (JET_CATEGORIES[icell % ncats], "+" if icell % ncats == ncats - 1 else "")),
+                               ("weight", var), ("nevents", int(counts[icell]))])
+            if selected is not None:
+                row["signal"], row["background"] = float(selsig[icell]), float(selbkg[icell])
+                row["ams"] = float(ams(selsig[icell], selbkg[icell], br))
+            ibest = best[icell]
+            row["bestthreshold"] = float(sortedscore[last[ibest]]) if ibest >= 0 else None
+            row["bestams"] = float(curve[ibest]) if ibest >= 0 else 0.
+            row["bestsignal"] = float(sig[ibest]) if ibest >= 0 else 0.
+            row["bestbackground"] = float(bkg[ibest]) if ibest >= 0 else 0.
+            rows += [row]
+    return rows
+
+
+def format_breakdown(rows):
+    """ the rows of ams_breakdown as a text table """
+    keys = list(rows[0].keys()) if rows else []
+    lines = [" ".join("%14s" % key for key in keys)]
+    for row in rows:
+        lines += [" ".join("%14s" % (("%.6g" % value) if isinstance(value, float) else value)
+                           for value in row.values())]
+    return "\n".join(lines)
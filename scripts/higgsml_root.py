@@ -0,0 +1,204 @@
+"""
+ATLAS Higgs Machine Learning Challenge 2014
+
+Parallel conversion of the challenge csv file into a root file (step 1 of higgsml_opendata_tmva.py)
+
+The csv is first converted into the binary cache of higgsml_data.py. The rows are then split
+in chunks, each chunk is converted into its own small root file in a pool of processes, and
+the chunk files are merged into the final tree. A worker only reads its own rows from the
+memory-mapped cache, so the memory used is bounded by the chunk size.
+If root_numpy is installed the branches are filled from whole column arrays (array2tree),
+otherwise the chunk is filled event by event.
+
+Types in the root tree are the same as the original conversion: float variables are /F,
+EventId and PRI_jet_num are /I, Label is 1 for "s" 0 for "b", KaggleSet t b v u are 0 10 11 100
+(-999 for anything else). New variables defined by expressions (see higgsml_features.py) are
+computed once on whole columns and stored in the cache before the conversion.
+
+read_tree_columns and clone_tree_with_branches move whole columns between a tree and numpy
+arrays (step 3 of higgsml_opendata_tmva.py).
+"""
+
+import array
+import multiprocessing
+import os
+from collections import OrderedDict
+
+import numpy as np
+from higgsml_data import load_cached
+from higgsml_features import load_features
+from higgsml_instrument import instrumented, result_value
+
+
+# value in the tree of each code of the categorical variables, the last one is for UNKNOWN (code -1)
+ROOT_CODES = {"Label": [0, 1, -999], "KaggleSet": [0, 10, 11, 100, -999]}
+
+CHUNKSIZE = 100000
+
+
+def root_columns(columns, start=0, stop=None):
+    """ rows [start,stop) of the columns, converted to the types of the root tree (int32 or float32) """
+    converted = OrderedDict()
+    for var, col in columns.items():
+        col = np.asarray(col[start:stop])
+        if var in ROOT_CODES:
+            col = np.array(ROOT_CODES[var], dtype=np.int32)[col]
+        elif col.dtype.kind in "iu":
+            col = col.astype(np.int32)
+        else:
+            col = col.astype(np.float32)
+        converted[var] = col
+    return converted
+
+
+def write_tree(filename, treename, columns):
+    """ write the columns (int32 or float32 arrays) into a new root file with one tree, return the number of entries """
+    from ROOT import TFile, TTree
+    output_file = TFile(filename, "recreate")
+    try:
+        from root_numpy import array2tree
+    except ImportError:
+        array2tree = None
+
+    nentries = len(list(columns.values())[0]) if columns else 0
+    if array2tree is not None:
+        # whole columns at once
+        records = np.empty(nentries, dtype=[(var, col.dtype) for var, col in columns.items()])
+        for var, col in columns.items():
+            records[var] = col
+        tree = array2tree(records, name=treename)
+    else:
+        tree = TTree(treename, treename)
+        maps = {}
+        for var, col in columns.items():
+            if col.dtype == np.int32:
+                maps[var] = array.array("i", [0])
+                tree.Branch(var, maps[var], "%s/I" % var)
+            else:
+                maps[var] = array.array("f", [0.0])
+                tree.Branch(var, maps[var], "%s/F" % var)
+        branches = [(maps[var], col) for var, col in columns.items()]
+        for ientry in range(nentries):
+            for branch, col in branches:
+                branch[0] = col[ientry]
+            tree.Fill()
+    nentries = tree.GetEntries()
+    # Save and close the output file (required for data to be written)
+    output_file.Write()
+    output_file.Close()
+    return nentries
+
+
+def convert_chunk(args):
+    """ convert rows [start,stop) of the (cached) csv file into chunkname, return the number of entries """
+    filenamecsv, treename, start, stop, chunkname, newvars = args
+    # the new variables come first, as in the original conversion
+    columns = load_features(filenamecsv, newvars)
+    columns.update(load_cached(filenamecsv)[0])
+    return write_tree(chunkname, treename, root_columns(columns, start, stop))
+
+
+def merge_trees(output_name, treename, filenames):
+    """ merge the trees of several root files into output_name """
+    from ROOT import TChain
+    chain = TChain(treename)
+    for filename in filenames:
+        chain.Add(filename)
+    chain.Merge(output_name, "fast")
+
+
+@instrumented("convert", rows=result_value)
+def csv_to_root(filenamecsv, output_name, treename, newvars=(), chunksize=CHUNKSIZE, nworkers=None):
+    """ convert the csv file into tree treename of root file output_name
+    newvars : list of (name, expression) pairs for new float variables, see higgsml_features.py
+    chunksize : number of rows converted at a time by a worker
+    nworkers : number of processes (default number of cores), 1 to convert in this process
+    Return the number of entries written """
+    # build the cache and compute the new variables once, before starting the workers
+    columns, meta = load_cached(filenamecsv)
+    load_features(filenamecsv, newvars)
+    del columns
+    nrows = meta["nrows"]
+    chunks = []
+    for ichunk, start in enumerate(range(0, max(nrows, 1), chunksize)):
+        chunkname = "%s.chunk%04d.root" % (output_name, ichunk)
+        chunks += [(filenamecsv, treename, start, min(start + chunksize, nrows), chunkname, newvars)]
+
+    if nworkers == 1 or len(chunks) == 1:
+        nentries = [convert_chunk(chunk) for chunk in chunks]
+    else:
+        pool = multiprocessing.Pool(nworkers)
+        try:
+            nentries = pool.map(convert_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+
+    chunknames = [chunk[4] for chunk in chunks]
+    if os.path.exists(output_name):
+        os.remove(output_name)
+    merge_trees(output_name, treename, chunknames)
+    for chunkname in chunknames:
+        os.remove(chunkname)
+    return sum(nentries)
+
+
+def read_tree_columns(tree, branches):
+    """ read some branches of a tree into an OrderedDict branch name -> numpy array
+    (with root_numpy if installed, event by event otherwise) """
+    try:
+        from root_numpy import tree2array
+    except ImportError:
+        tree2array = None
+    branches = list(branches)
+    if tree2array is not None:
+        records = tree2array(tree, branches=branches)
+        return OrderedDict((var, records[var]) for var in branches)
+
+    nentries = tree.GetEntries()
+    columns = OrderedDict((var, np.empty(nentries, dtype=np.float64)) for var in branches)
+    # only read the needed branches
+    tree.SetBranchStatus("*", 0)
+    for var in branches:
+        tree.SetBranchStatus(var, 1)
+    for ientry in range(nentries):
+        tree.GetEntry(ientry)
+        for var, col in columns.items():
+            col[ientry] = getattr(tree, var)
+    tree.SetBranchStatus("*", 1)
+    return columns
+
+
+def clone_tree_with_branches(inputtree, outputfilename, newcolumns):
+    """ write into outputfilename a copy of inputtree with new float branches filled from arrays
+    newcolumns : OrderedDict branch name -> array (one entry per event of inputtree) """
+    from ROOT import TFile
+    try:
+        from root_numpy import array2tree
+    except ImportError:
+        array2tree = None
+    nentries = inputtree.GetEntries()
+    outputfile = TFile.Open(outputfilename, "RECREATE")
+    if array2tree is not None:
+        # copy the tree as is, then add the new branches from the whole arrays
+        outputtree = inputtree.CloneTree(-1, "fast")
+        records = np.empty(nentries, dtype=[(var, np.float32) for var in newcolumns])
+        for var, col in newcolumns.items():
+            records[var] = col
+        array2tree(records, tree=outputtree)
+    else:
+        # Clone the original tree (but don't copy any entries yet).
+        outputtree = inputtree.CloneTree(0)
+        maps = {}
+        for var in newcolumns:
+            maps[var] = array.array("f", [0.0])
+            outputtree.Branch(var, maps[var], "%s/F" % var)
+        branches = [(maps[var], col) for var, col in newcolumns.items()]
+        for ientry in range(nentries):
+            inputtree.GetEntry(ientry)
+            for branch, col in branches:
+                branch[0] = col[ientry]
+            outputtree.Fill()
+    # Save and close the output file (required for data to be written)
+    outputfile.Write()
+    outputfile.Close()
@@ -0,0 +1,224 @@
+"""
+ATLAS Higgs Machine Learning Challenge 2014
+
+Search of the options of the gradient boosted trees of higgsml_gbt.py (number of trees, depth,
+learning rate, minimum node weight), on a grid or at random
+
+The training events are binned once (higgsml_gbt.bin_columns), the binned data is shared by a
+pool of processes, each running one trial at a time. A trial trains on a part of the events and
+computes the best AMS of the others (validation, weights renormalised to the full set) every
+few trees, it stops when the AMS does not improve any more, or early when it is below prune times
+the best AMS reached with the same number of trees by the trials already finished (after a few
+checks).
+Each finished trial is appended to a json lines file, trials already in the file are not run
+again, so an interrupted search is resumed by running it again. Trials which failed (e.g. a worker
+killed for lack of memory) are recorded with their error and run again by the next search.
+
+Typical use:
+    python higgsml_search.py atlas-higgs-challenge-2014-v2.csv [ntrials] [resultfile]
+or in the code:
+    trials=random_trials(SPACE,50)
+    results=search(binned,issig,kaggleweight,edges,variables,trials,"search.jsonl")
+    print results[0]["params"],results[0]["ams"]
+"""
+
+import ctypes
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from collections import OrderedDict
+
+import numpy as np
+from higgsml_gbt import shared_array, bin_columns, train_binned
+from higgsml_ams import renormalisation
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+
+# values tried for each option of train_binned
+SPACE = OrderedDict([
+    ("ntrees", [100, 200, 400, 800]),
+    ("maxdepth", [3, 4, 5, 6, 8]),
+    ("learningrate", [0.02, 0.05, 0.1, 0.2]),
+    ("minnodeweight", [0.2, 1., 5., 20.]),
+])
+RESULTFILE = "higgsml_search.jsonl"
+# fraction of the events used for validation
+VALIDFRACTION = 0.3
+CHECKEVERY = 10
+PATIENCE = 5
+# a trial is stopped if its AMS is below PRUNE times the best AMS of the finished trials with as many trees
+PRUNE = 0.9
+
+# data shared by the worker processes
+_searchdata = None
+
+
+def grid_trials(space=SPACE):
+    """ all the combinations of the values of space, list of OrderedDict option -> value """
+    return [OrderedDict(zip(space.keys(), values)) for values in itertools.product(*space.values())]
+
+
+def random_trials(space=SPACE, ntrials=20, seed=0):
+    """ ntrials distinct random combinations of the values of space (all of them if there are fewer) """
+    grid = grid_trials(space)
+    order = np.random.RandomState(seed).permutation(len(grid))
+    return [grid[i] for i in order[:ntrials]]
+
+
+def trial_key(params):
+    return json.dumps(params, sort_keys=True)
+
+
+def load_results(filename):
+    """ the trials of a result file, dictionary key (see trial_key) -> result (with an entry error if it failed) """
+    results = {}
+    if os.path.exists(filename):
+        with open(filename) as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    continue  # last line of an interrupted search
+                results[trial_key(result["params"])] = result
+    return results
+
+
+def _init_search_worker(shared, nvars, edges, variables):
+    global _searchdata
+    _searchdata = {"binned": np.ctypeslib.as_array(shared["binned"]).reshape(nvars, -1),
+                   "edges": edges, "variables": variables}
+    for key in ["label", "weight", "valid"]:
+        _searchdata[key] = np.ctypeslib.as_array(shared[key])
+
+
+def _run_trial(task):
+    """ train with the options of the trial, return the result (a dictionary) """
+    params, reference, checkevery, patience, prune = task
+    d = _searchdata
+    valid = d["valid"] == 1
+    issig = d["label"] == 1
+    start = time.time()
+    history = []
+    pruned = []
+
+    def monitor(ntrees, ams):
+        history.append((ntrees, ams))
+        # not before a few checks, the first trees of slow trials are not representative
+        if prune > 0 and len(history) >= patience and str(ntrees) in reference and ams < prune * reference[str(ntrees)]:
+            pruned.append(ntrees)
+        return bool(pruned)
+
+    try:
+        # weights of each part renormalised to the total of all the events, as KaggleWeight
+        sigscale, bkgscale = renormalisation(d["weight"], issig, valid)
+        validweight = d["weight"][valid] * np.where(issig[valid], sigscale, bkgscale)
+        # the shared binned data is not copied, the training and validation events are given by their rows
+        forest = train_binned(d["binned"], d["label"][~valid], d["weight"][~valid], d["edges"], d["variables"],
+                              nworkers=1, rows=np.flatnonzero(~valid),
+                              validation=(d["binned"], d["label"][valid], validweight, np.flatnonzero(valid)),
+                              checkevery=checkevery, patience=patience, monitor=monitor, **params)
+    except Exception:
+        return {"params": params, "error": traceback.format_exc()}
+    best = max(history, key=lambda point: point[1]) if history else (len(forest.roots), 0.)
+    return {"params": params, "ams": best[1], "besttrees": best[0], "history": history,
+            "pruned": bool(pruned), "time": time.time() - start}
+
+
+def search(binned, label, weight, edges, variables, trials, resultfile=RESULTFILE, validfraction=VALIDFRACTION,
+           seed=0, nworkers=None, checkevery=CHECKEVERY, patience=PATIENCE, prune=PRUNE, verbose=True):
+    """ run the trials (list of options of train_binned) not already in resultfile, in a pool of nworkers processes
+    Return the results of all the trials of the file, best AMS first """
+    results = load_results(resultfile)
+    # the trials which failed are run again
+    failed = set(key for key, result in results.items() if "error" in result)
+    for key in failed:
+        del results[key]
+    todo = [params for params in trials if trial_key(params) not in results]
+    if verbose:
+        print("%d trials, %d already done, %d failed before and run again" %
+              (len(trials), len(trials) - len(todo), len([params for params in todo if trial_key(params) in failed])))
+    valid = np.random.RandomState(seed).rand(len(label)) < validfraction
+    shared = {"binned": shared_array(binned, ctypes.c_uint8),
+              "label": shared_array(np.asarray(label, dtype=np.float64), "d"),
+              "weight": shared_array(np.asarray(weight, dtype=np.float64), "d"),
+              "valid": shared_array(valid.astype(np.int32), "i")}
+    initargs = (shared, binned.shape[0], edges, variables)
+
+    def reference():
+        """ best AMS of the finished trials for each number of trees """
+        best = {}
+        for result in results.values():
+            for ntrees, ams in result.get("history", []):
+                best[str(ntrees)] = max(best.get(str(ntrees), 0.), ams)
+        return best
+
+    def finished(result):
+        results[trial_key(result["params"])] = result
+        with open(resultfile, "a") as f:
+            f.write(json.dumps(result, sort_keys=True) + "\n")
+        if verbose:
+            print("%s : %s" % (trial_key(result["params"]), "error" if "error" in result else
+                               "ams %.4f with %d trees%s (%.1f s)" % (result["ams"], result["besttrees"],
+                                                                    ", pruned" if result["pruned"] else "", result["time"])))
+
+    nworkers = nworkers or multiprocessing.cpu_count()
+    if nworkers > 1 and len(todo) > 1:
+        # a trial is only started when a worker is free, with the results known at that time
+        pool = multiprocessing.Pool(nworkers, _init_search_worker, initargs)
+        done = Queue()
+        try:
+            running = {}  # key -> (params, async result) of the trials started
+            while todo or running:
+                while todo and len(running) < nworkers:
+                    params = todo.pop(0)
+                    running[trial_key(params)] = (params, pool.apply_async(
+                        _run_trial, ((params, reference(), checkevery, patience, prune),), callback=done.put))
+                try:
+                    result = done.get(timeout=1)
+                except Empty:
+                    # a trial failing outside of _run_trial (e.g. its result cannot be sent back) has no callback
+                    for key, (params, trial) in list(running.items()):
+                        if trial.ready() and not trial.successful():
+                            try:
+                                trial.get()
+                            except Exception:
+                                finished({"params": params, "error": traceback.format_exc()})
+                            del running[key]
+                    continue
+                del running[trial_key(result["params"])]
+                finished(result)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        _init_search_worker(*initargs)
+        for params in todo:
+            finished(_run_trial((params, reference(), checkevery, patience, prune)))
+    nerrors = len([result for result in results.values() if "error" in result])
+    if verbose and nerrors:
+        print("%d trials failed (errors in %s), they are run again by the next search" % (nerrors, resultfile))
+    return sorted([result for result in results.values() if "error" not in result], key=lambda result: -result["ams"])
+
+
+if __name__ == "__main__":
+    from higgsml_data import load_cached
+    filename = sys.argv[1] if len(sys.argv) > 1 else "atlas-higgs-challenge-2014-v2.csv"
+    ntrials = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    resultfile = sys.argv[3] if len(sys.argv) > 3 else RESULTFILE
+    columns, meta = load_cached(filename)
+    variables = [var for var in columns if var.startswith("DER_") or var.startswith("PRI_")]
+    intrain = columns["KaggleSet"] == 0
+    edges, binned = bin_columns(dict((var, columns[var][intrain]) for var in variables), variables)
+    results = search(binned, columns["Label"][intrain] == 1, columns["KaggleWeight"][intrain], edges, variables,
+                     random_trials(SPACE, ntrials), resultfile)
+    print("best trials:")
+    for result in results[:5]:
+        print("%s ams %.4f with %d trees" % (trial_key(result["params"]), result["ams"], result["besttrees"]))
@@ -0,0 +1,157 @@
+"""
+ATLAS Higgs Machine Learning Challenge 2014
+
+Columnar storage of the events, partitioned on disk by KaggleSet and jet category
+
+A store is a directory with one .npy file per variable and partition, the partitions being
+the KaggleSet (t, b, v, u) x jet category (PRI_jet_num 0, 1, 2 or more) combinations:
+  meta.json                                  variables, dtypes, rows and sha1 of each column of each partition
+  KaggleSet=t/PRI_jet_num=0/EventId.npy      ...
+  KaggleSet=b/PRI_jet_num=2/DER_mass_MMC.npy (PRI_jet_num=2 holds the events with 2 jets or more)
+Inside a partition the events keep the order of the csv file. load_store only opens the files
+of the requested variables in the requested partitions (memory-mapped), so that each step only
+reads what it uses, e.g. the evaluation reads the features and EventId of the b and v sets and
+never touches the weights, the labels or the t and u sets. The float variables are float32 as
+in the root tree, Label and KaggleSet are the int8 codes of higgsml_data (index in LABELS and
+KAGGLESETS), so the KaggleSet of a partition is known from its directory.
+New variables computed on some partitions (e.g. the score) go into another store with the same
+partitioning (write_like), loading the same partitions of both gives aligned columns.
+meta.json changes whenever the content changes (it has the sha1 of every column), it can be
+used as the file standing for the store (e.g. as input or output of a higgsml_pipeline step).
+
+Typical use:
+    from higgsml_store import csv_to_store,load_store,write_like
+    csv_to_store("atlas-higgs-challenge-2014-v2.csv","atlas-higgs-challenge-2014-v2.csv.parts")
+    columns=load_store("atlas-higgs-challenge-2014-v2.csv.parts",["EventId","DER_mass_MMC"],kagglesets=["b","v"])
+    write_like("score.parts","atlas-higgs-challenge-2014-v2.csv.parts",{"bdt":score},kagglesets=["b","v"])
+"""
+
+import hashlib
+import os
+import shutil
+from collections import OrderedDict
+
+import numpy as np
+from higgsml_data import KAGGLESETS, load_cached, read_cache_meta, write_cache_meta
+from higgsml_features import load_features
+from higgsml_instrument import instrumented, result_value
+from higgsml_jets import JET_CATEGORIES, jet_category
+
+
+# version of the store layout
+STORE_VERSION = 1
+
+
+def partition_dir(kaggleset, jets):
+    """ directory of a partition, relative to the store """
+    return os.path.join("KaggleSet=%s" % kaggleset, "PRI_jet_num=%d" % jets)
+
+
+def read_store_meta(dirname):
+    """ return the metadata of a store, raise IOError if there is none """
+    meta = read_cache_meta(dirname)
+    if meta is None or meta.get("version") != STORE_VERSION:
+        raise IOError("%s is not a store (or an older version), rebuild it" % dirname)
+    return meta
+
+
+def select_partitions(meta, kagglesets=None, jets=None):
+    """ the partitions (meta entries) of the requested KaggleSets and jet categories, in the store order """
+    return [part for part in meta["partitions"]
+            if (kagglesets is None or part["kaggleset"] in kagglesets) and (jets is None or part["jets"] in jets)]
+
+
+def _write_partitions(dirname, partitions, header, column, extra):
+    """ write the variables of header into a new store, column(var) : its values, the partitions one after the other """
+    tmpdir = dirname + ".tmp%d" % os.getpid()
+    if os.path.exists(tmpdir):
+        shutil.rmtree(tmpdir)
+    os.makedirs(tmpdir)
+    bounds = np.append(0, np.cumsum([part["nrows"] for part in partitions]))
+    meta = {"version": STORE_VERSION, "header": list(header), "dtypes": {}, "partitions": []}
+    meta.update(extra)
+    entries = [{"kaggleset": part["kaggleset"], "jets": part["jets"], "nrows": int(stop - start), "sha1": {}}
+               for part, start, stop in zip(partitions, bounds[:-1], bounds[1:])]
+    for entry in entries:
+        os.makedirs(os.path.join(tmpdir, partition_dir(entry["kaggleset"], entry["jets"])))
+    # one variable at a time, written partition by partition
+    for var in header:
+        values = column(var)
+        meta["dtypes"][var] = values.dtype.str
+        for entry, start, stop in zip(entries, bounds[:-1], bounds[1:]):
+            part = np.ascontiguousarray(values[start:stop])
+            np.save(os.path.join(tmpdir, partition_dir(entry["kaggleset"], entry["jets"]), var + ".npy"), part)
+            entry["sha1"][var] = hashlib.sha1(part.tobytes()).hexdigest()
+    meta["partitions"] = entries
+    write_cache_meta(tmpdir, meta)
+    if os.path.exists(dirname):
+        shutil.rmtree(dirname)
+    os.rename(tmpdir, dirname)
+    return meta
+
+
+def write_store(dirname, columns, float_dtype=np.float32, extra=None):
+    """ write the columns (with the KaggleSet codes and PRI_jet_num) into a new store partitioned on them
+    float variables are converted to float_dtype. Return the metadata """
+    category = np.asarray(columns["KaggleSet"]).astype(np.intp) * len(JET_CATEGORIES) + \
+        jet_category(columns["PRI_jet_num"])
+    order = np.argsort(category, kind="mergesort")  # keeps the file order inside each partition
+    counts = np.bincount(category, minlength=len(KAGGLESETS) * len(JET_CATEGORIES))
+    partitions = [{"kaggleset": KAGGLESETS[icell // len(JET_CATEGORIES)],
+                   "jets": JET_CATEGORIES[icell % len(JET_CATEGORIES)], "nrows": int(count)}
+                  for icell, count in enumerate(counts)]
+
+    def column(var):
+        values = np.asarray(columns[var])
+        return (values.astype(float_dtype) if values.dtype.kind == "f" else values)[order]
+
+    return _write_partitions(dirname, partitions, list(columns), column, extra or {})
+
+
+@instrumented("convert", rows=result_value)
+def csv_to_store(filenamecsv, dirname, newvars=(), float_dtype=np.float32):
+    """ convert the csv file (through its binary cache) into a store
+    newvars : list of (name, expression) pairs for new float variables, see higgsml_features.py
+    Return the number of rows written """
+    columns = load_features(filenamecsv, newvars)
+    base, meta = load_cached(filenamecsv)
+    columns.update(base)
+    write_store(dirname, columns, float_dtype, {"source": meta["source"], "sourcesha1": meta["sha1"]})
+    return meta["nrows"]
+
+
+def load_store(dirname, variables=None, kagglesets=None, jets=None, mmap=True):
+    """ read the variables (default all) of the partitions of the given KaggleSets (e.g. ["b","v"]) and jet
+    categories (e.g. [0], default all), concatenated in the store order (by KaggleSet, then jet category)
+    Return an OrderedDict variable -> numpy array (read-only memory-map if mmap and a single partition) """
+    meta = read_store_meta(dirname)
+    variables = meta["header"] if variables is None else list(variables)
+    for var in variables:
+        if var not in meta["dtypes"]:
+            raise KeyError("%s is not in the store %s" % (var, dirname))
+    partitions = [part for part in select_partitions(meta, kagglesets, jets) if part["nrows"] > 0]
+    columns = OrderedDict()
+    for var in variables:
+        arrays = [np.load(os.path.join(dirname, partition_dir(part["kaggleset"], part["jets"]), var + ".npy"),
+                          mmap_mode="r" if mmap else None) for part in partitions]
+        if len(arrays) == 1:
+            columns[var] = arrays[0]
+        elif arrays:
+            columns[var] = np.concatenate(arrays)
+        else:
+            columns[var] = np.empty(0, dtype=np.dtype(str(meta["dtypes"][var])))
+    return columns
+
+
+def write_like(dirname, reference, columns, kagglesets=None, jets=None):
+    """ write into a new store the columns computed on the partitions of the reference store given by kagglesets
+    and jets, in the order of load_store(reference,...,kagglesets,jets) (e.g. the score of these events)
+    Return the metadata """
+    meta = read_store_meta(reference)
+    partitions = select_partitions(meta, kagglesets, jets)
+    nrows = sum(part["nrows"] for part in partitions)
+    for var, values in columns.items():
+        if len(values) != nrows:
+            raise ValueError("%s has %d rows, the partitions of %s have %d" % (var, len(values), reference, nrows))
+    return _write_partitions(dirname, partitions, list(columns), lambda var: np.asarray(columns[var]),
+                             {"reference": os.path.abspath(reference)})
@@ -0,0 +1,348 @@
+"""
+ATLAS Higgs Machine Learning Challenge 2014
+
+Out-of-core processing of files larger than the memory
+
+iter_blocks yields the columns of a csv file (or of its binary cache, see higgsml_data.py) in
+blocks of a fixed number of rows, chosen from a memory budget, so that the memory used does not
+depend on the size of the file. The cache is read with plain file reads, not memory-mapped.
+The accumulators then work one block at a time (and can be merged, e.g. from several processes):
+  WeightSums     sums of Weight and KaggleWeight per Label and KaggleSet (as in the cache metadata)
+  SelectionSums  signal and background weight selected with score>threshold, and the AMS
+  Histogram      weighted signal and background histogram of a variable (or of the score), and the
+                 AMS with each bin edge as threshold (exact at the edges, unlike a scan in memory
+                 the thresholds are not all the distinct scores)
+  AMSTracker     signal and background weight over a fine uniform binning of the score in Fenwick
+                 trees: adding events costs log(bins) each, the weight above any threshold and its AMS
+                 log(bins), the full AMS curve and the best threshold one cumulative pass over
+                 the bins; the memory only depends on the number of bins
+external_sort sorts (score, EventId) pairs by writing sorted runs on disk and merging them a
+block at a time, it is used by higgsml_submission.write_submission_stream to rank the events.
+
+Typical use:
+    from higgsml_stream import iter_blocks,Histogram
+    hist=Histogram(np.linspace(-200.,0.,2001))
+    for block in iter_blocks("big.csv",["DER_mass_MMC","Label","KaggleWeight"],memory=256<<20):
+        hist.add(-np.abs(block["DER_mass_MMC"]-125.),block["Label"]==1,block["KaggleWeight"])
+    best=best_point(hist.ams_curve())
+    tracker=AMSTracker(-1.,1.) # e.g. BDT score
+    for score,issig,weight in batches:
+        tracker.add(score,issig,weight)
+        print tracker.best()["threshold"],tracker.best()["ams"]
+"""
+
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+from higgsml_data import (BLOCKSIZE, BlockParser, add_sums, check_cache, default_cachedir, iter_line_blocks,
+                          read_header, weight_sums)
+from higgsml_ams import ams, amssimple, amsasimov, best_point
+from higgsml_input import open_input
+
+
+# default memory budget (bytes) of a block and of its processing
+MEMORY = 256 << 20
+# bytes needed per field of a block (text, parsed values, typed column and the temporaries of a computation)
+BYTES_PER_FIELD = 64
+
+
+def block_rows(memory, nvar):
+    """ number of rows of a block of nvar variables within the memory budget """
+    return max(1000, int(memory // (BYTES_PER_FIELD * max(nvar, 1))))
+
+
+def rechunk(blocks, blockrows):
+    """ regroup a sequence of column blocks of any size into blocks of exactly blockrows rows (except the last) """
+    pending = []
+    npending = 0
+    for block in blocks:
+        pending += [block]
+        npending += len(next(iter(block.values())))
+        while npending >= blockrows:
+            merged = OrderedDict((var, np.concatenate([b[var] for b in pending])) for var in block)
+            yield OrderedDict((var, col[:blockrows]) for var, col in merged.items())
+            rest = OrderedDict((var, col[blockrows:]) for var, col in merged.items())
+            pending = [rest]
+            npending -= blockrows
+    if npending > 0:
+        yield OrderedDict((var, np.concatenate([b[var] for b in pending])) for var in pending[0])
+
+
+def iter_csv_blocks(filename, variables=None, blockrows=None, memory=MEMORY, float_dtype=np.float64):
+    """ yield the columns of the csv file as OrderedDict blocks of blockrows rows (default from the memory budget) """
+    with open_input(filename) as f:
+        header = read_header(f)
+        parser = BlockParser(header, float_dtype)
+        keep = header if variables is None else [var for var in header if var in variables]
+        blockrows = blockrows or block_rows(memory, len(header))
+
+        def parsed():
+            # the whole line has to be parsed, the text read at a time is a fraction of the budget
+            for block in iter_line_blocks(f, min(BLOCKSIZE, max(memory // 8, 1 << 16))):
+                columns = parser.parse(block)
+                yield OrderedDict((var, columns[var]) for var in keep)
+
+        for block in rechunk(parsed(), blockrows):
+            yield block
+
+
+def open_npy(filename):
+    """ open a .npy file for reading, return the file object positioned on the data, the dtype and the shape """
+    f = open(filename, "rb")
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+    else:
+        shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+    return f, dtype, shape
+
+
+def iter_cache_blocks(filename, variables=None, blockrows=None, memory=MEMORY, cachedir=None):
+    """ yield the columns of the binary cache of filename as OrderedDict blocks of blockrows rows
+    (the cache has to exist and be up to date, see higgsml_data.load_cached) """
+    cachedir = cachedir or default_cachedir(filename)
+    meta = check_cache(filename, cachedir)
+    if meta is None:
+        raise IOError("no up to date cache %s for %s" % (cachedir, filename))
+    keep = [var for var in meta["header"] if variables is None or var in variables]
+    blockrows = blockrows or block_rows(memory, len(keep))
+    files = OrderedDict((var, open_npy(os.path.join(cachedir, var + ".npy"))) for var in keep)
+    try:
+        for start in range(0, meta["nrows"], blockrows):
+            count = min(blockrows, meta["nrows"] - start)
+            yield OrderedDict((var, np.fromfile(f, dtype=dtype, count=count)) for var, (f, dtype, shape) in files.items())
+    finally:
+        for f, dtype, shape in files.values():
+            f.close()
+
+
+def iter_blocks(filename, variables=None, blockrows=None, memory=MEMORY, usecache=True, float_dtype=np.float64):
+    """ yield the columns of the file in blocks, from the binary cache if it is up to date (and usecache),
+    from the csv file otherwise """
+    if usecache and os.path.exists(default_cachedir(filename)) and check_cache(filename) is not None:
+        return iter_cache_blocks(filename, variables, blockrows, memory)
+    return iter_csv_blocks(filename, variables, blockrows, memory, float_dtype)
+
+
+class WeightSums(object):
+    """ sums of Weight and KaggleWeight per Label and KaggleSet, accumulated block by block """
+
+    def __init__(self):
+        self.sums = {}
+
+    def add(self, block):
+        add_sums(self.sums, weight_sums(block))
+
+    def merge(self, other):
+        add_sums(self.sums, other.sums)
+
+
+class SelectionSums(object):
+    """ signal and background weight of the events with score>threshold, accumulated block by block """
+
+    def __init__(self, threshold, sigscale=1., bkgscale=1.):
+        self.threshold = threshold
+        self.sigscale = sigscale
+        self.bkgscale = bkgscale
+        self.signal = 0.
+        self.background = 0.
+
+    def add(self, score, issig, weight):
+        selected = np.asarray(score) > self.threshold
+        issig = np.asarray(issig, dtype=bool)
+        weight = np.asarray(weight, dtype=np.float64)
+        self.signal += weight[selected & issig].sum() * self.sigscale
+        self.background += weight[selected & ~issig].sum() * self.bkgscale
+
+    def merge(self, other):
+        self.signal += other.signal
+        self.background += other.background
+
+    def ams(self, br=10.):
+        return ams(self.signal, self.background, br)
+
+
+class Histogram(object):
+    """ weighted histogram of the signal and of the background, accumulated block by block
+    bin i counts edges[i-1] < value <= edges[i] (bin 0 is below the first edge, the last bin above the last edge)
+    so that the sum of the bins above i is exactly the weight selected by value>edges[i] """
+
+    def __init__(self, edges):
+        self.edges = np.asarray(edges, dtype=np.float64)
+        self.signal = np.zeros(len(self.edges) + 1)
+        self.background = np.zeros(len(self.edges) + 1)
+
+    def add(self, values, issig, weight):
+        index = np.searchsorted(self.edges, np.asarray(values), side="left")
+        issig = np.asarray(issig, dtype=bool)
+        weight = np.asarray(weight, dtype=np.float64)
+        self.signal += np.bincount(index[issig], weights=weight[issig], minlength=len(self.signal))
+        self.background += np.bincount(index[~issig], weights=weight[~issig], minlength=len(self.background))
+
+    def merge(self, other):
+        self.signal += other.signal
+        self.background += other.background
+
+    def ams_curve(self, sigscale=1., bkgscale=1., br=10.):
+        """ same as higgsml_ams.ams_curve, with the bin edges as thresholds """
+        # weight above each edge, sum from the right
+        sig = np.cumsum(self.signal[::-1])[::-1][1:] * sigscale
+        bkg = np.cumsum(self.background[::-1])[::-1][1:] * bkgscale
+        return {"threshold": self.edges, "ams": ams(sig, bkg, br), "signal": sig, "background": bkg,
+                "amssimple": amssimple(sig, bkg), "amsasimov": amsasimov(sig, bkg)}
+
+
+class AMSTracker(object):
+    """ online AMS of a stream of scored events, over nbins uniform bins of the score between low and high
+    (scores outside go to the first or last bin), exact up to the bin width
+    Bin i (1 to nbins) covers low+(i-1)*width < score <= low+i*width (as Histogram), so that the bins above an
+    edge are exactly the events selected by score>edge.
+    The trees are indexed from the top bin, so that a prefix sum is directly the weight above a threshold """
+
+    def __init__(self, low, high, nbins=1 << 16, sigscale=1., bkgscale=1., br=10.):
+        self.low = float(low)
+        self.width = (float(high) - self.low) / nbins
+        self.nbins = nbins
+        self.sigscale = sigscale
+        self.bkgscale = bkgscale
+        self.br = br
+        # Fenwick trees (1-based, position p=nbins+1-bin), tree[p] is the sum of the positions p-lowbit(p)+1 to p
+        self.signal = np.zeros(nbins + 1)
+        self.background = np.zeros(nbins + 1)
+        self.nevents = 0
+
+    def positions(self, score):
+        """ position in the trees (nbins+1-bin) of each score """
+        index = np.ceil((np.asarray(score, dtype=np.float64) - self.low) / self.width) - 1
+        return self.nbins - np.clip(np.nan_to_num(index), 0, self.nbins - 1).astype(np.intp)
+
+    def _add(self, tree, index, weight):
+        # sum the weights of identical bins first, then go up the tree one level at a time
+        index, inverse = np.unique(index, return_inverse=True)
+        weight = np.bincount(inverse.ravel(), weights=weight, minlength=len(index))
+        while len(index):
+            np.add.at(tree, index, weight)
+            index = index + (index & -index)
+            inside = index <= self.nbins
+            index, weight = index[inside], weight[inside]
+
+    def _prefix(self, tree, index):
+        """ sum of the positions 1 to index (array), i.e. of the index top bins """
+        index = np.array(index, dtype=np.intp)
+        total = np.zeros(index.shape)
+        while np.any(index > 0):
+            total += tree[index]
+            index = index - (index & -index)
+        return total
+
+    def _cumulative(self, tree):
+        """ sums of the positions 1 to p for every position p, in a single pass over the tree
+        (the weight of each position is its node minus the nodes of its children) """
+        weight = tree.copy()
+        child = np.arange(1, self.nbins + 1)
+        parent = child + (child & -child)
+        inside = parent <= self.nbins
+        np.subtract.at(weight, parent[inside], tree[child[inside]])
+        return np.cumsum(weight)
+
+    def add(self, score, issig, weight):
+        """ add a batch of events """
+        index = self.positions(score)
+        issig = np.asarray(issig, dtype=bool)
+        weight = np.asarray(weight, dtype=np.float64)
+        self._add(self.signal, index[issig], weight[issig])
+        self._add(self.background, index[~issig], weight[~issig])
+        self.nevents += len(index)
+
+    def merge(self, other):
+        """ add the events of another tracker with the same binning (Fenwick trees are linear) """
+        if (other.low, other.width, other.nbins) != (self.low, self.width, self.nbins):
+            raise ValueError("only trackers with the same binning can be merged")
+        self.signal += other.signal
+        self.background += other.background
+        self.nevents += other.nevents
+
+    def edge(self, index):
+        """ lower edge of bin index """
+        return self.low + (np.asarray(index) - 1) * self.width
+
+    def selected(self, threshold):
+        """ signal and background weight above threshold (score>edge, from the first bin edge at or above it) """
+        below = np.clip(np.ceil((threshold - self.low) / self.width), 0, self.nbins).astype(np.intp)
+        return (self._prefix(self.signal, self.nbins - below) * self.sigscale,
+                self._prefix(self.background, self.nbins - below) * self.bkgscale)
+
+    def ams_at(self, threshold):
+        signal, background = self.selected(threshold)
+        return {"threshold": threshold, "ams": float(ams(signal, background, self.br)),
+                "signal": float(signal), "background": float(background)}
+
+    def ams_curve(self):
+        """ same as higgsml_ams.ams_curve, with the bin edges as thresholds """
+        index = np.arange(self.nbins)
+        # the weight above the edge of bin index+1 is the sum of the nbins-index top positions
+        sig = self._cumulative(self.signal)[self.nbins - index] * self.sigscale
+        bkg = self._cumulative(self.background)[self.nbins - index] * self.bkgscale
+        return {"threshold": self.edge(index + 1), "ams": ams(sig, bkg, self.br), "signal": sig, "background": bkg,
+                "amssimple": amssimple(sig, bkg), "amsasimov": amsasimov(sig, bkg)}
+
+    def best(self):
+        """ best point of the AMS curve (dictionary threshold, ams, signal, background...) """
+        return best_point(self.ams_curve())
+
+
+def _count_below(score, eventid, bound):
+    """ number of entries of the sorted (score, eventid) arrays lower or equal to the pair bound """
+    low = np.searchsorted(score, bound[0], side="left")
+    high = np.searchsorted(score, bound[0], side="right")
+    return int(low + np.searchsorted(eventid[low:high], bound[1], side="right"))
+
+
+def external_sort(blocks, blockrows=None, memory=MEMORY, tmpdir=None):
+    """ sort (score, eventid) pairs by increasing score then eventid, with bounded memory
+    blocks : iterable of (score, eventid) arrays, each is sorted and written to disk as a run
+    Yield (score, eventid) sorted blocks. The runs are merged a block at a time: each run gives its
+    next entries, everything up to the smallest of the last entries read from each run is in order """
+    blockrows = blockrows or block_rows(memory, 4)
+    workdir = tempfile.mkdtemp(prefix="higgsml_sort", dir=tmpdir)
+    try:
+        runs = []
+        for score, eventid in blocks:
+            order = np.lexsort((eventid, score))
+            name = os.path.join(workdir, "run%d" % len(runs))
+            np.save(name + "_score.npy", np.asarray(score)[order])
+            np.save(name + "_id.npy", np.asarray(eventid)[order])
+            runs += [name]
+        runs = [(np.load(name + "_score.npy", mmap_mode="r"), np.load(name + "_id.npy", mmap_mode="r"))
+                for name in runs]
+        positions = [0] * len(runs)
+        chunk = max(1, blockrows // max(len(runs), 1))
+        while True:
+            heads = []
+            bound = None
+            for irun, (score, eventid) in enumerate(runs):
+                if positions[irun] >= len(score):
+                    continue
+                stop = min(positions[irun] + chunk, len(score))
+                head = (np.array(score[positions[irun]:stop]), np.array(eventid[positions[irun]:stop]))
+                heads += [(irun, head)]
+                if stop < len(score):
+                    last = (head[0][-1], head[1][-1])
+                    bound = last if bound is None or last < bound else bound
+            if not heads:
+                break
+            parts = []
+            for irun, (score, eventid) in heads:
+                n = len(score) if bound is None else _count_below(score, eventid, bound)
+                parts += [(score[:n], eventid[:n])]
+                positions[irun] += n
+            score = np.concatenate([part[0] for part in parts])
+            eventid = np.concatenate([part[1] for part in parts])
+            order = np.lexsort((eventid, score))
+            yield score[order], eventid[order]
+        del runs
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
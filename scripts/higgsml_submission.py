@@ -0,0 +1,69 @@
+"""
+ATLAS Higgs Machine Learning Challenge 2014
+
+Ranking of the test events and writing of a submission file in kaggle format
+
+The RankOrder is computed with a single stable sort on (score, EventId): events with
+identical scores are ranked by EventId, so identical scores never cause a problem.
+Class is "s" for score>threshold, so all signal ranks are above all background ranks.
+The file is written in blocks of lines, in rank order.
+
+Typical use:
+    from higgsml_submission import write_submission
+    write_submission("submission.csv",eventid,score,threshold)
+
+For more events than fit in memory, write_submission_stream takes the events block by block
+and ranks them with an external merge sort (see higgsml_stream.py).
+"""
+
+import numpy as np
+from higgsml_stream import external_sort, MEMORY
+from higgsml_instrument import instrumented, result_value
+
+
+# number of lines formatted and written at a time
+BLOCKSIZE = 100000
+
+
+def rank_order(eventid, score):
+    """ index of the events sorted by increasing score (ties by increasing EventId), and
+    the RankOrder of each event in the input order (starting at 1 as kaggle wants) """
+    order = np.lexsort((np.asarray(eventid), np.asarray(score)))
+    ranks = np.empty(len(order), dtype=np.int64)
+    ranks[order] = np.arange(1, len(order) + 1)
+    return order, ranks
+
+
+def write_sorted_lines(outputfile, sortedid, sortedscore, threshold, firstrank=1, blocksize=BLOCKSIZE):
+    """ write the lines of events already sorted by rank, the first one has RankOrder firstrank """
+    sortedclass = np.where(sortedscore > threshold, "s", "b")
+    for start in range(0, len(sortedid), blocksize):
+        stop = min(start + blocksize, len(sortedid))
+        lines = zip(sortedid[start:stop].tolist(), range(firstrank + start, firstrank + stop),
+                    sortedclass[start:stop].tolist())
+        outputfile.write("".join(["%d,%d,%s\n" % line for line in lines]))
+
+
+@instrumented("submit", rows=result_value)
+def write_submission(filename, eventid, score, threshold, blocksize=BLOCKSIZE):
+    """ write the submission file (EventId,RankOrder,Class) of the events, return the number of events written """
+    eventid = np.asarray(eventid)
+    score = np.asarray(score)
+    order, ranks = rank_order(eventid, score)
+    with open(filename, "w") as outputfile:
+        outputfile.write("EventId,RankOrder,Class\n")
+        write_sorted_lines(outputfile, eventid[order], score[order], threshold, 1, blocksize)
+    return len(order)
+
+
+@instrumented("submit", rows=result_value)
+def write_submission_stream(filename, blocks, threshold, memory=MEMORY, blocksize=BLOCKSIZE):
+    """ same as write_submission for events given in blocks of (eventid, score) arrays, with bounded memory
+    (same file as write_submission on all the events), return the number of events written """
+    nwritten = 0
+    with open(filename, "w") as outputfile:
+        outputfile.write("EventId,RankOrder,Class\n")
+        for score, eventid in external_sort(((score, eventid) for eventid, score in blocks), memory=memory):
+            write_sorted_lines(outputfile, eventid, score, threshold, nwritten + 1, blocksize)
+            nwritten += len(eventid)
+    return nwritten
@@ -0,0 +1,104 @@
+"""
+ATLAS Higgs Machine Learning Challenge 2014
+
+Subsets of the events (selection, random fraction, stratified split) with renormalised weights
+
+The weights of a subset have to be renormalised so that its total signal and background weight
+are those of the full dataset, this is how KaggleWeight was derived from Weight:
+  for signal events (Label==1)     Weight*(Sum_(i all signal) Weight_i)/(Sum_(i subset signal) Weight_i)
+  for background events (Label==0) Weight*(Sum_(i all background) Weight_i)/(Sum_(i subset background) Weight_i)
+SubsetBuilder computes once the group of each event (combination of the values of the strata
+variables, e.g. Label, KaggleSet, PRI_jet_num) and the total weights per class, then each subset
+only costs a few bincount over the events, so that building many subsets is cheap:
+  select(mask)             the events of a selection
+  sample(fraction,seed)    a random fraction, the same fraction of each group
+  split(fractions,seed)    a random partition, each part has the same fraction of each group
+A subset is a dictionary with the index of its events (increasing), the renormalised weights
+(one entry per weight variable) and the signal and background scale factors.
+
+Typical use:
+    from higgsml_subset import SubsetBuilder
+    builder=SubsetBuilder(columns,strata=["Label","KaggleSet","PRI_jet_num"])
+    train,valid=builder.split([0.7,0.3],seed=1)
+    best,curve=optimise_threshold(score[valid["index"]],issig[valid["index"]],valid["weights"]["Weight"])
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+
+
+STRATA = ("Label", "KaggleSet", "PRI_jet_num")
+WEIGHTS = ("Weight", "KaggleWeight")
+
+
+def group_codes(columns, variables):
+    """ code (0 to ngroups-1) of the combination of the values of the variables for each event, and ngroups """
+    codes = np.zeros(len(columns[variables[0]]) if variables else 0, dtype=np.intp)
+    ngroups = 1
+    for var in variables:
+        values, inverse = np.unique(np.asarray(columns[var]), return_inverse=True)
+        codes = codes * len(values) + inverse.ravel()
+        ngroups *= len(values)
+    return codes, ngroups
+
+
+class SubsetBuilder(object):
+    """ builds subsets of the events of columns with their weights renormalised to the full set, stratified by
+    the strata variables (random subsets have the same fraction of each combination of their values) """
+
+    def __init__(self, columns, strata=STRATA, weights=WEIGHTS, label="Label"):
+        self.label = np.asarray(columns[label]).astype(np.intp)
+        self.weights = OrderedDict((var, np.asarray(columns[var], dtype=np.float64)) for var in weights if var in columns)
+        self.nevents = len(self.label)
+        self.codes, self.ngroups = group_codes(columns, list(strata))
+        self.counts = np.bincount(self.codes, minlength=self.ngroups)
+        # events grouped by group (sorted once), group g is grouped[starts[g]:starts[g+1]]
+        self.grouped = np.argsort(self.codes, kind="mergesort")
+        self.starts = np.append(0, np.cumsum(self.counts))
+        # total weight of each class in the full set
+        self.totals = dict((var, np.bincount(self.label, weights=weight, minlength=2))
+                           for var, weight in self.weights.items())
+
+    def subset(self, index):
+        """ subset of the events of index, with the weights renormalised per class """
+        index = np.asarray(index, dtype=np.intp)
+        label = self.label[index]
+        result = {"index": index, "weights": OrderedDict(), "scales": {}}
+        for var, weight in self.weights.items():
+            values = weight[index]
+            subtotals = np.bincount(label, weights=values, minlength=2)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                scales = np.where(subtotals > 0, self.totals[var] / subtotals, 0.)
+            result["weights"][var] = values * scales[label]
+            # (signal, background) factors as higgsml_ams.renormalisation
+            result["scales"][var] = (float(scales[1]), float(scales[0]))
+        return result
+
+    def select(self, mask):
+        """ subset of the events where mask is True """
+        return self.subset(np.flatnonzero(mask))
+
+    def _positions(self, seed):
+        """ random rank of each event within its group """
+        rng = np.random.RandomState(seed)
+        positions = np.empty(self.nevents, dtype=np.intp)
+        for start, stop in zip(self.starts[:-1], self.starts[1:]):
+            positions[self.grouped[start:stop]] = rng.permutation(stop - start)
+        return positions
+
+    def sample(self, fraction, seed=0):
+        """ random subset with round(fraction*size) events of each group """
+        keep = np.round(fraction * self.counts).astype(np.intp)
+        return self.select(self._positions(seed) < keep[self.codes])
+
+    def split(self, fractions, seed=0):
+        """ random partition in len(fractions) subsets, each with round(fraction*size) events of each group
+        (the fractions are normalised to 1) """
+        fractions = np.asarray(fractions, dtype=np.float64)
+        cuts = np.round(np.outer(self.counts, np.cumsum(fractions) / fractions.sum())).astype(np.intp)
+        positions = self._positions(seed)
+        part = (positions[:, np.newaxis] >= cuts[self.codes]).sum(axis=1)
+        order = np.argsort(part, kind="mergesort")
+        bounds = np.searchsorted(part[order], np.arange(len(fractions) + 1))
+        return [self.subset(order[bounds[ipart]:bounds[ipart + 1]]) for ipart in range(len(fractions))]
@@ -0,0 +1,239 @@
+"""
+ATLAS Higgs Machine Learning Challenge 2014
+
+Synthetic data with the schema of atlas-higgs-challenge-2014-v2.csv (for benchmarks and tests
+when the real file is not available)
+
+The file has the same header, the same types (EventId and PRI_jet_num int, Label s/b,
+KaggleSet t/b/v/u, all others float) and the same structure as the real file:
+  - the jet variables are -999.0 when there are not enough jets (PRI_jet_num 0 : no jet variable,
+    PRI_jet_num 1 : no subleading jet nor dijet variable), PRI_jet_all_pt is 0 without jet
+  - DER_mass_MMC is -999.0 for some events (more often for background)
+  - the proportions of signal and of the kaggle sets are those of the real file
+  - Weight sums per Label are those of the real file whatever the number of events,
+    KaggleWeight is Weight renormalised per KaggleSet and Label to the totals of each Label,
+    as in the real file (see kaggle_factors)
+The physics variables are rough shapes, signal and background differ enough for a BDT or a
+threshold to give an AMS of a few units, which is all the benchmarks need.
+
+The events are generated in blocks of BLOCKSIZE rows, each with its own seed (seed, block index),
+the blocks are generated and formatted in a pool of processes and written in order, so the file
+only depends on the number of rows and the seed. The KaggleWeight factors need the Weight sums of
+the whole file: a first pass generates the blocks only to sum their weights.
+
+Typical use:
+    python higgsml_synthetic.py 1 synthetic.csv    (scale 1 = 818238 events as the real file, up to 100)
+or
+    from higgsml_synthetic import write_csv,generate_columns
+    write_csv("synthetic.csv",scale=10)
+    columns=generate_columns(100000) # same columns as higgsml_data.load_csv, no file
+"""
+
+import math
+import multiprocessing
+import os
+import sys
+from collections import OrderedDict
+
+import numpy as np
+from higgsml_data import LABELS, KAGGLESETS
+
+
+HEADER = ["EventId", "DER_mass_MMC", "DER_mass_transverse_met_lep", "DER_mass_vis", "DER_pt_h",
+          "DER_deltaeta_jet_jet", "DER_mass_jet_jet", "DER_prodeta_jet_jet", "DER_deltar_tau_lep",
+          "DER_pt_tot", "DER_sum_pt", "DER_pt_ratio_lep_tau", "DER_met_phi_centrality",
+          "DER_lep_eta_centrality", "PRI_tau_pt", "PRI_tau_eta", "PRI_tau_phi", "PRI_lep_pt",
+          "PRI_lep_eta", "PRI_lep_phi", "PRI_met", "PRI_met_phi", "PRI_met_sumet", "PRI_jet_num",
+          "PRI_jet_leading_pt", "PRI_jet_leading_eta", "PRI_jet_leading_phi", "PRI_jet_subleading_pt",
+          "PRI_jet_subleading_eta", "PRI_jet_subleading_phi", "PRI_jet_all_pt", "Weight", "Label",
+          "KaggleSet", "KaggleWeight"]
+
+# number of events of the real file, and of each kaggle set
+NEVENTS = 818238
+KAGGLESET_FRACTIONS = np.array([250000., 100000., 450000., 18238.]) / NEVENTS  # t b v u
+SIGNAL_FRACTION = 0.3417
+# probability of PRI_jet_num 0,1,2,3
+JET_FRACTIONS = [0.40, 0.31, 0.20, 0.09]
+# probability of DER_mass_MMC undefined, for background and signal
+MMC_MISSING = [0.20, 0.05]
+# sums of Weight of the background and of the signal of the real file
+WEIGHT_SUMS = [411000., 692.]
+# relative values and probabilities of the background weights (a few processes with very different weights)
+BACKGROUND_WEIGHTS = [(0.002, 0.25), (0.02, 0.05), (0.5, 0.30), (1.0, 0.20), (2.5, 0.15), (5.0, 0.05)]
+
+# number of rows generated at a time by one process
+BLOCKSIZE = 100000
+FIRST_EVENTID = 100000
+MISSING = -999.
+
+
+def rng_eta(rng, n, width):
+    return np.clip(rng.normal(0., width, n), -width * 2, width * 2)
+
+
+def rng_phi(rng, n):
+    return rng.uniform(-math.pi, math.pi, n)
+
+
+# name -> (function(rng, number of events, issig) -> values, minimum number of jets for the variable to be defined)
+VARIABLES = OrderedDict([
+    ("DER_mass_MMC", (lambda rng, n, s: np.where(s, np.abs(rng.normal(125., 20., n)), rng.gamma(4., 25., n)), 0)),
+    ("DER_mass_transverse_met_lep", (lambda rng, n, s: rng.gamma(2., np.where(s, 15., 30.)), 0)),
+    ("DER_mass_vis", (lambda rng, n, s: np.where(s, np.abs(rng.normal(100., 20., n)), rng.gamma(5., 17., n)), 0)),
+    ("DER_pt_h", (lambda rng, n, s: rng.gamma(2., np.where(s, 40., 30.)), 0)),
+    ("DER_deltaeta_jet_jet", (lambda rng, n, s: rng.uniform(0., np.where(s, 8., 6.)), 2)),
+    ("DER_mass_jet_jet", (lambda rng, n, s: rng.gamma(2., np.where(s, 250., 200.)), 2)),
+    ("DER_prodeta_jet_jet", (lambda rng, n, s: rng.normal(-1., 3., n), 2)),
+    ("DER_deltar_tau_lep", (lambda rng, n, s: rng.gamma(np.where(s, 6., 8.), 0.35), 0)),
+    ("DER_pt_tot", (lambda rng, n, s: rng.gamma(1.5, 12., n), 0)),
+    ("DER_sum_pt", (lambda rng, n, s: rng.gamma(4., np.where(s, 45., 40.)), 0)),
+    ("DER_pt_ratio_lep_tau", (lambda rng, n, s: rng.gamma(3., 0.5, n), 0)),
+    ("DER_met_phi_centrality", (lambda rng, n, s: rng.uniform(-1.414, 1.414, n), 0)),
+    ("DER_lep_eta_centrality", (lambda rng, n, s: rng.uniform(0., 1., n), 2)),
+    ("PRI_tau_pt", (lambda rng, n, s: 20. + rng.gamma(2., np.where(s, 20., 15.)), 0)),
+    ("PRI_tau_eta", (lambda rng, n, s: rng_eta(rng, n, 1.2), 0)),
+    ("PRI_tau_phi", (lambda rng, n, s: rng_phi(rng, n), 0)),
+    ("PRI_lep_pt", (lambda rng, n, s: 26. + rng.gamma(2., 15., n), 0)),
+    ("PRI_lep_eta", (lambda rng, n, s: rng_eta(rng, n, 1.2), 0)),
+    ("PRI_lep_phi", (lambda rng, n, s: rng_phi(rng, n), 0)),
+    ("PRI_met", (lambda rng, n, s: rng.gamma(2., 20., n), 0)),
+    ("PRI_met_phi", (lambda rng, n, s: rng_phi(rng, n), 0)),
+    ("PRI_met_sumet", (lambda rng, n, s: rng.gamma(4., 55., n), 0)),
+    ("PRI_jet_leading_pt", (lambda rng, n, s: 30. + rng.gamma(2., 40., n), 1)),
+    ("PRI_jet_leading_eta", (lambda rng, n, s: rng_eta(rng, n, 2.2), 1)),
+    ("PRI_jet_leading_phi", (lambda rng, n, s: rng_phi(rng, n), 1)),
+    ("PRI_jet_subleading_pt", (lambda rng, n, s: 30. + rng.gamma(2., 20., n), 2)),
+    ("PRI_jet_subleading_eta", (lambda rng, n, s: rng_eta(rng, n, 2.2), 2)),
+    ("PRI_jet_subleading_phi", (lambda rng, n, s: rng_phi(rng, n), 2)),
+])
+
+# format of one line of the csv file, in the order of HEADER
+LINE_FORMAT = ",".join(["%d"] + ["%.3f"] * 22 + ["%d"] + ["%.3f"] * 7 + ["%.15g", "%s", "%s", "%.15g"]) + "\n"
+
+
+def kaggle_factors(sums):
+    """ KaggleWeight/Weight for each (KaggleSet, Label) from the sums of Weight, array (KaggleSets, Labels):
+    total of the Label over all events / total in the KaggleSet """
+    sums = np.asarray(sums, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(sums > 0, sums.sum(axis=0) / sums, 0.)
+
+
+def weight_sums(columns):
+    """ sums of Weight per (KaggleSet, Label), array (KaggleSets, Labels) """
+    index = columns["KaggleSet"].astype(np.intp) * len(LABELS) + columns["Label"]
+    return np.bincount(index, weights=columns["Weight"], minlength=len(KAGGLESETS) * len(LABELS)).reshape(-1, len(LABELS))
+
+
+def generate_block(iblock, nrows, seed=0, scale=1., factors=None):
+    """ rows [iblock*BLOCKSIZE, iblock*BLOCKSIZE+nrows) of the synthetic file, as an OrderedDict of columns
+    with the types of higgsml_data.load_csv (Label and KaggleSet as codes)
+    scale : number of events of the full file over the real number, weights are divided by scale
+    factors : KaggleWeight factors of the whole file (see kaggle_factors), default those of the block alone """
+    rng = np.random.RandomState([seed, iblock])
+    issig = rng.random_sample(nrows) < SIGNAL_FRACTION
+    njet = np.searchsorted(np.cumsum(JET_FRACTIONS), rng.random_sample(nrows), side="right").astype(np.int32)
+    njet = np.minimum(njet, len(JET_FRACTIONS) - 1)
+    kaggleset = np.searchsorted(np.cumsum(KAGGLESET_FRACTIONS), rng.random_sample(nrows), side="right")
+    kaggleset = np.minimum(kaggleset, len(KAGGLESETS) - 1).astype(np.int8)
+
+    columns = OrderedDict()
+    columns["EventId"] = np.arange(FIRST_EVENTID + iblock * BLOCKSIZE, FIRST_EVENTID + iblock * BLOCKSIZE + nrows,
+                                   dtype=np.int32)
+    for var, (func, minjets) in VARIABLES.items():
+        values = np.round(func(rng, nrows, issig), 3)
+        if minjets > 0:
+            values[njet < minjets] = MISSING
+        columns[var] = values
+    columns["DER_mass_MMC"][rng.random_sample(nrows) < np.where(issig, MMC_MISSING[1], MMC_MISSING[0])] = MISSING
+    columns["PRI_jet_num"] = njet
+    leading = np.where(njet >= 1, columns["PRI_jet_leading_pt"], 0.)
+    subleading = np.where(njet >= 2, columns["PRI_jet_subleading_pt"], 0.)
+    extra = np.where(njet >= 3, np.round(rng.gamma(2., 15., nrows), 3), 0.)
+    columns["PRI_jet_all_pt"] = leading + subleading + extra
+
+    # background weight : one of a few processes, signal weight : around the same small value
+    values, probabilities = zip(*BACKGROUND_WEIGHTS)
+    process = np.searchsorted(np.cumsum(probabilities), rng.random_sample(nrows), side="right")
+    bkgweight = np.array(values)[np.minimum(process, len(values) - 1)] * rng.uniform(0.9, 1.1, nrows)
+    sigweight = rng.uniform(0.8, 1.2, nrows)
+    meanbkg = sum(value * probability for value, probability in BACKGROUND_WEIGHTS)
+    expected = NEVENTS * scale * np.array([1. - SIGNAL_FRACTION, SIGNAL_FRACTION])
+    weight = np.where(issig, sigweight * WEIGHT_SUMS[1] / expected[1], bkgweight * WEIGHT_SUMS[0] / (meanbkg * expected[0]))
+    columns["Weight"] = weight
+    columns["Label"] = issig.astype(np.int8)  # code of "s" is 1 (see higgsml_data.LABELS)
+    columns["KaggleSet"] = kaggleset
+    factors = kaggle_factors(weight_sums(columns)) if factors is None else factors
+    columns["KaggleWeight"] = weight * factors[kaggleset, columns["Label"]]
+    return columns
+
+
+def format_block(columns):
+    """ lines of the csv file for a block of columns """
+    decoded = []
+    for var in HEADER:
+        if var == "Label":
+            decoded += [np.array(LABELS)[columns[var]].tolist()]
+        elif var == "KaggleSet":
+            decoded += [np.array(KAGGLESETS)[columns[var]].tolist()]
+        else:
+            decoded += [columns[var].tolist()]
+    return "".join([LINE_FORMAT % line for line in zip(*decoded)])
+
+
+def _sums_task(task):
+    return weight_sums(generate_block(*task))
+
+
+def _format_task(task):
+    return format_block(generate_block(*task))
+
+
+def blocks(nrows, seed=0, scale=1.):
+    """ list of (block index, number of rows, seed, scale), one per block of the file """
+    return [(iblock, min(BLOCKSIZE, nrows - start), seed, scale)
+            for iblock, start in enumerate(range(0, nrows, BLOCKSIZE))]
+
+
+def generate_columns(nrows=None, seed=0, scale=1.):
+    """ all the columns in memory, without writing a file (nrows defaults to scale times the real size) """
+    nrows = int(round(NEVENTS * scale)) if nrows is None else nrows
+    parts = [generate_block(*task) for task in blocks(nrows, seed, float(nrows) / NEVENTS)]
+    columns = OrderedDict((var, np.concatenate([part[var] for part in parts])) for var in HEADER)
+    factors = kaggle_factors(weight_sums(columns))
+    columns["KaggleWeight"] = columns["Weight"] * factors[columns["KaggleSet"], columns["Label"]]
+    return columns
+
+
+def write_csv(filename, nrows=None, seed=0, scale=1., nworkers=None):
+    """ write the synthetic csv file (nrows defaults to scale times the real size)
+    nworkers : number of processes (default number of cores), 1 to generate in this process
+    Return the number of rows written """
+    nrows = int(round(NEVENTS * scale)) if nrows is None else nrows
+    tasks = blocks(nrows, seed, float(nrows) / NEVENTS)
+    pool = None if nworkers == 1 or len(tasks) <= 1 else multiprocessing.Pool(nworkers)
+    # write under a temporary name, an interrupted run leaves no partial file under the final name
+    tmpname = filename + ".tmp%d" % os.getpid()
+    try:
+        # first pass : the weight sums of the whole file for the KaggleWeight factors
+        factors = kaggle_factors(sum(pool.map(_sums_task, tasks) if pool else [_sums_task(task) for task in tasks]))
+        tasks = [task + (factors,) for task in tasks]
+        with open(tmpname, "w") as f:
+            f.write(",".join(HEADER) + "\n")
+            # imap keeps the order of the blocks, only a few formatted blocks wait in memory
+            for text in (pool.imap(_format_task, tasks) if pool else (_format_task(task) for task in tasks)):
+                f.write(text)
+        os.rename(tmpname, filename)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+    return nrows
+
+
+if __name__ == "__main__":
+    scale = float(sys.argv[1]) if len(sys.argv) > 1 else 1.
+    filename = sys.argv[2] if len(sys.argv) > 2 else "synthetic_x%g.csv" % scale
+    print("writing %d events into %s" % (write_csv(filename, scale=scale), filename))